@@ -1,8 +1,20 @@
-from dash import Dash, html, dcc
+from concurrent.futures import Future
+from threading import Thread
+from gzip import decompress
+from time import perf_counter
+from dash import Dash, html, dcc, Input, Output
+from dash.exceptions import PreventUpdate
 import dash_ag_grid as dag
-import plotly.express as px
-from stats_analysis import RESP_FREQ_DF, COMPARISON, COMPARISON_FILTER, DATA_FRAME_SUMMARY, DATA_FRAME_FILTERED_BOXPLOT
-from subset_analysis import DATA_FRAME_PROJECTS, DATA_FRAME_RESPONDERS, DATA_FRAME_SEXES, DATA_FRAME_FILTER
+from flask import Response, request
+from pandas import DataFrame
+from stats_analysis import comparison, comparison_filter, cohort_comparison, filtered_frequencies, response_frequencies
+from cohort import FILTERS, Cohort, cohort_frequencies, cohort_options
+from query_cache import cached_query
+from figures import box_figure
+from summary_grid import FIELDS, PAGE_SIZE, TEXT_FIELDS, summary_rows
+from subset_analysis import baseline_samples, samples_per_project, subjects_per_response, subjects_per_sex
+from instrument import configure_logging, logger, span
+from payload_cache import cached_payload, decode_payload, payload_key
 
 # pip install "dash[cloud]"
 
@@ -11,6 +23,10 @@ FONT_SIZE = 18
 FONT_FAMILY = "Arial"
 SMALL_TABLE_WIDTH = "30rem"
 THEME = "themeBalham"
+FILTER_LABELS = { "condition": "Condition", "treatment": "Treatment", "sample_type": "Sample Type",
+                  "time_from_treatment_start": "Time From Treatment Start", "sex": "Sex" }
+POLL_INTERVAL = 1000
+"""Milliseconds between a page's checks for the warmed-up sections, until it has them"""
 
 app = Dash(__name__, title = "Teiko Exam - Data Analysis")
 
@@ -19,55 +35,54 @@ app.layout = [
             style = { "textAlign": "center", "fontSize": HEADER_SIZE, "fontFamily": FONT_FAMILY }),
     html.H2(children = "Summary Table",
             style = { "textAlign": "center", "fontSize": HEADER_SIZE, "fontFamily": FONT_FAMILY }),
+    # Rows are fetched from the database one page at a time as the grid scrolls, sorts, and filters (see `summary_page`)
     dag.AgGrid(
-        rowData = DATA_FRAME_SUMMARY.to_dict("records"),
+        id = "summary-grid",
+        rowModelType = "infinite",
         columnSize = "responsiveSizeToFit",
-        columnDefs = [ { "field": i, "filter": True } for i in DATA_FRAME_SUMMARY.columns ],
-        dashGridOptions = { "theme": THEME, "pagination": False },
+        columnDefs = [ { "field": i, "filter": "agTextColumnFilter" if i in TEXT_FIELDS else "agNumberColumnFilter" } for i in FIELDS ],
+        dashGridOptions = { "theme": THEME, "cacheBlockSize": PAGE_SIZE, "maxBlocksInCache": 10, "infiniteInitialRowCount": PAGE_SIZE },
     ),
 
     html.H1(children = "Part 3: Statistical Analysis",
             style = { "textAlign": "center", "fontSize": HEADER_SIZE, "fontFamily": FONT_FAMILY }),
     
     # Boxplot displaying the relative frequencies of responders vs. non-responders for each cell population
-    dcc.Graph(figure = px.box(RESP_FREQ_DF,
-                              x = "population",
-                              y = "percentage",
-                              color = "response",
-                              labels = { "population": "Cell Population", "percentage": "Relative Frequency (%)", "response": "Response" },
-                              title = "Responders vs. Non-Responders",
-                              subtitle = "Relative frequencies of responders vs. non-responders for each cell population"
-                            )
-              ),
+    dcc.Loading(dcc.Graph(id = "responders-boxplot")),
     
     html.H2(children = "Differences in relative frequencies between responders vs. non-responders for each cell population",
             style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
     html.H3(children = "This data is for all samples with responses",
             style = { "textAlign": "center", "fontSize": (FONT_SIZE * 0.9), "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = COMPARISON.to_dict("records"),
+        id = "responders-comparison",
         dashGridOptions = { "domLayout": "autoHeight", "theme": THEME },
-        columnDefs = [ { "field": i, "filter": True } for i in COMPARISON.columns ],
     ),
 
-    dcc.Graph(figure = px.box(DATA_FRAME_FILTERED_BOXPLOT,
-                              x = "population",
-                              y = "percentage",
-                              color = "response",
-                              labels = { "population": "Cell Population", "percentage": "Relative Frequency (%)", "response": "Response" },
-                              title = "Filtered Responders vs. Non-Responders",
-                              subtitle = "Relative frequencies of melanoma patients receiving miraclib who respond vs. non-responders for each cell population that includes PBMC samples"
-                            )
-              ),
+    dcc.Loading(dcc.Graph(id = "filtered-boxplot")),
 
     html.H2(children = "Differences in relative frequencies between responders vs. non-responders for each cell population",
             style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
     html.H3(children = "This data is filtered to only include melanoma patients receiving miraclib with PBMC samples",
             style = { "textAlign": "center", "fontSize": (FONT_SIZE * 0.9), "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = COMPARISON_FILTER.to_dict("records"),
-        dashGridOptions = { "domLayout": "autoHeight", "theme": THEME },
-        columnDefs = [ { "field": i, "filter": True } for i in COMPARISON_FILTER.columns ]
+        id = "filtered-comparison",
+        dashGridOptions = { "domLayout": "autoHeight", "theme": THEME }
+    ),
+
+    html.H2(children = "Explore a cohort",
+            style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
+    html.H3(children = "Pick any combination of values; leaving a filter empty includes all of its values",
+            style = { "textAlign": "center", "fontSize": (FONT_SIZE * 0.9), "fontFamily": FONT_FAMILY }),
+    html.Div(children = [
+        dcc.Dropdown(id = f"cohort-{column}", options = [], multi = True, placeholder = FILTER_LABELS[column],
+                     style = { "minWidth": "12rem", "fontFamily": FONT_FAMILY })
+        for column in FILTERS
+    ], style = { "display": "flex", "gap": "1rem", "justifyContent": "center", "flexWrap": "wrap" }),
+    dcc.Graph(id = "cohort-boxplot"),
+    dag.AgGrid(
+        id = "cohort-comparison",
+        dashGridOptions = { "domLayout": "autoHeight", "theme": THEME }
     ),
 
     html.H1(children = "Part 4: Data Subset Analysis",
@@ -76,10 +91,9 @@ app.layout = [
     html.H2(children = "1. All melanoma PBMC samples at baseline from patients treated with miraclib",
             style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = DATA_FRAME_FILTER.to_dict("records"),
+        id = "baseline-samples",
         columnSize = "responsiveSizeToFit",
         style = { "width": SMALL_TABLE_WIDTH, "margin": "0 auto" },
-        columnDefs = [ { "field": i, "filter": True } for i in DATA_FRAME_FILTER.columns ],
         dashGridOptions = { "theme": THEME },
     ),
 
@@ -88,33 +102,257 @@ app.layout = [
     html.P(children = "Note: All other projects (i.e. prj2) have 0 samples in the filtered dataset",
             style = { "textAlign": "center", "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = DATA_FRAME_PROJECTS.to_dict("records"),
+        id = "samples-per-project",
         dashGridOptions = { "domLayout": "autoHeight", "theme": THEME },
         columnSize = "responsiveSizeToFit",
         style = { "width": SMALL_TABLE_WIDTH, "margin": "0 auto" },
-        columnDefs = [ { "field": i } for i in DATA_FRAME_PROJECTS.columns ]
     ),
 
     html.H2(children = "3. How many subjects were Responders (yes) vs Non-Responders (no) in the filtered dataset",
             style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = DATA_FRAME_RESPONDERS.to_dict("records"),
+        id = "subjects-per-response",
         dashGridOptions = { "domLayout": "autoHeight", "theme": THEME },
         columnSize = "responsiveSizeToFit",
         style = { "width": SMALL_TABLE_WIDTH, "margin": "0 auto" },
-        columnDefs = [ { "field": i } for i in DATA_FRAME_RESPONDERS.columns ]
     ),
 
     html.H2(children = "4. How many subjects were Males (M) vs. Females (F) in the filtered dataset",
             style = { "textAlign": "center", "fontSize": FONT_SIZE, "fontFamily": FONT_FAMILY }),
     dag.AgGrid(
-        rowData = DATA_FRAME_SEXES.to_dict("records"),
+        id = "subjects-per-sex",
         dashGridOptions = { "domLayout": "autoHeight", "theme": THEME },
         columnSize = "responsiveSizeToFit",
         style = { "width": SMALL_TABLE_WIDTH, "margin": "0 auto" },
-        columnDefs = [ { "field": i } for i in DATA_FRAME_SEXES.columns ]
-    )
+    ),
+
+    # The page is served before the sections above are computed; a clientside callback polls `/payloads/sections`
+    # on every tick until it gets them (see `sections_response`)
+    dcc.Interval(id = "warm-up", interval = POLL_INTERVAL)
 ]
 
+def grid(data_frame: DataFrame, filter: bool = False) -> dict:
+    """
+    Get the row data and column definitions of a grid showing a DataFrame
+
+    Args:
+        data_frame (DataFrame): Rows to show
+        filter (bool, optional): Whether the columns can be filtered; defaults to False
+
+    Returns:
+        dict: "rowData" and "columnDefs" properties of the grid
+    """
+    return {
+        "rowData": data_frame.to_dict("records"),
+        "columnDefs": [ { "field": i, "filter": True } if filter else { "field": i } for i in data_frame.columns ]
+    }
+
+SECTIONS = [
+    ("responders-boxplot", "figure"),
+    ("responders-comparison", "rowData"), ("responders-comparison", "columnDefs"),
+    ("filtered-boxplot", "figure"),
+    ("filtered-comparison", "rowData"), ("filtered-comparison", "columnDefs"),
+    ("cohort-comparison", "columnDefs"),
+    ("baseline-samples", "rowData"), ("baseline-samples", "columnDefs"),
+    ("samples-per-project", "rowData"), ("samples-per-project", "columnDefs"),
+    ("subjects-per-response", "rowData"), ("subjects-per-response", "columnDefs"),
+    ("subjects-per-sex", "rowData"), ("subjects-per-sex", "columnDefs"),
+    *[ (f"cohort-{column}", "options") for column in FILTERS ]
+]
+"""(Component ID, property) filled in by the clientside callback fetching `/payloads/sections`, in the order of its outputs"""
+
+def dashboard_sections() -> list:
+    """
+    Compute every section of the dashboard that depends on the data
+
+    Returns:
+        list: Value of each property in SECTIONS
+    """
+    responders = grid(comparison(), filter = True)
+
+    sections = {
+        "responders-boxplot": { "figure": box_figure(response_frequencies(),
+                                                     title = "Responders vs. Non-Responders",
+                                                     subtitle = "Relative frequencies of responders vs. non-responders for each cell population"
+                                                    ).to_dict() },
+        "responders-comparison": responders,
+        "filtered-boxplot": { "figure": box_figure(filtered_frequencies(),
+                                                   title = "Filtered Responders vs. Non-Responders",
+                                                   subtitle = "Relative frequencies of melanoma patients receiving miraclib who respond vs. non-responders for each cell population that includes PBMC samples"
+                                                  ).to_dict() },
+        "filtered-comparison": grid(comparison_filter(), filter = True),
+        "cohort-comparison": { "columnDefs": responders["columnDefs"] },
+        "baseline-samples": grid(baseline_samples(), filter = True),
+        "samples-per-project": grid(samples_per_project()),
+        "subjects-per-response": grid(subjects_per_response()),
+        "subjects-per-sex": grid(subjects_per_sex()),
+        **{ f"cohort-{column}": { "options": values } for column, values in cohort_options().items() }
+    }
+
+    return [ sections[component][prop] for component, prop in SECTIONS ]
+
+def sections_payload() -> tuple[str, bytes]:
+    """
+    Get `dashboard_sections` as compressed JSON, computed once per database version by whichever worker
+    asks first and shared with the others through the disk (see `payload_cache.cached_payload`)
+
+    Returns:
+        tuple[str, bytes]: Database content version and compressed payload
+    """
+    return cached_payload("sections", dashboard_sections)
+
+def start_warm_up() -> Future:
+    """
+    Compute `sections_payload` on a background thread, so the server can start answering requests right away
+
+    Returns:
+        Future: Resolves to the time the warm-up took in seconds, or to its exception
+    """
+    warm_up = Future()
+
+    def target() -> None:
+        start = perf_counter()
+
+        try:
+            with span("warm_up"):
+                sections_payload()
+
+                # Every page opens on the unfiltered cohort, so it is computed ahead as well
+                cohort_view(*[ None ] * len(FILTERS))
+
+            warm_up.set_result(perf_counter() - start)
+            logger.info("Dashboard ready after %.1fs", warm_up.result())
+
+        except Exception as e:
+            logger.exception("Dashboard warm-up failed")
+            warm_up.set_exception(e)
+
+    # A daemon thread doesn't keep the process alive when the server stops mid-warm-up
+    Thread(target = target, name = "warm-up", daemon = True).start()
+
+    return warm_up
+
+
+@app.callback(Output("summary-grid", "getRowsResponse"), Input("summary-grid", "getRowsRequest"))
+def summary_page(request: dict | None) -> dict:
+    """
+    Serve the summary grid's requested page of rows
+
+    Args:
+        request (dict | None): Page, sort and filter requested by the grid
+
+    Returns:
+        dict: Rows of the page and total number of matching rows
+    """
+    if request is None:
+        raise PreventUpdate
+
+    return summary_rows(request)
+
+@cached_query(maxsize = 128)
+def cohort_boxplot(cohort: Cohort) -> dict:
+    """
+    Boxplot of a cohort's relative frequencies, built once per cohort until the database changes
+
+    Args:
+        cohort (Cohort): Cohort
+
+    Returns:
+        dict: Plotly figure
+    """
+    return box_figure(cohort_frequencies(cohort),
+                      title = "Cohort Responders vs. Non-Responders",
+                      subtitle = "Relative frequencies of the selected cohort's responders vs. non-responders for each cell population"
+                    ).to_dict()
+
+@app.callback(Output("cohort-boxplot", "figure"), Output("cohort-comparison", "rowData"),
+              [ Input(f"cohort-{column}", "value") for column in FILTERS ])
+def cohort_view(*values: list | None) -> list:
+    """
+    Recompute the boxplot and comparison table of the cohort selected with the dropdowns
+
+    Args:
+        *values (list | None): Selected values of each column in FILTERS
+
+    Returns:
+        list: Boxplot figure and comparison table rows
+    """
+    # Sorted tuples, so the same selection always maps to the same cache key
+    cohort = Cohort(**{ column: tuple(sorted(value)) if value else None for column, value in zip(FILTERS, values) })
+
+    # Shared with the other workers through the disk, so each cohort is only computed once per database version
+    _, payload = cached_payload(f"cohort-{payload_key(cohort)}",
+                                lambda: [ cohort_boxplot(cohort), cohort_comparison(cohort).to_dict("records") ])
+
+    return decode_payload(payload)
+
+# The browser fetches the sections' compressed payload as is (see `sections_response`), instead of each worker
+# decoding and re-encoding it in a server-side callback; it keeps polling until the payload is served
+app.clientside_callback(
+    f"""
+    function (_) {{
+        return fetch("{app.get_relative_path("/payloads/sections")}").then(function (response) {{
+            if (!response.ok) {{
+                throw window.dash_clientside.PreventUpdate;
+            }}
+            return response.json().then(function (sections) {{ return sections.concat([ true ]); }});
+        }}).catch(function () {{
+            throw window.dash_clientside.PreventUpdate;
+        }});
+    }}
+    """,
+    [ Output(component, prop) for component, prop in SECTIONS ], Output("warm-up", "disabled"), Input("warm-up", "n_intervals")
+)
+
+@app.server.route("/payloads/sections")
+def sections_response() -> Response | tuple[dict, int]:
+    """
+    Serve the dashboard's sections (see `dashboard_sections`) as gzip-compressed JSON, once the warm-up is done
+
+    The saved payload is sent without decompressing it, to any client accepting gzip. Clients that already
+    have the current version (sent as the ETag) get an empty 304 response.
+
+    Returns:
+        Response | tuple[dict, int]: JSON list of the values of SECTIONS, or 503 while warming up
+    """
+    if not WARM_UP.done():
+        return { "status": "warming up" }, 503
+
+    version, payload = sections_payload()
+
+    if version in request.if_none_match:
+        return Response(status = 304, headers = { "ETag": f'"{version}"' })
+
+    headers = { "ETag": f'"{version}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding" }
+
+    if "gzip" not in request.accept_encodings:
+        return Response(decompress(payload), mimetype = "application/json", headers = headers)
+
+    return Response(payload, mimetype = "application/json", headers = { **headers, "Content-Encoding": "gzip" })
+
+@app.server.route("/ready")
+def ready() -> tuple[dict, int]:
+    """
+    Readiness check: 200 once the dashboard's sections are computed, 503 until then (or if computing them failed)
+
+    Returns:
+        tuple[dict, int]: JSON status and HTTP status code
+    """
+    if not WARM_UP.done():
+        return { "status": "warming up" }, 503
+
+    if error := WARM_UP.exception():
+        return { "status": "failed", "error": str(error) }, 503
+
+    return { "status": "ready", "warm_up_seconds": round(WARM_UP.result(), 3) }, 200
+
+server = app.server
+"""WSGI application, for serving the dashboard with e.g. gunicorn ("gunicorn app:server")"""
+
+configure_logging()
+
+WARM_UP = start_warm_up()
+"""Background computation of the dashboard's sections, started as soon as the app is imported"""
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
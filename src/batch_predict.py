@@ -0,0 +1,226 @@
+from argparse import ArgumentParser
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import closing
+from os.path import splitext
+from sqlite3 import Connection, connect
+from numpy import asarray, float64
+from pandas import DataFrame, read_csv, read_sql_query
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+from load_data import BATCH_SIZE
+from database import DATABASE, reader
+from model_store import MODEL_DIRECTORY, load_artifact
+from stats_analysis import trained_model
+
+ID_COLUMN: str = "sample"
+"""Column identifying each scored row, copied to the output"""
+
+PREDICTIONS_TABLE: str = "predictions"
+"""Table predictions are written to when the output is a SQLite database"""
+
+SQLITE_EXTENSIONS = [ ".db", ".sqlite", ".sqlite3" ]
+"""Output file extensions treated as SQLite databases; anything else is written as CSV"""
+
+def feature_matrix(data_frame: DataFrame, feature_columns: list[str]) -> DataFrame:
+    """
+    Compute the relative frequency features of every row as one matrix operation
+
+    Args:
+        data_frame (DataFrame): Cell counts, one row per sample
+        feature_columns (list[str]): Cell count columns, in the order the model was trained with
+
+    Returns:
+        DataFrame: Relative frequency (%) of each cell population, named as during training (`<column>_pct`)
+    """
+    counts = asarray(data_frame[feature_columns], dtype = float64)
+    percentages = counts / counts.sum(axis = 1, keepdims = True) * 100
+
+    return DataFrame(percentages, columns = [ f"{column}_pct" for column in feature_columns ], index = data_frame.index)
+
+def score_frame(model: RandomForestClassifier, encoder: LabelEncoder, feature_columns: list[str], data_frame: DataFrame,
+                id_column: str | None = ID_COLUMN) -> DataFrame:
+    """
+    Predict the response of every row of a DataFrame with a single `predict_proba` call
+
+    Args:
+        model (RandomForestClassifier): Trained model
+        encoder (LabelEncoder): Label encoder used during training
+        feature_columns (list[str]): Cell count columns, in the order the model was trained with
+        data_frame (DataFrame): Cell counts, one row per sample
+        id_column (str | None, optional): Column copied to the output, if present; defaults to ID_COLUMN
+
+    Returns:
+        DataFrame: Prediction, confidence, and probabilities (as in `predict_new_sample`) of every row
+    """
+    probabilities = model.predict_proba(feature_matrix(data_frame, feature_columns))
+
+    # The predicted class is the most probable one, as `model.predict` would pick it
+    codes = probabilities.argmax(axis = 1)
+
+    scores = DataFrame(index = data_frame.index)
+    if id_column is not None and id_column in data_frame:
+        scores[id_column] = data_frame[id_column]
+
+    scores["prediction"] = encoder.inverse_transform(model.classes_[codes])
+    scores["confidence"] = (probabilities.max(axis = 1) * 100).round(2)
+    for code, label in enumerate(encoder.classes_):
+        scores[f"probability_{label}"] = (probabilities[:, code] * 100).round(2)
+
+    return scores
+
+def csv_chunks(csv: str, chunk_size: int = BATCH_SIZE) -> Iterator[DataFrame]:
+    """
+    Read a CSV file in chunks
+
+    Args:
+        csv (str): CSV file path
+        chunk_size (int, optional): Number of rows per chunk; defaults to BATCH_SIZE
+
+    Returns:
+        Iterator[DataFrame]: Chunks of the file
+    """
+    with read_csv(csv, chunksize = chunk_size) as reader:
+        yield from reader
+
+def query_chunks(query: str, database: str = DATABASE, chunk_size: int = BATCH_SIZE) -> Iterator[DataFrame]:
+    """
+    Run a query on a database and read its result in chunks
+
+    Args:
+        query (str): SQL query, e.g. selecting rows of the 'samples' table
+        database (str, optional): Name of the SQLite database file; defaults to DATABASE
+        chunk_size (int, optional): Number of rows per chunk; defaults to BATCH_SIZE
+
+    Returns:
+        Iterator[DataFrame]: Chunks of the query result
+    """
+    yield from read_sql_query(query, reader(database), chunksize = chunk_size)
+
+def frame_chunks(data_frame: DataFrame, chunk_size: int = BATCH_SIZE) -> Iterator[DataFrame]:
+    """
+    Split a DataFrame into chunks without copying it
+
+    Args:
+        data_frame (DataFrame): Input DataFrame
+        chunk_size (int, optional): Number of rows per chunk; defaults to BATCH_SIZE
+
+    Returns:
+        Iterator[DataFrame]: Consecutive slices of `data_frame`
+    """
+    for start in range(0, len(data_frame), chunk_size):
+        yield data_frame.iloc[start:start + chunk_size]
+
+def csv_writer(path: str) -> Callable[[DataFrame], None]:
+    """
+    Make a function appending chunks of predictions to a CSV file, which is overwritten by the first chunk
+
+    Args:
+        path (str): Output CSV path
+
+    Returns:
+        Callable[[DataFrame], None]: Chunk writer
+    """
+    first = True
+
+    def write(scores: DataFrame) -> None:
+        nonlocal first
+        scores.to_csv(path, mode = "w" if first else "a", header = first, index = False)
+        first = False
+
+    return write
+
+def sqlite_writer(connection: Connection, table: str = PREDICTIONS_TABLE) -> Callable[[DataFrame], None]:
+    """
+    Make a function appending chunks of predictions to a SQLite table, which is replaced by the first chunk
+
+    Args:
+        connection (Connection): Connection to the output database; it shouldn't be the database being read
+            with `query_chunks`, whose open read would block the writes
+        table (str, optional): Output table; defaults to PREDICTIONS_TABLE
+
+    Returns:
+        Callable[[DataFrame], None]: Chunk writer
+    """
+    first = True
+
+    def write(scores: DataFrame) -> None:
+        nonlocal first
+        scores.to_sql(table, connection, if_exists = "replace" if first else "append", index = False)
+        connection.commit()
+        first = False
+
+    return write
+
+def score_chunks(chunks: Iterable[DataFrame], write: Callable[[DataFrame], None], model: RandomForestClassifier,
+                 encoder: LabelEncoder, feature_columns: list[str], id_column: str | None = ID_COLUMN) -> int:
+    """
+    Score chunks of samples one at a time and hand each chunk's predictions to `write`
+
+    Only one chunk is held in memory at a time, so any number of rows can be scored.
+
+    Args:
+        chunks (Iterable[DataFrame]): Chunks of cell counts (see `csv_chunks`, `query_chunks` and `frame_chunks`)
+        write (Callable[[DataFrame], None]): Function storing a chunk of predictions (see `csv_writer` and `sqlite_writer`)
+        model (RandomForestClassifier): Trained model
+        encoder (LabelEncoder): Label encoder used during training
+        feature_columns (list[str]): Cell count columns, in the order the model was trained with
+        id_column (str | None, optional): Column copied to the output, if present; defaults to ID_COLUMN
+
+    Returns:
+        int: Number of rows scored
+    """
+    rows = 0
+
+    for chunk in chunks:
+        write(score_frame(model, encoder, feature_columns, chunk, id_column))
+        rows += len(chunk)
+
+    return rows
+
+def main(output: str, csv: str | None = None, query: str | None = None, database: str = DATABASE,
+         chunk_size: int = BATCH_SIZE, model_key: str | None = None, model_directory: str = MODEL_DIRECTORY) -> None:
+    """
+    Score every sample of a CSV file or query result and write the predictions to a CSV file or SQLite database
+
+    Args:
+        output (str): Output path; SQLITE_EXTENSIONS are written to the PREDICTIONS_TABLE table, anything else as CSV
+        csv (str | None, optional): CSV file with the samples to score; defaults to None
+        query (str | None, optional): Query selecting the samples to score from `database`, used when `csv` is None;
+            defaults to None
+        database (str, optional): Name of the SQLite database file `query` runs on; defaults to DATABASE
+        chunk_size (int, optional): Number of rows scored at a time; defaults to BATCH_SIZE
+        model_key (str | None, optional): Key of a saved model artifact; defaults to the model trained on the current data
+        model_directory (str, optional): Directory model artifacts are saved to; defaults to MODEL_DIRECTORY
+    """
+    try:
+        if model_key is None:
+            artifact, _ = trained_model(directory = model_directory)
+        elif (artifact := load_artifact(model_key, model_directory)) is None:
+            raise FileNotFoundError(f"No model artifact '{model_key}' in '{model_directory}'")
+
+        chunks = csv_chunks(csv, chunk_size) if csv is not None else query_chunks(query, database, chunk_size)
+
+        if splitext(output)[1].lower() in SQLITE_EXTENSIONS:
+            with closing(connect(output)) as connection:
+                rows = score_chunks(chunks, sqlite_writer(connection), artifact.model, artifact.encoder, artifact.feature_columns)
+        else:
+            rows = score_chunks(chunks, csv_writer(output), artifact.model, artifact.encoder, artifact.feature_columns)
+
+        print(f"Scored {rows} samples with model {artifact.key} into '{output}'")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Predict the treatment response of many samples at once")
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument("--csv", help = "CSV file with the samples to score")
+    source.add_argument("--query", help = "SQL query selecting the samples to score, e.g. \"SELECT * FROM samples\"")
+    parser.add_argument("--output", required = True, help = f"Output CSV file, or SQLite database ({', '.join(SQLITE_EXTENSIONS)})")
+    parser.add_argument("--database", default = DATABASE, help = f"SQLite database path (default: {DATABASE})")
+    parser.add_argument("--chunk-size", type = int, default = BATCH_SIZE, help = f"Rows scored at a time (default: {BATCH_SIZE})")
+    parser.add_argument("--model", help = "Key of a saved model artifact (default: model trained on the current data)")
+    parser.add_argument("--model-directory", default = MODEL_DIRECTORY, help = f"Model artifact directory (default: {MODEL_DIRECTORY})")
+    args = parser.parse_args()
+
+    main(args.output, args.csv, args.query, args.database, args.chunk_size, args.model, args.model_directory)
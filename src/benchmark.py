@@ -0,0 +1,224 @@
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from gzip import decompress
+from json import dump, dumps, loads
+from os import cpu_count, devnull, environ, makedirs, remove
+from os.path import abspath, dirname, exists, getsize, join
+from platform import platform, python_version
+from resource import RUSAGE_SELF, getrusage
+from subprocess import run
+from sys import executable, platform as system
+from time import perf_counter
+from load_data import CSV
+from database import DATABASE, DATABASE_VARIABLE
+
+ROOT: str = dirname(dirname(abspath(__file__)))
+"""Repository root (where app.py lives)"""
+
+SIZES = [ 100_000, 1_000_000, 10_000_000 ]
+"""Dataset sizes (rows) benchmarked by default"""
+
+STAGES = [ "generate", "load", "summary", "stats", "subset", "dashboard" ]
+"""Benchmarked stages, in the order they run"""
+
+BENCHMARK_DIRECTORY: str = "benchmark"
+"""Directory the generated datasets and databases are kept in"""
+
+RESULTS: str = "benchmark.json"
+"""Default results file"""
+
+def peak_rss() -> int:
+    """
+    Get the peak resident set size of this process
+
+    Returns:
+        int: Peak RSS in bytes
+    """
+    # Linux reports kilobytes, macOS bytes
+    return getrusage(RUSAGE_SELF).ru_maxrss * (1 if system == "darwin" else 1024)
+
+def run_stage(stage: str, rows: int, csv: str, mode: str, template: str) -> dict:
+    """
+    Run one stage in this process, which must be started in the benchmark directory (see `benchmark`)
+
+    Args:
+        stage (str): One of STAGES
+        rows (int): Number of rows of the dataset
+        csv (str): Path of the dataset
+        mode (str): `load_data` mode of the "load" stage
+        template (str): CSV file the dataset is modeled on
+
+    Returns:
+        dict: Stage measurements; `seconds` and `peak_rss_bytes`, plus payload sizes for "dashboard"
+    """
+    extra = {}
+    start = perf_counter()
+
+    # The stages' own output would drown the measurements
+    with open(devnull, mode = "w") as sink, redirect_stdout(sink):
+        if stage == "generate":
+            from generate_data import generate_csv
+            generate_csv(rows, csv, template)
+
+        elif stage == "load":
+            from load_data import main as load
+            load(DATABASE, csv, mode)
+
+        elif stage == "summary":
+            from data_analysis import main as summarize
+            summarize(DATABASE)
+
+        elif stage == "stats":
+            from stats_analysis import comparison, comparison_filter, trained_model
+            comparison()
+            comparison_filter()
+            trained_model()
+
+        elif stage == "subset":
+            from subset_analysis import main as subset
+            subset()
+
+        elif stage == "dashboard":
+            from plotly.utils import PlotlyJSONEncoder
+            from app import WARM_UP, app, sections_payload, summary_page
+
+            # Time until the server can answer, then until its warm-up has computed every section
+            extra["startup_seconds"] = round(perf_counter() - start, 3)
+            extra["warm_up_seconds"] = round(WARM_UP.result(), 3)
+
+            # Bytes sent to the browser: the initial layout, its sections once ready, then the first page of the summary grid
+            extra["layout_bytes"] = len(dumps(app.layout, cls = PlotlyJSONEncoder).encode())
+            _, payload = sections_payload()
+            extra["sections_bytes"] = len(decompress(payload))
+            extra["sections_compressed_bytes"] = len(payload)
+            extra["summary_page_bytes"] = len(dumps(summary_page({ "startRow": 0, "endRow": 100 })).encode())
+
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+
+    return { "seconds": round(perf_counter() - start, 3), "peak_rss_bytes": peak_rss(), **extra }
+
+def git_commit() -> str | None:
+    """
+    Get the commit being benchmarked
+
+    Returns:
+        str | None: Commit hash, or None outside of a Git checkout
+    """
+    try:
+        result = run([ "git", "rev-parse", "HEAD" ], cwd = ROOT, capture_output = True, text = True)
+    except OSError:
+        return None
+
+    return result.stdout.strip() or None
+
+def benchmark(sizes: list[int] = SIZES, directory: str = BENCHMARK_DIRECTORY, mode: str = "bulk", template: str = CSV,
+              stages: list[str] = STAGES) -> dict:
+    """
+    Benchmark every stage on synthetic datasets of each size
+
+    Each stage runs in a fresh interpreter in `directory`, where the database lives, so its peak RSS is
+    its own and no cache carries over from a previous stage. Datasets are generated once and reused.
+
+    Args:
+        sizes (list[int], optional): Dataset sizes (rows); defaults to SIZES
+        directory (str, optional): Directory the datasets and databases are kept in; defaults to BENCHMARK_DIRECTORY
+        mode (str, optional): `load_data` mode of the "load" stage; defaults to "bulk"
+        template (str, optional): CSV file the datasets are modeled on; defaults to CSV
+        stages (list[str], optional): Stages to run, in order; defaults to STAGES
+
+    Returns:
+        dict: Environment and per-size, per-stage measurements
+    """
+    directory = abspath(directory)
+    template = abspath(template)
+    makedirs(directory, exist_ok = True)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+        "python": python_version(),
+        "platform": platform(),
+        "cpu_count": cpu_count(),
+        "mode": mode,
+        "results": []
+    }
+
+    for rows in sizes:
+        csv = join(directory, f"synthetic-{rows}.csv")
+        database = join(directory, DATABASE)
+        result = { "rows": rows, "stages": {} }
+
+        # Every size is loaded into a new database (along with its write-ahead log)
+        if "load" in stages:
+            for path in (database, f"{database}-wal", f"{database}-shm"):
+                if exists(path):
+                    remove(path)
+
+        for stage in stages:
+            if stage == "generate" and exists(csv):
+                continue
+
+            process = run(
+                [ executable, abspath(__file__), "--stage", stage, "--rows", str(rows), "--csv", csv, "--mode", mode, "--template", template ],
+                cwd = directory, capture_output = True, text = True, env = { **environ, "PYTHONPATH": f"{join(ROOT, 'src')}:{ROOT}", DATABASE_VARIABLE: database }
+            )
+
+            if process.returncode != 0:
+                result["stages"][stage] = { "error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit code {process.returncode}" }
+                continue
+
+            result["stages"][stage] = loads(process.stdout.strip().splitlines()[-1])
+            print(f"{rows:>12,} rows  {stage:<10} {result['stages'][stage]['seconds']:>10.3f}s  "
+                  f"{result['stages'][stage]['peak_rss_bytes'] / 2 ** 20:>8.1f} MiB peak RSS")
+
+        result["csv_bytes"] = getsize(csv) if exists(csv) else None
+        result["db_bytes"] = getsize(database) if exists(database) else None
+        results["results"].append(result)
+
+    return results
+
+def main(sizes: list[int] = SIZES, directory: str = BENCHMARK_DIRECTORY, output: str = RESULTS, mode: str = "bulk",
+         template: str = CSV, stages: list[str] = STAGES) -> None:
+    """
+    Benchmark every stage and write the results as JSON
+
+    Args:
+        sizes (list[int], optional): Dataset sizes (rows); defaults to SIZES
+        directory (str, optional): Directory the datasets and databases are kept in; defaults to BENCHMARK_DIRECTORY
+        output (str, optional): Results file; defaults to RESULTS
+        mode (str, optional): `load_data` mode of the "load" stage; defaults to "bulk"
+        template (str, optional): CSV file the datasets are modeled on; defaults to CSV
+        stages (list[str], optional): Stages to run, in order; defaults to STAGES
+    """
+    try:
+        results = benchmark(sizes, directory, mode, template, stages)
+
+        with open(output, mode = "w", encoding = "utf-8") as file:
+            dump(results, file, indent = 2)
+
+        print(f"Wrote benchmark results to '{output}'")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Benchmark loading, analysis, and dashboard stages on synthetic datasets")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = SIZES, help = f"Dataset sizes in rows (default: {' '.join(map(str, SIZES))})")
+    parser.add_argument("--directory", default = BENCHMARK_DIRECTORY, help = f"Directory for datasets and databases (default: {BENCHMARK_DIRECTORY})")
+    parser.add_argument("--output", default = RESULTS, help = f"Results file (default: {RESULTS})")
+    parser.add_argument("--mode", default = "bulk", help = "load_data mode of the load stage (default: bulk)")
+    parser.add_argument("--template", default = CSV, help = f"CSV file the datasets are modeled on (default: {CSV})")
+    parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES, help = "Stages to run (default: all)")
+
+    # Internal: run a single stage in this process and print its measurements
+    parser.add_argument("--stage", choices = STAGES, help = "Run a single stage (used by the benchmark itself)")
+    parser.add_argument("--rows", type = int)
+    parser.add_argument("--csv")
+    args = parser.parse_args()
+
+    if args.stage:
+        print(dumps(run_stage(args.stage, args.rows, args.csv, args.mode, args.template)))
+    else:
+        main(args.sizes, args.directory, args.output, args.mode, args.template, args.stages)
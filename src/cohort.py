@@ -0,0 +1,307 @@
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from sqlite3 import Connection, OperationalError
+from pandas import DataFrame, read_sql_query
+from load_data import CELL_TYPES, CUBE_SAMPLE_DIMENSIONS, CUBE_SUBJECT_DIMENSIONS
+from database import DATABASE, reader
+from query_cache import cached_query
+from instrument import span
+
+COLUMNS = {
+    "project": "subj.project",
+    "condition": "subj.condition",
+    "treatment": "subj.treatment",
+    "response": "subj.response",
+    "sex": "subj.sex",
+    "sample_type": "t.sample_type",
+    "time_from_treatment_start": "t.time_from_treatment_start"
+}
+"""Cohort column name -> column qualified with its table alias ('samples' t, 'subjects' subj)"""
+
+SUBJECT_DIMENSIONS = CUBE_SUBJECT_DIMENSIONS
+"""Columns that only depend on the subject; counts of distinct subjects can be added up across their groups"""
+
+FILTERS = [ "condition", "treatment", "sample_type", "time_from_treatment_start", "sex" ]
+"""Columns the dashboard lets users filter cohorts by"""
+
+Value = str | int | tuple[str | int, ...] | None
+"""Filter on one column: None (no filter), a value, or a tuple of allowed values"""
+
+@dataclass(frozen = True)
+class Cohort:
+    """
+    Filter selecting the samples (and their subjects) of a cohort
+
+    Each field restricts the column of the same name; None leaves it unrestricted and a tuple allows
+    any of its values. Cohorts are immutable and hashable, so they can be used as cache keys.
+    """
+    project: Value = None
+    condition: Value = None
+    treatment: Value = None
+    response: Value = None
+    sex: Value = None
+    sample_type: Value = None
+    time_from_treatment_start: Value = None
+
+    def shape(self) -> tuple[tuple[str, int], ...]:
+        """
+        Get the filtered columns and the number of values each allows, which is all the SQL text depends on
+
+        Returns:
+            tuple[tuple[str, int], ...]: (column, number of values; 0 for a single value) of each filtered column
+        """
+        return tuple(
+            (column, len(value) if isinstance(value, tuple) else 0)
+            for column, value in asdict(self).items() if value is not None
+        )
+
+    def parameters(self) -> list[str | int]:
+        """
+        Get the query parameters, in the order of the placeholders in `compile_cohort`
+
+        Returns:
+            list[str | int]: Values of the filtered columns
+        """
+        return [
+            item
+            for value in asdict(self).values() if value is not None
+            for item in (value if isinstance(value, tuple) else (value,))
+        ]
+
+    def samples(self, connection: Connection, columns: tuple[str, ...] = ("sample",)) -> DataFrame:
+        """
+        List the cohort's samples
+
+        Args:
+            connection (Connection): Database connection
+            columns (tuple[str, ...], optional): Columns selected ('sample', 'subject', any column in COLUMNS
+                or any cell population); defaults to the sample IDs only
+
+        Returns:
+            DataFrame: Selected columns of every sample in the cohort
+        """
+        if unknown := set(columns) - { "sample", "subject", *COLUMNS, *CELL_TYPES }:
+            raise ValueError(f"Unknown cohort columns: {sorted(unknown)}")
+
+        return read_sql_query(compile_cohort(self.shape(), f"SELECT {', '.join(columns)} FROM cohort"), connection, params = self.parameters())
+
+    def in_cube(self) -> bool:
+        """
+        Check whether the cohort cube can summarize the cohort, i.e. each of CUBE_SAMPLE_DIMENSIONS is
+        either unfiltered or restricted to a single value (subject columns can be filtered in any way)
+
+        Returns:
+            bool: True if `summarize` can read the cube instead of scanning the samples
+        """
+        return not any(isinstance(getattr(self, column), tuple) for column in CUBE_SAMPLE_DIMENSIONS)
+
+    def summarize(self, connection: Connection) -> DataFrame:
+        """
+        Aggregate the cohort by SUBJECT_DIMENSIONS (see `rollup`)
+
+        When the cohort is `in_cube` and the database has a cohort cube, the result is read from the cube,
+        which takes the same time whatever the number of samples; otherwise the cohort is scanned once.
+
+        Args:
+            connection (Connection): Database connection
+
+        Returns:
+            DataFrame: Number of samples, number of distinct subjects, and sum of each cell population's
+                counts for each combination of SUBJECT_DIMENSIONS values
+        """
+        if self.in_cube() and has_cube(connection):
+            return read_sql_query(compile_cube(self.shape()), connection, params = self.parameters())
+
+        return read_sql_query(compile_cohort(self.shape(), SUMMARIZE), connection, params = self.parameters())
+
+    def frequencies(self, connection: Connection) -> DataFrame:
+        """
+        Get the cell population relative frequencies of the cohort's samples from subjects with a response
+
+        Args:
+            connection (Connection): Database connection
+
+        Returns:
+            DataFrame: Population, percentage, response, and subject of every matching sample
+        """
+        return read_sql_query(compile_cohort(self.shape(), FREQUENCIES), connection, params = self.parameters())
+
+SUMMARIZE: str = f"""
+    SELECT {', '.join(SUBJECT_DIMENSIONS)},
+        COUNT(*) AS samples,
+        COUNT(DISTINCT subject) AS subjects,
+        {', '.join(f'SUM({cell_type}) AS {cell_type}' for cell_type in CELL_TYPES)}
+    FROM cohort
+    GROUP BY {', '.join(SUBJECT_DIMENSIONS)}
+"""
+"""Query aggregating a cohort by SUBJECT_DIMENSIONS"""
+
+FREQUENCIES: str = """
+    SELECT s.population, s.percentage, c.response, c.subject
+    FROM cohort c
+    JOIN summary s ON s.sample = c.sample
+    WHERE c.response IN ('yes', 'no')
+"""
+"""Query selecting the 'summary' table rows of a cohort's samples from subjects with a response"""
+
+@lru_cache(maxsize = 128)
+def compile_cohort(shape: tuple[tuple[str, int], ...], query: str) -> str:
+    """
+    Compile a query on a cohort into SQL, defining the cohort as a parameterized CTE named 'cohort'
+
+    The SQL only depends on which columns are filtered (not on their values), so it is compiled once
+    per shape and, being identical text, its prepared statement is reused by SQLite's statement cache.
+
+    Args:
+        shape (tuple[tuple[str, int], ...]): Output of `Cohort.shape`
+        query (str): Query selecting from 'cohort'
+
+    Returns:
+        str: SQL statement taking `Cohort.parameters` as parameters
+    """
+    predicates = [
+        f"{COLUMNS[column]} IN ({', '.join('?' for _ in range(arity))})" if arity else f"{COLUMNS[column]} = ?"
+        for column, arity in shape
+    ]
+
+    return f"""
+        WITH cohort AS (
+            SELECT t.sample, t.subject, {', '.join(f'{qualified} AS {column}' for column, qualified in COLUMNS.items())},
+                {', '.join(f't.{cell_type}' for cell_type in CELL_TYPES)}
+            FROM samples t
+            JOIN subjects subj ON t.subject = subj.subject
+            {'WHERE ' + ' AND '.join(predicates) if predicates else ''}
+        )
+        {query}
+    """
+
+@lru_cache(maxsize = 128)
+def compile_cube(shape: tuple[tuple[str, int], ...]) -> str:
+    """
+    Compile `Cohort.summarize` into a query on the cohort cube
+
+    For each of CUBE_SAMPLE_DIMENSIONS, the cube rows grouped by it are used if it is filtered, and the rows
+    aggregated over it otherwise, so every distinct subject count is read as is and never added up across
+    sample types or time points. Rows of different subject column values do add up, as they share no subject.
+
+    Args:
+        shape (tuple[tuple[str, int], ...]): Output of `Cohort.shape`, for a cohort that is `in_cube`
+
+    Returns:
+        str: SQL statement taking `Cohort.parameters` as parameters
+    """
+    filtered = { column for column, _ in shape }
+    predicates = [ f"all_{column} = {int(column not in filtered)}" for column in CUBE_SAMPLE_DIMENSIONS ] + [
+        f"{column} IN ({', '.join('?' for _ in range(arity))})" if arity else f"{column} = ?"
+        for column, arity in shape
+    ]
+
+    return f"""
+        SELECT {', '.join(SUBJECT_DIMENSIONS)},
+            SUM(samples) AS samples,
+            SUM(subjects) AS subjects,
+            {', '.join(f'SUM({cell_type}) AS {cell_type}' for cell_type in CELL_TYPES)}
+        FROM cohort_cube
+        WHERE {' AND '.join(predicates)}
+        GROUP BY {', '.join(SUBJECT_DIMENSIONS)}
+    """
+
+def has_cube(connection: Connection) -> bool:
+    """
+    Check whether the database has a populated cohort cube (see `load_data.populate_cohort_cube`)
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        bool: False for databases loaded before the cube existed, or whose cube is empty
+    """
+    try:
+        return bool(connection.execute("SELECT EXISTS (SELECT 1 FROM cohort_cube)").fetchone()[0])
+    except OperationalError:
+        return False
+
+def rollup(summary: DataFrame, by: list[str]) -> DataFrame:
+    """
+    Aggregate the output of `Cohort.summarize` further, by any of SUBJECT_DIMENSIONS
+
+    Distinct subject counts stay exact, since a subject belongs to one group of SUBJECT_DIMENSIONS only.
+
+    Args:
+        summary (DataFrame): Output of `Cohort.summarize`
+        by (list[str]): Columns to group by; an empty list aggregates the whole cohort
+
+    Returns:
+        DataFrame: Number of samples, number of distinct subjects, and mean count of each cell population per group
+    """
+    columns = [ "samples", "subjects", *CELL_TYPES ]
+    totals = summary.groupby(by, dropna = False)[columns].sum().reset_index() if by else DataFrame([ summary[columns].sum() ])
+
+    for cell_type in CELL_TYPES:
+        totals[cell_type] = totals[cell_type] / totals["samples"]
+
+    return totals
+
+@cached_query()
+def cohort_summary(cohort: Cohort) -> DataFrame:
+    """
+    Cached `Cohort.summarize`, read with this thread's connection to the database
+
+    Args:
+        cohort (Cohort): Cohort
+
+    Returns:
+        DataFrame: Output of `Cohort.summarize`
+    """
+    with span("query"):
+        return cohort.summarize(reader(DATABASE))
+
+@cached_query()
+def cohort_samples(cohort: Cohort, columns: tuple[str, ...] = ("sample",)) -> DataFrame:
+    """
+    Cached `Cohort.samples`, read with this thread's connection to the database
+
+    Args:
+        cohort (Cohort): Cohort
+        columns (tuple[str, ...], optional): Columns selected; defaults to the sample IDs only
+
+    Returns:
+        DataFrame: Output of `Cohort.samples`
+    """
+    with span("query"):
+        return cohort.samples(reader(DATABASE), columns)
+
+@cached_query()
+def cohort_frequencies(cohort: Cohort) -> DataFrame:
+    """
+    Cached `Cohort.frequencies`, read with this thread's connection to the database
+
+    Args:
+        cohort (Cohort): Cohort
+
+    Returns:
+        DataFrame: Output of `Cohort.frequencies`
+    """
+    with span("query"):
+        return cohort.frequencies(reader(DATABASE))
+
+@cached_query()
+def cohort_options() -> dict[str, list[str | int]]:
+    """
+    Get the values each column in FILTERS can be filtered by
+
+    Returns:
+        dict[str, list[str | int]]: Column -> sorted distinct non-NULL values
+    """
+    connection = reader(DATABASE)
+
+    # The cube's most detailed rows hold every combination of values, in far fewer rows than the samples
+    if has_cube(connection):
+        query = f"SELECT DISTINCT {{column}} FROM cohort_cube WHERE {' AND '.join(f'all_{column} = 0' for column in CUBE_SAMPLE_DIMENSIONS)} AND {{column}} IS NOT NULL ORDER BY 1"
+    else:
+        query = compile_cohort((), "SELECT DISTINCT {column} FROM cohort WHERE {column} IS NOT NULL ORDER BY 1")
+
+    return {
+        column: [ value for value, in connection.execute(query.format(column = column)) ]
+        for column in FILTERS
+    }
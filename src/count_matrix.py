@@ -0,0 +1,347 @@
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from json import dump, load
+from os import makedirs, remove, replace
+from os.path import exists, join
+from sqlite3 import Connection
+from numpy import dtype, empty, fromiter, int32, load as load_array, min_scalar_type, ndarray
+from numpy.lib.format import open_memmap
+from pandas import Categorical, DataFrame, Index
+from load_data import BATCH_SIZE, CELL_TYPES
+from database import DATABASE, content_version, read_transaction, reader
+
+MATRIX_DIRECTORY: str = "count_matrix"
+"""Directory the count matrix is exported to"""
+
+CATEGORICAL_COLUMNS = [ "subject", "project", "condition", "sex", "treatment", "response", "sample_type" ]
+"""Sample metadata columns stored as integer codes into a sorted list of categories"""
+
+NUMERIC_COLUMNS = [ "age", "time_from_treatment_start" ]
+"""Sample metadata columns stored as int32 values"""
+
+MISSING: int = -1
+"""Code or value stored in place of NULL"""
+
+MANIFEST: str = "manifest.json"
+"""Name of the file describing an exported count matrix; written last, once all arrays are complete"""
+
+QUALIFIED = {
+    "subject": "t.subject",
+    "project": "subj.project",
+    "condition": "subj.condition",
+    "sex": "subj.sex",
+    "treatment": "subj.treatment",
+    "response": "subj.response",
+    "sample_type": "t.sample_type",
+    "age": "subj.age",
+    "time_from_treatment_start": "t.time_from_treatment_start"
+}
+"""Metadata column name -> column qualified with its table alias ('samples' t, 'subjects' subj)"""
+
+@dataclass(frozen = True)
+class CountMatrix:
+    """
+    Cell counts of every sample as a samples x CELL_TYPES int32 matrix, along with encoded sample metadata
+
+    Row `i` of every array refers to the same sample. Arrays are memory-mapped by `load_count_matrix`,
+    so opening a matrix reads nothing up front and processes mapping the same files share their pages.
+    """
+    samples: ndarray
+    """Sample IDs"""
+
+    counts: ndarray
+    """Cell counts; one column per cell population in `cell_types` order"""
+
+    cell_types: list[str]
+    """Cell population of each column of `counts`"""
+
+    codes: dict[str, ndarray]
+    """Categorical column name -> codes into `categories[column]` (MISSING for NULL)"""
+
+    categories: dict[str, list[str]]
+    """Categorical column name -> sorted distinct values"""
+
+    values: dict[str, ndarray]
+    """Numeric column name -> values (MISSING for NULL)"""
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def decode(self, column: str) -> Categorical:
+        """
+        Decode a categorical column without copying its codes
+
+        Args:
+            column (str): Name of a column in CATEGORICAL_COLUMNS
+
+        Returns:
+            Categorical: Column values (NaN for NULL)
+        """
+        return Categorical.from_codes(self.codes[column], categories = self.categories[column])
+
+    def frame(self) -> DataFrame:
+        """
+        Build a DataFrame with one row per sample, holding its metadata and cell counts
+
+        Returns:
+            DataFrame: Samples with categorical metadata columns and int32 count columns
+        """
+        data_frame = DataFrame({ "sample": self.samples })
+
+        for column in CATEGORICAL_COLUMNS:
+            data_frame[column] = self.decode(column)
+
+        for column in NUMERIC_COLUMNS:
+            data_frame[column] = self.values[column]
+
+        for index, cell_type in enumerate(self.cell_types):
+            data_frame[cell_type] = self.counts[:, index]
+
+        return data_frame
+
+def matrix_categories(connection: Connection) -> dict[str, list[str]]:
+    """
+    Get the sorted distinct values of each categorical column, which its codes index
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        dict[str, list[str]]: Column in CATEGORICAL_COLUMNS -> sorted distinct non-NULL values
+    """
+    return {
+        column: [ value for value, in connection.execute(f"""
+            SELECT DISTINCT {QUALIFIED[column]}
+            FROM samples t
+            JOIN subjects subj ON t.subject = subj.subject
+            WHERE {QUALIFIED[column]} IS NOT NULL
+            ORDER BY 1
+        """) ]
+        for column in CATEGORICAL_COLUMNS
+    }
+
+def matrix_size(connection: Connection) -> tuple[int, int]:
+    """
+    Count the samples `fill_count_matrix` reads (those with a subject) and the length of the longest sample ID
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        tuple[int, int]: Number of samples and maximum sample ID length (at least 1)
+    """
+    rows, sample_length = connection.execute("""
+        SELECT COUNT(*), MAX(LENGTH(t.sample))
+        FROM samples t
+        JOIN subjects subj ON t.subject = subj.subject
+    """).fetchone()
+
+    return rows, sample_length or 1
+
+def fill_count_matrix(connection: Connection, matrix: CountMatrix, chunk_size: int = BATCH_SIZE) -> None:
+    """
+    Stream every sample, ordered by sample ID, into the preallocated arrays of a count matrix
+
+    Must run in the same read transaction as the `matrix_size` call the arrays were sized with, so both
+    see the same samples.
+
+    Args:
+        connection (Connection): Database connection
+        matrix (CountMatrix): Matrix with arrays of the right length and final `categories`, filled in place
+        chunk_size (int, optional): Number of samples fetched at a time; defaults to BATCH_SIZE
+
+    Raises:
+        RuntimeError: If the query returned a different number of samples than the arrays hold
+    """
+    indexes = { column: Index(values) for column, values in matrix.categories.items() }
+
+    cursor = connection.execute(f"""
+        SELECT t.sample, {', '.join(QUALIFIED[column] for column in CATEGORICAL_COLUMNS + NUMERIC_COLUMNS)}, {', '.join(f't.{cell_type}' for cell_type in CELL_TYPES)}
+        FROM samples t
+        JOIN subjects subj ON t.subject = subj.subject
+        ORDER BY t.sample
+    """)
+
+    start = 0
+    while chunk := cursor.fetchmany(chunk_size):
+        end = start + len(chunk)
+        columns = list(zip(*chunk))
+
+        matrix.samples[start:end] = columns[0]
+
+        # Values are coded in bulk; NULL and unknown values get code -1, i.e. MISSING
+        for index, column in enumerate(CATEGORICAL_COLUMNS, start = 1):
+            matrix.codes[column][start:end] = indexes[column].get_indexer(columns[index])
+
+        for index, column in enumerate(NUMERIC_COLUMNS, start = 1 + len(CATEGORICAL_COLUMNS)):
+            matrix.values[column][start:end] = fromiter((MISSING if value is None else value for value in columns[index]), dtype = int32, count = len(chunk))
+
+        matrix.counts[start:end] = [ row[-len(CELL_TYPES):] for row in chunk ]
+
+        start = end
+
+    # Rows left unfilled would hold uninitialized memory
+    if start != len(matrix):
+        raise RuntimeError(f"Read {start} samples into a count matrix of {len(matrix)} rows")
+
+def read_count_matrix(connection: Connection, chunk_size: int = BATCH_SIZE) -> CountMatrix:
+    """
+    Read the 'samples' and 'subjects' tables into an in-memory count matrix (see `CountMatrix`)
+
+    Args:
+        connection (Connection): Database connection
+        chunk_size (int, optional): Number of samples fetched at a time; defaults to BATCH_SIZE
+
+    Returns:
+        CountMatrix: Count matrix held in memory
+    """
+    # Sized, coded, and filled from one snapshot, so a concurrent commit can't leave rows unfilled
+    with read_transaction(connection):
+        rows, sample_length = matrix_size(connection)
+        categories = matrix_categories(connection)
+
+        matrix = CountMatrix(
+            samples = empty(rows, dtype = dtype(f"U{sample_length}")),
+            counts = empty((rows, len(CELL_TYPES)), dtype = int32),
+            cell_types = CELL_TYPES,
+            codes = { column: empty(rows, dtype = min_scalar_type(-max(len(values), 1))) for column, values in categories.items() },
+            categories = categories,
+            values = { column: empty(rows, dtype = int32) for column in NUMERIC_COLUMNS }
+        )
+        fill_count_matrix(connection, matrix, chunk_size)
+
+    return matrix
+
+def export_count_matrix(connection: Connection, directory: str = MATRIX_DIRECTORY, chunk_size: int = BATCH_SIZE,
+                        database: str = DATABASE) -> int:
+    """
+    Export the 'samples' and 'subjects' tables to memory-mappable .npy files (see `CountMatrix`)
+
+    Rows are streamed from the database in chunks of `chunk_size` straight into the memory-mapped
+    output files, so memory use does not depend on the number of samples. The manifest records the
+    database's `content_version`, which tells `current_count_matrix` whether the export is up to date.
+
+    Args:
+        connection (Connection): Database connection
+        directory (str, optional): Output directory; defaults to MATRIX_DIRECTORY
+        chunk_size (int, optional): Number of samples fetched at a time; defaults to BATCH_SIZE
+        database (str, optional): Path of the database `connection` reads; defaults to DATABASE
+
+    Returns:
+        int: Number of samples exported
+    """
+    makedirs(directory, exist_ok = True)
+
+    # Arrays are overwritten in place, so a previous export stops being valid right away
+    if exists(join(directory, MANIFEST)):
+        remove(join(directory, MANIFEST))
+
+    version = content_version(database)
+
+    # Sized, coded, and filled from one snapshot, so a concurrent commit can't leave rows unfilled
+    with read_transaction(connection):
+        rows, sample_length = matrix_size(connection)
+
+        # Sorted distinct values of each categorical column, whose count decides the smallest code type
+        categories = matrix_categories(connection)
+
+        matrix = CountMatrix(
+            samples = open_memmap(join(directory, "samples.npy"), mode = "w+", dtype = dtype(f"U{sample_length}"), shape = (rows,)),
+            counts = open_memmap(join(directory, "counts.npy"), mode = "w+", dtype = int32, shape = (rows, len(CELL_TYPES))),
+            cell_types = CELL_TYPES,
+            codes = {
+                column: open_memmap(join(directory, f"{column}.npy"), mode = "w+", shape = (rows,),
+                                    dtype = min_scalar_type(-max(len(values), 1)))
+                for column, values in categories.items()
+            },
+            categories = categories,
+            values = { column: open_memmap(join(directory, f"{column}.npy"), mode = "w+", dtype = int32, shape = (rows,)) for column in NUMERIC_COLUMNS }
+        )
+        fill_count_matrix(connection, matrix, chunk_size)
+
+    for array in (matrix.samples, matrix.counts, *matrix.codes.values(), *matrix.values.values()):
+        array.flush()
+
+    # Data committed during the export may or may not be in it, so it is never taken as current
+    if content_version(database) != version:
+        version = None
+
+    # The manifest is written last and renamed into place atomically, so readers never open a partially written matrix
+    with open(join(directory, f"{MANIFEST}.tmp"), mode = "w", encoding = "utf-8") as file:
+        dump({ "rows": rows, "cell_types": CELL_TYPES, "categories": categories, "version": version }, file)
+    replace(join(directory, f"{MANIFEST}.tmp"), join(directory, MANIFEST))
+
+    return rows
+
+def load_count_matrix(directory: str = MATRIX_DIRECTORY, mmap_mode: str | None = "r") -> CountMatrix:
+    """
+    Open a count matrix exported by `export_count_matrix`
+
+    Args:
+        directory (str, optional): Directory the matrix was exported to; defaults to MATRIX_DIRECTORY
+        mmap_mode (str | None, optional): Memory-map mode passed to `numpy.load`; None reads the arrays
+            into memory instead; defaults to "r" (read-only, zero-copy)
+
+    Returns:
+        CountMatrix: Count matrix backed by the files in `directory`
+    """
+    with open(join(directory, MANIFEST), mode = "r", encoding = "utf-8") as file:
+        manifest = load(file)
+
+    def array(name: str) -> ndarray:
+        return load_array(join(directory, f"{name}.npy"), mmap_mode = mmap_mode)
+
+    return CountMatrix(
+        samples = array("samples"),
+        counts = array("counts"),
+        cell_types = manifest["cell_types"],
+        codes = { column: array(column) for column in CATEGORICAL_COLUMNS },
+        categories = manifest["categories"],
+        values = { column: array(column) for column in NUMERIC_COLUMNS }
+    )
+
+def current_count_matrix(directory: str = MATRIX_DIRECTORY, database: str = DATABASE) -> CountMatrix | None:
+    """
+    Open the exported count matrix if it holds the database's current contents
+
+    Args:
+        directory (str, optional): Directory the matrix was exported to; defaults to MATRIX_DIRECTORY
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Returns:
+        CountMatrix | None: Memory-mapped count matrix, or None if there is no complete export or the
+            database changed since it was written
+    """
+    try:
+        with open(join(directory, MANIFEST), mode = "r", encoding = "utf-8") as file:
+            version = load(file).get("version")
+    except FileNotFoundError:
+        return None
+
+    if version is None or version != content_version(database):
+        return None
+
+    return load_count_matrix(directory)
+
+def main(database: str = DATABASE, directory: str = MATRIX_DIRECTORY) -> None:
+    """
+    Export the cell counts and sample metadata in the database to a memory-mappable count matrix
+
+    Args:
+        database (str, optional): Name of the SQLite database file; defaults to DATABASE
+        directory (str, optional): Output directory; defaults to MATRIX_DIRECTORY
+    """
+    try:
+        rows = export_count_matrix(reader(database), directory, database = database)
+        print(f"Exported {rows} samples from '{database}' to '{directory}'")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Export the cell counts to memory-mappable .npy files")
+    parser.add_argument("--database", default = DATABASE, help = f"SQLite database path (default: {DATABASE})")
+    parser.add_argument("--directory", default = MATRIX_DIRECTORY, help = f"Output directory (default: {MATRIX_DIRECTORY})")
+    args = parser.parse_args()
+
+    main(args.database, args.directory)
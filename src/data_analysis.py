@@ -1,88 +1,323 @@
-from sqlite3 import Connection, connect
-from uuid import uuid4
-from load_data import CELL_TYPES, DATABASE
+from argparse import ArgumentParser
+from sqlite3 import Connection, Cursor
+from load_data import CELL_TYPES, CREATE_LONGITUDINAL, CREATE_SUMMARY
+from instrument import count, logger, run, span
+from database import DATABASE, writer
+
+INSERT_SUMMARY: str = f"""
+    INSERT INTO summary (sample, population, total_count, count, percentage)
+    SELECT
+        sample,
+        population,
+        total_count,
+        count,
+        CASE WHEN total_count > 0 THEN (CAST(count AS REAL) / total_count) * 100 ELSE 0 END
+    FROM (
+        SELECT
+            t.sample,
+            p.population,
+            p.position,
+            {' + '.join(f't.{cell_type}' for cell_type in CELL_TYPES)} AS total_count,
+            CASE p.population {' '.join(f"WHEN '{cell_type}' THEN t.{cell_type}" for cell_type in CELL_TYPES)} END AS count
+        FROM samples t
+        CROSS JOIN ({' UNION ALL '.join(f"SELECT '{cell_type}' AS population, {position} AS position" for position, cell_type in enumerate(CELL_TYPES))}) p
+        {{where}}
+    )
+    ORDER BY sample, position
+"""
+"""Statement computing and inserting the 'summary' table rows of all samples matching `{where}`,
+unpivoting the cell population columns of 'samples' in a single pass, in CELL_TYPES order within each sample"""
+
+SUMMARY_INDEXES = {
+    "idx_summary_population_percentage": "summary(population, percentage)",
+    "idx_summary_percentage": "summary(percentage)"
+}
+"""Secondary indexes (name -> table and columns) serving the dashboard's sorted and filtered pages of the 'summary' table"""
+
+INSERT_LONGITUDINAL: str = """
+    INSERT INTO longitudinal (
+        sample, population, subject, sample_type, time_from_treatment_start, count, percentage,
+        baseline_count, baseline_percentage, count_change, percentage_change,
+        count_fold_change, percentage_fold_change, percentage_step
+    )
+    SELECT
+        sample,
+        population,
+        subject,
+        sample_type,
+        time_from_treatment_start,
+        count,
+        percentage,
+        baseline_count,
+        baseline_percentage,
+        count - baseline_count,
+        percentage - baseline_percentage,
+        CASE WHEN baseline_count > 0 THEN count / baseline_count END,
+        CASE WHEN baseline_percentage > 0 THEN percentage / baseline_percentage END,
+        percentage - previous_percentage
+    FROM (
+        SELECT
+            s.sample,
+            s.population,
+            t.subject,
+            t.sample_type,
+            t.time_from_treatment_start,
+            s.count,
+            s.percentage,
+            AVG(CASE WHEN t.time_from_treatment_start = 0 THEN s.count END) OVER trajectory AS baseline_count,
+            AVG(CASE WHEN t.time_from_treatment_start = 0 THEN s.percentage END) OVER trajectory AS baseline_percentage,
+            LAG(s.percentage) OVER (trajectory ORDER BY t.time_from_treatment_start, s.sample) AS previous_percentage
+        FROM summary s
+        JOIN samples t ON s.sample = t.sample
+        WHERE t.time_from_treatment_start IS NOT NULL
+        {where}
+        WINDOW trajectory AS (PARTITION BY t.subject, t.sample_type, s.population)
+    )
+"""
+"""Statement computing and inserting the 'longitudinal' table rows of all subjects matching `{where}` in a single pass:
+each (subject, sample type, population) trajectory is a window, whose time 0 rows (averaged if several) are the baseline"""
+
+LONGITUDINAL_INDEXES = {
+    "idx_longitudinal_trajectory": "longitudinal(subject, sample_type, population, time_from_treatment_start)",
+    "idx_longitudinal_population_time": "longitudinal(population, time_from_treatment_start)"
+}
+"""Secondary indexes (name -> table and columns) serving per-subject trajectories and per-time point comparisons"""
+
+PENDING_SUBJECTS: str = """
+    SELECT subject FROM samples WHERE sample IN (SELECT sample FROM summary_pending)
+    UNION
+    SELECT subject FROM longitudinal WHERE sample IN (SELECT sample FROM summary_pending)
+"""
+"""Query selecting the subjects with a sample queued in 'summary_pending', before or after the incremental load;
+must run before their longitudinal rows are deleted, which is where a moved sample's previous subject is found"""
+
+def insert_summary_rows(cursor: Cursor, where: str = "") -> int:
+    """
+    Compute and insert the 'summary' table rows of the given samples in one statement
+
+    Args:
+        cursor (Cursor): Database cursor
+        where (str, optional): WHERE clause on 'samples' (aliased 't') selecting the samples; defaults to all samples
+
+    Returns:
+        int: Number of rows inserted
+    """
+    cursor.execute(INSERT_SUMMARY.format(where = where))
+    return cursor.rowcount
 
 def populate_summary_table(connection: Connection) -> None:
     """
     Populate summary table with the following for each sample (i.e. row):
-        - id: Unique ID for each row
         - sample: Sample ID (i.e. 'sample' column in .csv)
-        - total_count: Sample's total cell count (i.e. sum of all cell population counts for that sample)
         - population: Immune cell population's name (e.g. b_cell, cd8_t_cell, etc.)
+        - total_count: Sample's total cell count (i.e. sum of all cell population counts for that sample)
         - count: Cell count
         - percentage: Relative frquency of the cell population (in percentage)
 
+    Each row is identified by its (sample, population) pair. The table is recreated from scratch,
+    so it can be rebuilt without creating duplicates, and a table with an older schema is replaced.
+    The rebuild is a single transaction, so readers see the previous table until it commits.
+
     Args:
         connection (Connection): Database connection
     """
     cursor = connection.cursor()
 
-    print("Fetching sample data")
-    sample_data = cursor.execute(f"SELECT sample, {', '.join(CELL_TYPES)} FROM samples").fetchall()
-
-    # Loop over each sample
-    for sample in sample_data:
-        # Get sample ID and cell population counts from current sample
-        sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte = sample
-
-        cell_columns = [ b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte ]
-
-        # Calculate total cell count for current sample
-        total_count = sum(cell_columns)
-        print(f"Total count for sample '{sample_id}': {total_count}")
-
-        # Loop over each cell population in sample
-        for population, count in zip(CELL_TYPES, cell_columns):
-            # Calculate relative frequency of current cell population in sample
-            frequency = (count / total_count) * 100 if total_count > 0 else 0
-            
-            print(f"Processing '{population}' in sample '{sample_id}' with count {count} and frequency {frequency:.2f}%")
-
-            # Insert a row into summary table with the following column values:
-            # 1. Row's unique ID
-            # 2. Sample ID
-            # 3. Sample's total count
-            # 4. Cell population name
-            # 5. Cell count for population
-            # 6. Relative frequency of cell population in sample
-            cursor.execute(f"""
-                INSERT INTO summary
-                (id, sample, total_count, population, count, percentage)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                    str(uuid4()),
-                    sample_id,
-                    total_count,
-                    population,
-                    count,
-                    frequency
-                )
-            )
-            print(f"Inserted sample '{sample_id}' into 'summary' table")
+    # DDL statements don't open a transaction on their own, so the table would briefly be missing
+    if not connection.in_transaction:
+        cursor.execute("BEGIN")
+
+    # Every sample is rebuilt, so nothing is left pending from incremental loads
+    cursor.execute("DROP TABLE IF EXISTS summary")
+    cursor.execute(CREATE_SUMMARY)
+    cursor.execute("DELETE FROM summary_pending")
+
+    rows = insert_summary_rows(cursor)
+
+    # Indexes are built once the rows are in, which is faster than maintaining them row by row
+    for name, columns in SUMMARY_INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+
+    connection.commit()
+
+    count("summary_rows", rows)
+    logger.info("Finished populating 'summary' table with %d rows", rows)
+
+def insert_longitudinal_rows(cursor: Cursor, where: str = "") -> int:
+    """
+    Compute and insert the 'longitudinal' table rows of the given subjects in one statement
+
+    Args:
+        cursor (Cursor): Database cursor
+        where (str, optional): Condition on 'samples' (aliased 't') starting with AND, selecting the subjects;
+            defaults to all subjects
+
+    Returns:
+        int: Number of rows inserted
+    """
+    cursor.execute(INSERT_LONGITUDINAL.format(where = where))
+    return cursor.rowcount
+
+def populate_longitudinal_table(connection: Connection) -> None:
+    """
+    Populate longitudinal table from the summary table, with the following for each sample and cell population:
+        - subject, sample_type, time_from_treatment_start: Where the sample lies on its subject's trajectory
+        - count, percentage: Cell count and relative frequency (as in the summary table)
+        - baseline_count, baseline_percentage: Same values for the subject's time 0 sample of the same type
+        - count_change, percentage_change: Difference from the baseline
+        - count_fold_change, percentage_fold_change: Ratio to the baseline (NULL if the baseline is missing or 0)
+        - percentage_step: Difference from the subject's previous time point (NULL at the first one)
+
+    Like the summary table, the table is recreated from scratch in a single transaction.
+
+    Args:
+        connection (Connection): Database connection
+    """
+    cursor = connection.cursor()
+
+    if not connection.in_transaction:
+        cursor.execute("BEGIN")
+
+    cursor.execute("DROP TABLE IF EXISTS longitudinal")
+    cursor.execute(CREATE_LONGITUDINAL)
+
+    rows = insert_longitudinal_rows(cursor)
+
+    for name, columns in LONGITUDINAL_INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
 
     connection.commit()
 
-    print(f"Finished populating 'summary' table")
+    count("longitudinal_rows", rows)
+    logger.info("Finished populating 'longitudinal' table with %d rows", rows)
 
-def main(database: str = DATABASE) -> None:
+def refresh_summary_table(connection: Connection) -> int:
+    """
+    Recompute the summary table rows of the samples queued in 'summary_pending' by an incremental load
+    (see `load_data.load_csv_incremental`), and the longitudinal table rows of their subjects, leaving
+    every other sample's and subject's rows untouched
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        int: Number of samples recomputed
+    """
+    cursor = connection.cursor()
+
+    cursor.execute("DELETE FROM summary WHERE sample IN (SELECT sample FROM summary_pending)")
+    rows = insert_summary_rows(cursor, "WHERE t.sample IN (SELECT sample FROM summary_pending)")
+
+    # Patching only the changed subjects would leave out every other subject if the table was never built
+    built = cursor.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'longitudinal')").fetchone()[0] \
+        and cursor.execute("SELECT EXISTS(SELECT 1 FROM longitudinal)").fetchone()[0]
+
+    if built:
+        # Subjects are collected once: after the delete, a sample moved to another subject no longer leads to its previous one
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS pending_subjects (subject TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM pending_subjects")
+        cursor.execute(f"INSERT OR IGNORE INTO pending_subjects {PENDING_SUBJECTS}")
+
+        # A changed sample can move its subject's baseline, so whole trajectories are recomputed
+        cursor.execute("DELETE FROM longitudinal WHERE subject IN (SELECT subject FROM pending_subjects)")
+        trajectories = insert_longitudinal_rows(cursor, "AND t.subject IN (SELECT subject FROM pending_subjects)")
+        count("longitudinal_rows", trajectories)
+
+    cursor.execute("DELETE FROM summary_pending")
+
+    if built:
+        connection.commit()
+    else:
+        # Rebuilt from the refreshed summary in the same transaction, which it commits
+        populate_longitudinal_table(connection)
+
+    samples = rows // len(CELL_TYPES)
+    count("summary_rows", rows)
+    logger.info("Refreshed 'summary' table for %d changed sample(s) and 'longitudinal' table for their subjects", samples)
+
+    return samples
+
+def verify_tables(connection: Connection) -> dict[str, int]:
+    """
+    Compare the summary and longitudinal tables with a full rebuild, e.g. after `refresh_summary_table`,
+    without changing them: the rebuild runs in a savepoint that is rolled back
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        dict[str, int]: Table name -> number of rows missing from it or not in the rebuild (0 if identical)
+    """
+    cursor = connection.cursor()
+    differences = {}
+
+    cursor.execute("SAVEPOINT verify_tables")
+
+    try:
+        # Summary first, since the longitudinal rows are computed from it
+        for table, insert_rows in (("summary", insert_summary_rows), ("longitudinal", insert_longitudinal_rows)):
+            cursor.execute(f"CREATE TEMP TABLE current_{table} AS SELECT * FROM {table}")
+            cursor.execute(f"DELETE FROM {table}")
+            insert_rows(cursor)
+
+            differences[table] = cursor.execute(f"""
+                SELECT COUNT(*) FROM (
+                    SELECT * FROM (SELECT * FROM {table} EXCEPT SELECT * FROM current_{table})
+                    UNION ALL
+                    SELECT * FROM (SELECT * FROM current_{table} EXCEPT SELECT * FROM {table})
+                )
+            """).fetchone()[0]
+
+    finally:
+        cursor.execute("ROLLBACK TO verify_tables")
+        cursor.execute("RELEASE verify_tables")
+
+    return differences
+
+def main(database: str = DATABASE, incremental: bool = False, verify: bool = False) -> None:
     """
     Main function for Part 2: Initial Analysis - Data Overview
         1. Create summary table in database
         2. Populate summary table in database
+        3. Populate longitudinal table (changes from baseline) in database
 
     Args:
         database (str, optional): Name of the SQLite database file; defaults to DATABASE
+        incremental (bool, optional): Only recompute the samples changed by the last incremental load; defaults to False
+        verify (bool, optional): Check that the tables equal a full rebuild afterwards; defaults to False
     """
-    try:
-        with connect(database) as connection:
-            populate_summary_table(connection)
-            print(f"Populated 'summary' table in '{database}'")
+    with run("data_analysis"):
+        try:
+            with writer(database) as connection:
+                with span("summarize"):
+                    if incremental:
+                        refresh_summary_table(connection)
+                    else:
+                        populate_summary_table(connection)
 
-    except Exception as e:
-        print(f"An error occurred in main: {e}")
+                if not incremental:
+                    with span("longitudinal"):
+                        populate_longitudinal_table(connection)
 
-    finally:
-        connection.close()
+                logger.info("Populated 'summary' table in '%s'", database)
+
+                if verify:
+                    with span("verify"):
+                        differences = verify_tables(connection)
+
+                    if any(differences.values()):
+                        logger.error("Tables differ from a full rebuild: %s", differences)
+                    else:
+                        logger.info("Tables match a full rebuild")
+
+        except Exception as e:
+            logger.error(f"An error occurred in main: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = ArgumentParser(description = "Populate the summary table of the SQLite database")
+    parser.add_argument("--database", default = DATABASE, help = f"SQLite database path (default: {DATABASE})")
+    parser.add_argument("--incremental", action = "store_true", help = "Only recompute samples changed by the last incremental load")
+    parser.add_argument("--verify", action = "store_true", help = "Check that the tables equal a full rebuild afterwards")
+    args = parser.parse_args()
+
+    main(args.database, args.incremental, args.verify)
@@ -0,0 +1,227 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from hashlib import blake2b
+from json import dumps
+from os import environ, stat
+from os.path import abspath
+from sqlite3 import Connection, connect
+from threading import Lock, RLock, local
+
+DATABASE_VARIABLE: str = "TEIKO_DATABASE"
+"""Environment variable overriding the SQLite database path"""
+
+DATABASE: str = environ.get(DATABASE_VARIABLE) or "subjects.db"
+"""SQLite database path; TEIKO_DATABASE if set, else "subjects.db" (relative to the working directory)"""
+
+BUSY_TIMEOUT: float = 30.0
+"""Seconds a connection waits for a lock held by another connection before failing with "database is locked" """
+
+WAL_SIZE_LIMIT: int = 64 * 1024 * 1024
+"""Bytes the write-ahead log is truncated to after a checkpoint, so a large load doesn't leave a large file behind"""
+
+_readers = local()
+"""Per-thread read-only connections, as a database path -> (inode, connection) dict in `_readers.connections`"""
+
+_writers: dict[str, tuple[int | None, Connection]] = {}
+"""Database path -> (inode, connection) of the process's single writer connection"""
+
+_writer_locks: dict[str, RLock] = {}
+"""Database path -> lock held while the writer connection is in use"""
+
+_writers_lock = Lock()
+"""Guards `_writer_locks`, which is shared by every thread"""
+
+def inode(path: str) -> int | None:
+    """
+    Get the inode of a file, to tell when a database was deleted and recreated
+
+    Args:
+        path (str): Absolute file path
+
+    Returns:
+        int | None: Inode, or None if the file doesn't exist
+    """
+    try:
+        return stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+def content_version(database: str = DATABASE) -> str:
+    """
+    Get a token that changes whenever the database's contents may have changed, and that every process
+    computes alike from the same files
+
+    Unlike `query_cache.database_version`, the token doesn't depend on any connection, only on the inode,
+    modification time, and size of the database file and its write-ahead log. A checkpoint changes it
+    without changing the contents, which only costs one recomputation.
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Returns:
+        str: Hexadecimal token
+    """
+    path = abspath(database)
+    files = []
+
+    for name in (path, f"{path}-wal"):
+        try:
+            file_stat = stat(name)
+            files.append((file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size))
+        except FileNotFoundError:
+            files.append(None)
+
+    return blake2b(dumps([ path, files ]).encode(), digest_size = 8).hexdigest()
+
+def open_reader(database: str = DATABASE, check_same_thread: bool = True) -> Connection:
+    """
+    Open a new read-only connection, which can never take a write lock
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+        check_same_thread (bool, optional): Whether only the creating thread may use the connection; defaults to True
+
+    Returns:
+        Connection: Read-only connection (a `mode=ro` URI connection)
+    """
+    connection = connect(f"file:{abspath(database)}?mode=ro", uri = True, timeout = BUSY_TIMEOUT, check_same_thread = check_same_thread)
+    connection.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    return connection
+
+def open_writer(database: str = DATABASE, check_same_thread: bool = True) -> Connection:
+    """
+    Open a new read-write connection, creating the database if needed, and switch it to WAL journaling
+
+    In WAL mode, readers keep reading the last committed data while a write transaction is in progress,
+    instead of failing or waiting until it commits. The journal mode is stored in the database file, so
+    it only needs to be set once.
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+        check_same_thread (bool, optional): Whether only the creating thread may use the connection; defaults to True
+
+    Returns:
+        Connection: Read-write connection
+    """
+    connection = connect(database, timeout = BUSY_TIMEOUT, check_same_thread = check_same_thread)
+    connection.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute(f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT}")
+    return connection
+
+def reader(database: str = DATABASE) -> Connection:
+    """
+    Get this thread's read-only connection to a database, opening it on first use
+
+    Connections are kept open and reused by later calls from the same thread, and reopened if the
+    database file was replaced. Callers must not close them.
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Returns:
+        Connection: Read-only connection owned by the current thread
+    """
+    path = abspath(database)
+    current = inode(path)
+
+    if not hasattr(_readers, "connections"):
+        _readers.connections = {}
+
+    opened, connection = _readers.connections.get(path, (None, None))
+
+    # (Re)open the connection if the file was replaced since it was opened
+    if connection is None or opened != current:
+        if connection is not None:
+            connection.close()
+
+        connection = open_reader(path)
+        _readers.connections[path] = (current, connection)
+
+    return connection
+
+@contextmanager
+def writer(database: str = DATABASE) -> Iterator[Connection]:
+    """
+    Use the process's single writer connection to a database as a transaction
+
+    Only one thread writes at a time: the others wait for the block to end. The transaction is committed
+    if the block succeeds and rolled back otherwise. Other processes' writers wait up to BUSY_TIMEOUT,
+    and readers are never blocked.
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Yields:
+        Connection: Writer connection, to be used only inside the block
+    """
+    path = abspath(database)
+
+    with _writers_lock:
+        lock = _writer_locks.setdefault(path, RLock())
+
+    with lock:
+        opened, connection = _writers.get(path, (None, None))
+        current = inode(path)
+
+        # (Re)open the connection if the file was replaced (or created) since it was opened
+        if connection is None or opened != current:
+            if connection is not None:
+                connection.close()
+
+            connection = open_writer(path, check_same_thread = False)
+            _writers[path] = (inode(path), connection)
+
+        try:
+            yield connection
+            connection.commit()
+
+        except BaseException:
+            connection.rollback()
+            raise
+
+@contextmanager
+def read_transaction(connection: Connection) -> Iterator[Connection]:
+    """
+    Run several statements on one consistent snapshot of the database
+
+    Outside a transaction, each statement sees the data committed when it starts, so a writer committing
+    between two statements can make them disagree. If the connection is already in a transaction, the
+    block simply joins it.
+
+    Args:
+        connection (Connection): Database connection, e.g. from `reader`
+
+    Yields:
+        Connection: The same connection, to be used only inside the block
+    """
+    began = not connection.in_transaction
+
+    if began:
+        connection.execute("BEGIN")
+
+    try:
+        yield connection
+
+    finally:
+        if began:
+            connection.commit()
+
+def close_connections() -> None:
+    """
+    Close the current thread's readers and every writer, e.g. before deleting a database file
+    """
+    for _, connection in getattr(_readers, "connections", {}).values():
+        connection.close()
+
+    _readers.connections = {}
+
+    with _writers_lock:
+        locks = list(_writer_locks.items())
+
+    for path, lock in locks:
+        with lock:
+            _, connection = _writers.pop(path, (None, None))
+
+            if connection is not None:
+                connection.close()
@@ -0,0 +1,289 @@
+from dataclasses import asdict, dataclass
+from numpy import arange, isin, ndarray, repeat, tile, where
+from pandas import Categorical, DataFrame, Index, read_sql_query
+from load_data import CELL_TYPES
+from database import DATABASE, reader
+from query_cache import cached_query
+from instrument import count, run, span
+from count_matrix import CATEGORICAL_COLUMNS, NUMERIC_COLUMNS, CountMatrix, current_count_matrix, read_count_matrix
+from cohort import Cohort
+
+POPULATIONS = sorted(CELL_TYPES)
+"""Categories of the frames' 'population' column, sorted as grouping by population always sorted them"""
+
+POPULATION_CODES = Index(POPULATIONS).get_indexer(CELL_TYPES).astype("int8")
+"""Code in POPULATIONS of each population in CELL_TYPES"""
+
+SAMPLE_COLUMNS = [ "sample", *CATEGORICAL_COLUMNS, *NUMERIC_COLUMNS, *CELL_TYPES ]
+"""Columns a `Dataset.samples` frame can select: one value per sample"""
+
+FREQUENCY_COLUMNS = [ *SAMPLE_COLUMNS, "population", "count", "total_count", "percentage" ]
+"""Columns a `Dataset.frequencies` frame can select: one value per sample and cell population"""
+
+LEGACY_QUERIES = {
+    "summary": "SELECT sample, population, count, total_count, percentage FROM summary",
+    "response_frequencies": """
+        SELECT s.population, s.percentage, subj.response, t.subject
+        FROM summary s
+        JOIN samples t ON s.sample = t.sample
+        JOIN subjects subj ON t.subject = subj.subject
+        WHERE subj.response IN ('yes', 'no')
+    """,
+    "filtered_frequencies": """
+        SELECT s.population, s.percentage, subj.response, t.subject
+        FROM summary s
+        JOIN samples t ON s.sample = t.sample
+        JOIN subjects subj ON t.subject = subj.subject
+        WHERE subj.response IN ('yes', 'no') AND t.sample_type = 'PBMC' AND subj.condition = 'melanoma' AND subj.treatment = 'miraclib'
+    """,
+    "training": f"""
+        SELECT DISTINCT t.sample, {', '.join(f't.{cell_type}' for cell_type in CELL_TYPES)}, t.subject, subj.response
+        FROM samples t
+        JOIN subjects subj ON t.subject = subj.subject
+        WHERE t.sample_type = 'PBMC' AND subj.condition = 'melanoma' AND subj.treatment = 'miraclib' AND subj.response IN ('yes', 'no')
+    """
+}
+"""View name -> query each module used to run to get its own copy of the view, measured by `memory_report`"""
+
+RESPONDED = Cohort(response = ("yes", "no"))
+"""Samples from subjects with a response"""
+
+FILTERED = Cohort(condition = "melanoma", treatment = "miraclib", sample_type = "PBMC", response = ("yes", "no"))
+"""PBMC samples of melanoma patients with a response who were treated with miraclib"""
+
+@dataclass(frozen = True)
+class Dataset:
+    """
+    Every sample's cell counts and metadata, held once per process and sliced into the views the
+    analyses and the dashboard use
+
+    Metadata is stored as categorical codes and counts as an int32 matrix (see `CountMatrix`), so the
+    dataset takes a fraction of the memory of the frames it replaces. Percentages are not stored: they
+    are derived from the counts of the selected samples only, exactly as the 'summary' table computes them.
+    """
+    matrix: CountMatrix
+    """Cell counts and encoded metadata, one row per sample ordered by sample ID"""
+
+    sample_index: Index
+    """Sample IDs, shared as the categories of every view's 'sample' column"""
+
+    totals: ndarray
+    """Total cell count of every sample"""
+
+    order: ndarray
+    """Column of `matrix.counts` holding each population in CELL_TYPES, the order of a sample's 'summary' table rows"""
+
+    @classmethod
+    def from_matrix(cls, matrix: CountMatrix) -> "Dataset":
+        """
+        Wrap a count matrix, precomputing what every view needs
+
+        Args:
+            matrix (CountMatrix): Count matrix, e.g. from `read_count_matrix`
+
+        Returns:
+            Dataset: Dataset over the matrix
+        """
+        return cls(
+            matrix = matrix,
+            sample_index = Index(matrix.samples),
+            totals = matrix.counts.sum(axis = 1, dtype = "int64"),
+            order = array_order(matrix.cell_types)
+        )
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def nbytes(self) -> int:
+        """
+        Get the memory held by the dataset's arrays
+
+        Returns:
+            int: Size in bytes
+        """
+        arrays = [ self.matrix.samples, self.matrix.counts, self.totals, *self.matrix.codes.values(), *self.matrix.values.values() ]
+        return sum(array.nbytes for array in arrays) + int(self.sample_index.memory_usage(deep = True))
+
+    def mask(self, cohort: Cohort) -> ndarray:
+        """
+        Select the samples of a cohort, as `Cohort.samples` would
+
+        Args:
+            cohort (Cohort): Cohort
+
+        Returns:
+            ndarray: Boolean mask over the samples; NULL values never match a filter
+        """
+        selected = repeat(True, len(self))
+
+        for column, value in asdict(cohort).items():
+            if value is None:
+                continue
+
+            allowed = value if isinstance(value, tuple) else (value,)
+
+            if column in CATEGORICAL_COLUMNS:
+                categories = self.matrix.categories[column]
+                selected &= isin(self.matrix.codes[column], [ categories.index(item) for item in allowed if item in categories ])
+            else:
+                selected &= isin(self.matrix.values[column], allowed)
+
+        return selected
+
+    def column(self, column: str, rows: ndarray) -> Categorical | ndarray:
+        """
+        Get one sample-level column for some samples
+
+        Args:
+            column (str): Name of a column in SAMPLE_COLUMNS
+            rows (ndarray): Positions of the samples
+
+        Returns:
+            Categorical | ndarray: Categorical for categorical metadata, values otherwise (MISSING for NULL numeric metadata)
+        """
+        if column == "sample":
+            return self.sample_index.take(rows).array
+
+        if column in CATEGORICAL_COLUMNS:
+            return Categorical.from_codes(self.matrix.codes[column][rows], categories = self.matrix.categories[column])
+
+        if column in NUMERIC_COLUMNS:
+            return self.matrix.values[column][rows]
+
+        return self.matrix.counts[rows, self.matrix.cell_types.index(column)]
+
+    def samples(self, mask: ndarray | None = None, columns: tuple[str, ...] = ("sample",)) -> DataFrame:
+        """
+        Build a frame with one row per selected sample
+
+        Args:
+            mask (ndarray | None, optional): Boolean mask over the samples, e.g. from `mask`; defaults to all samples
+            columns (tuple[str, ...], optional): Columns in SAMPLE_COLUMNS; defaults to the sample IDs only
+
+        Returns:
+            DataFrame: Selected columns, ordered by sample ID
+        """
+        if unknown := set(columns) - set(SAMPLE_COLUMNS):
+            raise ValueError(f"Unknown sample columns: {sorted(unknown)}")
+
+        rows = arange(len(self)) if mask is None else mask.nonzero()[0]
+
+        return DataFrame({ column: self.column(column, rows) for column in columns })
+
+    def frequencies(self, mask: ndarray | None = None,
+                    columns: tuple[str, ...] = ("population", "percentage", "response", "subject")) -> DataFrame:
+        """
+        Build a frame with one row per selected sample and cell population, like the 'summary' table
+
+        Args:
+            mask (ndarray | None, optional): Boolean mask over the samples, e.g. from `mask`; defaults to all samples
+            columns (tuple[str, ...], optional): Columns in FREQUENCY_COLUMNS; defaults to population, percentage,
+                response and subject
+
+        Returns:
+            DataFrame: Selected columns, ordered by sample ID and then population in CELL_TYPES order
+        """
+        if unknown := set(columns) - set(FREQUENCY_COLUMNS):
+            raise ValueError(f"Unknown frequency columns: {sorted(unknown)}")
+
+        rows = arange(len(self)) if mask is None else mask.nonzero()[0]
+        width = len(CELL_TYPES)
+
+        counts = self.matrix.counts[rows][:, self.order].ravel()
+        totals = repeat(self.totals[rows], width)
+
+        derived = {
+            # Each sample ID repeats once per population, so they are coded against the shared index
+            "sample": lambda: Categorical.from_codes(repeat(rows, width), categories = self.sample_index),
+            "population": lambda: Categorical.from_codes(tile(POPULATION_CODES, len(rows)), categories = POPULATIONS),
+            "count": lambda: counts,
+            "total_count": lambda: totals,
+            "percentage": lambda: where(totals > 0, counts / where(totals > 0, totals, 1) * 100, 0.0)
+        }
+
+        return DataFrame({
+            column: derived[column]() if column in derived else self.column(column, repeat(rows, width))
+            for column in columns
+        })
+
+def array_order(cell_types: list[str]) -> ndarray:
+    """
+    Get the column of each population in CELL_TYPES within a counts matrix
+
+    Args:
+        cell_types (list[str]): Cell population of each counts column
+
+    Returns:
+        ndarray: Column positions
+    """
+    return Index(cell_types).get_indexer(CELL_TYPES)
+
+@cached_query(maxsize = 1)
+def dataset() -> Dataset:
+    """
+    Load the dataset, once per process and database version
+
+    The count matrix exported by `count_matrix.py` is memory-mapped when it is up to date, so processes
+    share its pages instead of each reading the database; otherwise the matrix is read from the database.
+
+    Returns:
+        Dataset: Current dataset, shared by every view
+    """
+    with span("query"):
+        matrix = current_count_matrix()
+
+        if matrix is None:
+            matrix = read_count_matrix(reader(DATABASE))
+
+        data = Dataset.from_matrix(matrix)
+
+    count("rows_queried", len(data))
+    return data
+
+def memory_report() -> DataFrame:
+    """
+    Compare the memory taken by the views when each is read from the database as its own frame
+    (LEGACY_QUERIES) with the shared dataset and the views sliced from it
+
+    Returns:
+        DataFrame: Bytes of each view read from the database ('legacy') and sliced from the dataset ('dataset'),
+            with a 'dataset (shared)' row holding the dataset itself and a 'total' row
+    """
+    data = dataset()
+    views = {
+        "summary": lambda: data.frequencies(columns = ("sample", "population", "count", "total_count", "percentage")),
+        "response_frequencies": lambda: data.frequencies(data.mask(RESPONDED)),
+        "filtered_frequencies": lambda: data.frequencies(data.mask(FILTERED)),
+        "training": lambda: data.samples(data.mask(FILTERED), ("sample", *CELL_TYPES, "subject", "response"))
+    }
+
+    rows = [
+        {
+            "view": name,
+            "legacy": int(read_sql_query(LEGACY_QUERIES[name], reader(DATABASE)).memory_usage(deep = True).sum()),
+            "dataset": int(view().memory_usage(deep = True).sum())
+        }
+        for name, view in views.items()
+    ]
+    rows.append({ "view": "dataset (shared)", "legacy": 0, "dataset": data.nbytes() })
+
+    report = DataFrame(rows)
+    report.loc[len(report)] = [ "total", report["legacy"].sum(), report["dataset"].sum() ]
+    report["reduction (%)"] = (100 * (1 - report["dataset"] / report["legacy"].where(report["legacy"] > 0))).round(1)
+
+    return report
+
+def main() -> None:
+    """
+    Print the memory taken by the views with and without the shared dataset
+    """
+    try:
+        report = memory_report()
+        print(report.to_string(index = False))
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    with run("dataset"):
+        main()
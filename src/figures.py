@@ -0,0 +1,135 @@
+from numpy.random import default_rng
+from pandas import DataFrame
+import plotly.graph_objects as go
+from plotly.colors import qualitative
+from instrument import span
+
+MAX_OUTLIERS: int = 200
+"""Maximum number of outliers drawn per box; the rest are left out of the figure"""
+
+WHISKER_IQR: float = 1.5
+"""Whiskers reach the furthest values within this many interquartile ranges of the quartiles (as Plotly does)"""
+
+LABELS = { "population": "Cell Population", "percentage": "Relative Frequency (%)", "response": "Response" }
+"""Column name -> axis or legend title"""
+
+def box_statistics(data_frame: DataFrame, x: str = "population", y: str = "percentage", color: str = "response",
+                   max_outliers: int | None = MAX_OUTLIERS, random_state: int | None = 0) -> tuple[DataFrame, DataFrame]:
+    """
+    Compute the statistics drawn by a box plot for every (color, x) group at once
+
+    Args:
+        data_frame (DataFrame): One row per point
+        x (str, optional): Column of the box positions; defaults to "population"
+        y (str, optional): Column of the values; defaults to "percentage"
+        color (str, optional): Column splitting each position into side-by-side boxes; defaults to "response"
+        max_outliers (int | None, optional): Maximum number of outliers kept per box, picked at random;
+            None keeps them all; defaults to MAX_OUTLIERS
+        random_state (int | None, optional): Seed of the outlier sampling; defaults to 0
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Per group: `count`, `q1`, `median`, `q3`, `lowerfence` and `upperfence`
+            (the furthest values within WHISKER_IQR interquartile ranges of the quartiles);
+            and the (possibly sampled) outliers beyond the fences
+    """
+    values = data_frame[[ color, x, y ]].dropna()
+
+    if values.empty:
+        return DataFrame(columns = [ color, x, "q1", "median", "q3", "count", "lowerfence", "upperfence" ]), values
+
+    groups = values.groupby([ color, x ], observed = True, sort = True)[y]
+
+    # Quartiles of every group in one pass
+    statistics = groups.quantile([ 0.25, 0.5, 0.75 ]).unstack()
+    statistics.columns = [ "q1", "median", "q3" ]
+    statistics["count"] = groups.size()
+
+    # Whiskers end at the furthest points inside the 1.5 IQR bounds, not at the bounds themselves
+    iqr = statistics["q3"] - statistics["q1"]
+    bounds = DataFrame({ "low": statistics["q1"] - WHISKER_IQR * iqr, "high": statistics["q3"] + WHISKER_IQR * iqr })
+    bounds = values.join(bounds, on = [ color, x ])[[ "low", "high" ]]
+    inside = values[y].between(bounds["low"], bounds["high"])
+
+    fences = values[inside].groupby([ color, x ], observed = True)[y].agg([ "min", "max" ])
+    statistics["lowerfence"] = fences["min"]
+    statistics["upperfence"] = fences["max"]
+
+    outliers = values[~inside]
+
+    # Keep a random subset of each box's outliers, so the figure's size doesn't grow with the data
+    if max_outliers is not None and len(outliers):
+        shuffled = outliers.iloc[default_rng(random_state).permutation(len(outliers))]
+        outliers = shuffled.groupby([ color, x ], observed = True).head(max_outliers).sort_index()
+
+    return statistics.reset_index(), outliers.reset_index(drop = True)
+
+def box_figure(data_frame: DataFrame, title: str, subtitle: str | None = None, x: str = "population", y: str = "percentage",
+               color: str = "response", labels: dict[str, str] = LABELS, max_outliers: int | None = MAX_OUTLIERS) -> go.Figure:
+    """
+    Build a grouped box plot from precomputed statistics (see `box_statistics`)
+
+    The figure holds a handful of numbers per box and at most `max_outliers` points, instead of every
+    value in `data_frame`, so neither its size nor the browser's work depends on the number of rows.
+
+    Args:
+        data_frame (DataFrame): One row per point
+        title (str): Figure title
+        subtitle (str | None, optional): Figure subtitle; defaults to None
+        x (str, optional): Column of the box positions; defaults to "population"
+        y (str, optional): Column of the values; defaults to "percentage"
+        color (str, optional): Column splitting each position into side-by-side boxes; defaults to "response"
+        labels (dict[str, str], optional): Column name -> axis or legend title; defaults to LABELS
+        max_outliers (int | None, optional): Maximum number of outliers drawn per box; defaults to MAX_OUTLIERS
+
+    Returns:
+        go.Figure: Box plot with one box trace and one outlier trace per `color` value
+    """
+    with span("render"):
+        return build_box_figure(*box_statistics(data_frame, x, y, color, max_outliers), title, subtitle, x, y, color, labels)
+
+def build_box_figure(statistics: DataFrame, outliers: DataFrame, title: str, subtitle: str | None, x: str, y: str,
+                     color: str, labels: dict[str, str]) -> go.Figure:
+    """
+    Build a grouped box plot from the output of `box_statistics` (see `box_figure`)
+
+    Args:
+        statistics (DataFrame): Box statistics
+        outliers (DataFrame): Outliers drawn as points
+        title (str): Figure title
+        subtitle (str | None): Figure subtitle
+        x (str): Column of the box positions
+        y (str): Column of the values
+        color (str): Column splitting each position into side-by-side boxes
+        labels (dict[str, str]): Column name -> axis or legend title
+
+    Returns:
+        go.Figure: Box plot with one box trace and one outlier trace per `color` value
+    """
+    figure = go.Figure()
+
+    for index, (group, boxes) in enumerate(statistics.groupby(color, observed = True, sort = True)):
+        marker_color = qualitative.Plotly[index % len(qualitative.Plotly)]
+        points = outliers[outliers[color] == group]
+
+        figure.add_trace(go.Box(
+            name = str(group), legendgroup = str(group), offsetgroup = str(group), marker_color = marker_color,
+            x = boxes[x], q1 = boxes["q1"], median = boxes["median"], q3 = boxes["q3"],
+            lowerfence = boxes["lowerfence"], upperfence = boxes["upperfence"]
+        ))
+
+        # Outliers are a separate scatter trace in the same offset group, so they line up with their box
+        figure.add_trace(go.Scatter(
+            name = str(group), legendgroup = str(group), offsetgroup = str(group), showlegend = False,
+            x = points[x], y = points[y], mode = "markers", marker = { "color": marker_color, "size": 4 }
+        ))
+
+    figure.update_layout(
+        title = { "text": title, "subtitle": { "text": subtitle } if subtitle else None },
+        boxmode = "group",
+        scattermode = "group",
+        legend_title_text = labels.get(color, color),
+        xaxis_title = labels.get(x, x),
+        yaxis_title = labels.get(y, y)
+    )
+
+    return figure
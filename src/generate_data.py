@@ -0,0 +1,105 @@
+from argparse import ArgumentParser
+from numpy import arange, clip, cumsum, int64, repeat, rint
+from numpy.random import default_rng
+from pandas import read_csv
+from load_data import CELL_TYPES, CSV
+
+SYNTHETIC_CSV: str = "synthetic-cell-count.csv"
+"""Default output path of the generated dataset"""
+
+SUBJECTS_PER_CHUNK: int = 100_000
+"""Number of subjects generated and written at a time"""
+
+COUNT_NOISE: float = 0.15
+"""Standard deviation of the log-normal noise multiplying each template cell count (whose mean is 1)"""
+
+AGE_JITTER: int = 3
+"""Maximum number of years a synthetic subject's age differs from its template's"""
+
+def generate_csv(rows: int, output: str = SYNTHETIC_CSV, template: str = CSV, seed: int | None = 0,
+                 subjects_per_chunk: int = SUBJECTS_PER_CHUNK) -> int:
+    """
+    Generate a synthetic dataset with the same schema and structure as a template CSV file
+
+    Every synthetic subject is modeled on a template subject picked at random: it keeps its project,
+    condition, sex, treatment and response, with a slightly different age, and has the same samples
+    (sample types and time points), whose cell counts are the template's times log-normal noise. The
+    subject/sample structure and the joint distribution of subject attributes (including the share of
+    responders) therefore match the template's, whatever the size. Rows are written in chunks, so
+    memory use does not depend on `rows`.
+
+    Args:
+        rows (int): Number of samples (i.e. rows) to generate
+        output (str, optional): Output CSV path; defaults to SYNTHETIC_CSV
+        template (str, optional): CSV file the data is modeled on; defaults to CSV
+        seed (int | None, optional): Random seed, for reproducible datasets; defaults to 0
+        subjects_per_chunk (int, optional): Number of subjects generated at a time; defaults to SUBJECTS_PER_CHUNK
+
+    Returns:
+        int: Number of rows written
+    """
+    rng = default_rng(seed)
+    data = read_csv(template).sort_values([ "subject", "sample" ], kind = "stable").reset_index(drop = True)
+    columns = list(data.columns)
+
+    # Template rows of each subject are contiguous: subject i owns rows starts[i] to starts[i] + sizes[i]
+    sizes = data.groupby("subject", sort = False).size().to_numpy()
+    starts = cumsum(sizes) - sizes
+
+    written = subjects = 0
+    first = True
+
+    while written < rows:
+        # Template of each new subject, and the template rows of all their samples
+        picks = rng.integers(len(sizes), size = subjects_per_chunk)
+        lengths = sizes[picks]
+        offsets = cumsum(lengths) - lengths
+        positions = arange(lengths.sum())
+        indices = repeat(starts[picks], lengths) + positions - repeat(offsets, lengths)
+
+        # The last chunk stops at exactly `rows` rows
+        indices = indices[:rows - written]
+        subject_numbers = subjects + repeat(arange(len(picks)), lengths)[:len(indices)]
+
+        chunk = data.iloc[indices].reset_index(drop = True)
+        chunk["subject"] = [ f"sbj{number:08d}" for number in subject_numbers ]
+        chunk["sample"] = [ f"sample{number:09d}" for number in range(written, written + len(chunk)) ]
+        chunk["age"] = clip(chunk["age"].to_numpy() + repeat(rng.integers(-AGE_JITTER, AGE_JITTER + 1, size = len(picks)), lengths)[:len(chunk)], 0, None)
+
+        counts = chunk[CELL_TYPES].to_numpy(dtype = float)
+        chunk[CELL_TYPES] = rint(counts * rng.lognormal(-COUNT_NOISE ** 2 / 2, COUNT_NOISE, size = counts.shape)).astype(int64)
+
+        chunk[columns].to_csv(output, mode = "w" if first else "a", header = first, index = False)
+
+        first = False
+        written += len(chunk)
+        subjects += len(picks)
+
+    return written
+
+def main(rows: int, output: str = SYNTHETIC_CSV, template: str = CSV, seed: int | None = 0) -> None:
+    """
+    Generate a synthetic dataset modeled on `template`
+
+    Args:
+        rows (int): Number of samples (i.e. rows) to generate
+        output (str, optional): Output CSV path; defaults to SYNTHETIC_CSV
+        template (str, optional): CSV file the data is modeled on; defaults to CSV
+        seed (int | None, optional): Random seed; defaults to 0
+    """
+    try:
+        written = generate_csv(rows, output, template, seed)
+        print(f"Generated {written} rows modeled on '{template}' into '{output}'")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Generate a synthetic dataset with the same schema and structure as cell-count.csv")
+    parser.add_argument("--rows", type = int, required = True, help = "Number of samples (rows) to generate, e.g. 100000, 1000000 or 10000000")
+    parser.add_argument("--output", default = SYNTHETIC_CSV, help = f"Output CSV path (default: {SYNTHETIC_CSV})")
+    parser.add_argument("--template", default = CSV, help = f"CSV file the data is modeled on (default: {CSV})")
+    parser.add_argument("--seed", type = int, default = 0, help = "Random seed (default: 0)")
+    args = parser.parse_args()
+
+    main(args.rows, args.output, args.template, args.seed)
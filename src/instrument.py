@@ -0,0 +1,194 @@
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cProfile import Profile
+from datetime import datetime, timezone
+from io import StringIO
+from json import dump
+from logging import Formatter, Logger, StreamHandler, getLogger
+from os import environ, getpid
+from pstats import Stats
+from threading import Lock
+from time import perf_counter
+import tracemalloc
+
+LOG_LEVEL_VARIABLE: str = "TEIKO_LOG_LEVEL"
+"""Environment variable setting the log level (e.g. DEBUG, INFO, WARNING); defaults to INFO"""
+
+REPORT_VARIABLE: str = "TEIKO_REPORT"
+"""Environment variable holding the path the JSON run report is written to; unset disables the report"""
+
+PROFILE_VARIABLE: str = "TEIKO_PROFILE"
+"""Environment variable enabling profilers: "cprofile", "tracemalloc", or both separated by a comma (or "all")"""
+
+PROFILE_TOP: int = 20
+"""Number of functions and allocation sites listed in the report"""
+
+logger: Logger = getLogger("teiko")
+"""Logger shared by every module"""
+
+_lock = Lock()
+"""Guards the spans and counters, which may be updated by several threads"""
+
+_spans: dict[str, dict[str, float]] = defaultdict(lambda: { "calls": 0, "seconds": 0.0 })
+"""Span path (e.g. "load_data/load") -> number of calls and total seconds"""
+
+_counters: dict[str, int] = defaultdict(int)
+"""Counter name -> value"""
+
+_path: ContextVar[str] = ContextVar("span_path", default = "")
+"""Path of the innermost open span"""
+
+def recording() -> bool:
+    """
+    Check whether spans and counters are being recorded, i.e. a report or profile was asked for
+
+    Returns:
+        bool: True if TEIKO_REPORT or TEIKO_PROFILE is set
+    """
+    return bool(environ.get(REPORT_VARIABLE) or environ.get(PROFILE_VARIABLE))
+
+def configure_logging(level: str | None = None) -> None:
+    """
+    Send the shared logger's records to standard error, once
+
+    Args:
+        level (str | None, optional): Log level; defaults to TEIKO_LOG_LEVEL, or INFO if unset
+    """
+    if not logger.handlers:
+        handler = StreamHandler()
+        handler.setFormatter(Formatter("[%(levelname)s] %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+
+    logger.setLevel((level or environ.get(LOG_LEVEL_VARIABLE) or "INFO").upper())
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time a stage (e.g. "create", "load", "summarize", "query", "compare", "train", "render")
+
+    Spans nest: a span opened inside another is recorded under "<outer>/<name>". Timings are logged at
+    DEBUG level, and aggregated per path for the run report when `recording()`.
+
+    Args:
+        name (str): Stage name
+    """
+    parent = _path.get()
+    path = f"{parent}/{name}" if parent else name
+    token = _path.set(path)
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        _path.reset(token)
+
+        if recording():
+            with _lock:
+                _spans[path]["calls"] += 1
+                _spans[path]["seconds"] += seconds
+
+        logger.debug("%s took %.3fs", path, seconds)
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Add to a counter (e.g. rows or bytes processed) of the run report; does nothing unless `recording()`
+
+    Args:
+        name (str): Counter name
+        value (int, optional): Amount added; defaults to 1
+    """
+    if recording():
+        with _lock:
+            _counters[name] += value
+
+def profile_report(profile: Profile) -> list[dict]:
+    """
+    Summarize a cProfile profile
+
+    Args:
+        profile (Profile): Stopped profiler
+
+    Returns:
+        list[dict]: PROFILE_TOP functions with the highest cumulative time
+    """
+    stats = Stats(profile, stream = StringIO())
+    rows = sorted(stats.stats.items(), key = lambda item: item[1][3], reverse = True)[:PROFILE_TOP]
+
+    return [
+        { "function": f"{file}:{line}({function})", "calls": calls, "own_seconds": round(own, 6), "cumulative_seconds": round(cumulative, 6) }
+        for (file, line, function), (_, calls, own, cumulative, _) in rows
+    ]
+
+@contextmanager
+def run(name: str) -> Iterator[None]:
+    """
+    Instrument a whole program run (e.g. a module's `main`)
+
+    Configures logging and opens the outermost span. When TEIKO_PROFILE is set, the run is profiled with
+    cProfile (also saved as "<name>-<pid>.prof" for pstats/snakeviz) and/or tracemalloc. When
+    TEIKO_REPORT is set, a JSON report with the spans, counters, and profiles is written to it at the end.
+
+    Args:
+        name (str): Run name, used as the root of every span path
+    """
+    configure_logging()
+
+    profilers = { value.strip().lower() for value in environ.get(PROFILE_VARIABLE, "").split(",") if value.strip() }
+    if "all" in profilers:
+        profilers = { "cprofile", "tracemalloc" }
+
+    profile = Profile() if "cprofile" in profilers else None
+    tracing = "tracemalloc" in profilers and not tracemalloc.is_tracing()
+    started = datetime.now(timezone.utc)
+
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+    if tracing:
+        tracemalloc.start()
+    if profile is not None:
+        profile.enable()
+
+    try:
+        with span(name):
+            yield
+
+    finally:
+        if profile is not None:
+            profile.disable()
+
+        report = {
+            "name": name,
+            "pid": getpid(),
+            "started": started.isoformat(timespec = "seconds"),
+            "spans": { path: { "calls": values["calls"], "seconds": round(values["seconds"], 6) } for path, values in _spans.items() },
+            "counters": dict(_counters)
+        }
+
+        if profile is not None:
+            profile.dump_stats(f"{name}-{getpid()}.prof")
+            report["cprofile"] = profile_report(profile)
+
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            report["tracemalloc"] = {
+                "peak_bytes": peak,
+                "top_allocations": [
+                    { "location": str(statistic.traceback), "bytes": statistic.size, "blocks": statistic.count }
+                    for statistic in snapshot.statistics("lineno")[:PROFILE_TOP]
+                ]
+            }
+
+        if path := environ.get(REPORT_VARIABLE):
+            with open(path, mode = "w", encoding = "utf-8") as file:
+                dump(report, file, indent = 2)
+
+            logger.info("Wrote run report to '%s'", path)
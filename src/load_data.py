@@ -1,8 +1,20 @@
-from sqlite3 import Connection, Cursor, connect
-from csv import DictReader
-
-DATABASE: str = "subjects.db"
-"""SQLite database path"""
+from argparse import ArgumentParser
+from sqlite3 import Connection, Cursor
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from csv import reader
+from glob import glob
+from hashlib import blake2b
+from itertools import islice, product
+from logging import DEBUG
+from operator import itemgetter
+from os import cpu_count, stat
+from os.path import abspath, getsize, isdir, isfile, join
+from time import perf_counter
+from typing import BinaryIO
+from instrument import count, logger, run, span
+from database import DATABASE, writer
 
 CSV: str = "cell-count.csv"
 """CSV file path"""
@@ -10,6 +22,169 @@ CSV: str = "cell-count.csv"
 CELL_TYPES = [ "b_cell", "cd8_t_cell", "cd4_t_cell", "nk_cell", "monocyte" ]
 """List of cell population column names in database"""
 
+POPULATION_POSITION: str = "CASE population " + " ".join(f"WHEN '{cell_type}' THEN {position}" for position, cell_type in enumerate(CELL_TYPES)) + " END"
+"""SQL expression giving the position of a 'population' column's value in CELL_TYPES, the order of each sample's summary rows"""
+
+SUBJECT_FIELDS = [ "subject", "project", "condition", "age", "sex", "treatment", "response" ]
+"""CSV columns stored in 'subjects' table"""
+
+SAMPLE_FIELDS = [ "sample", "sample_type", "time_from_treatment_start", *CELL_TYPES ]
+"""CSV columns stored in 'samples' table (besides 'subject')"""
+
+BATCH_SIZE: int = 10_000
+"""Number of rows inserted per `executemany` call when bulk loading"""
+
+CHUNK_BYTES: int = 8 * 1024 * 1024
+"""Size in bytes of the file ranges parsed by each worker when loading files in parallel"""
+
+HASH_BATCH_SIZE: int = 500
+"""Number of rows whose stored hashes are looked up per query when loading incrementally"""
+
+LOAD_MODES = [ "row", "bulk", "stream", "parallel", "incremental" ]
+"""Ways `main` can load the CSV file into the database"""
+
+BULK_PRAGMAS = { "synchronous": "OFF", "temp_store": "MEMORY", "cache_size": -262144 }
+"""PRAGMA settings used while bulk loading (i.e. no fsync, 256 MiB page cache); the WAL journal is kept so readers aren't blocked"""
+
+INSERT_SUBJECT: str = """
+    INSERT OR IGNORE INTO subjects
+    (subject, project, condition, age, sex, treatment, response)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+"""Statement inserting one row into 'subjects' table, unless its subject already exists"""
+
+INSERT_SAMPLE: str = f"""
+    INSERT OR IGNORE INTO samples
+    (sample, subject, sample_type, time_from_treatment_start, {', '.join(CELL_TYPES)})
+    VALUES (?, ?, ?, ?, {', '.join('?' for _ in CELL_TYPES)})
+"""
+"""Statement inserting one row into 'samples' table, unless its sample already exists"""
+
+UPSERT_SUBJECT: str = """
+    INSERT INTO subjects
+    (subject, project, condition, age, sex, treatment, response)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (subject) DO UPDATE SET
+        (project, condition, age, sex, treatment, response) =
+        (excluded.project, excluded.condition, excluded.age, excluded.sex, excluded.treatment, excluded.response)
+    WHERE (project, condition, age, sex, treatment, response) IS NOT
+        (excluded.project, excluded.condition, excluded.age, excluded.sex, excluded.treatment, excluded.response)
+"""
+"""Statement inserting one row into 'subjects' table, or updating the existing row if any column differs"""
+
+UPSERT_SAMPLE: str = f"""
+    INSERT INTO samples
+    (sample, subject, sample_type, time_from_treatment_start, {', '.join(CELL_TYPES)})
+    VALUES (?, ?, ?, ?, {', '.join('?' for _ in CELL_TYPES)})
+    ON CONFLICT (sample) DO UPDATE SET
+        (subject, sample_type, time_from_treatment_start, {', '.join(CELL_TYPES)}) =
+        (excluded.subject, excluded.sample_type, excluded.time_from_treatment_start, {', '.join(f'excluded.{cell_type}' for cell_type in CELL_TYPES)})
+    WHERE (subject, sample_type, time_from_treatment_start, {', '.join(CELL_TYPES)}) IS NOT
+        (excluded.subject, excluded.sample_type, excluded.time_from_treatment_start, {', '.join(f'excluded.{cell_type}' for cell_type in CELL_TYPES)})
+"""
+"""Statement inserting one row into 'samples' table, or updating the existing row if any column differs"""
+
+CREATE_SUMMARY: str = """
+    CREATE TABLE IF NOT EXISTS summary (
+        sample TEXT NOT NULL,
+        population TEXT NOT NULL,
+        total_count INTEGER,
+        count INTEGER,
+        percentage REAL,
+        PRIMARY KEY (sample, population),
+        FOREIGN KEY (sample) REFERENCES samples (sample)
+    ) WITHOUT ROWID
+"""
+"""Statement creating 'summary' table, keyed by sample and population (which also serves lookups by sample)"""
+
+CREATE_LONGITUDINAL: str = """
+    CREATE TABLE IF NOT EXISTS longitudinal (
+        sample TEXT NOT NULL,
+        population TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        sample_type TEXT,
+        time_from_treatment_start INTEGER NOT NULL,
+        count INTEGER,
+        percentage REAL,
+        baseline_count REAL,
+        baseline_percentage REAL,
+        count_change REAL,
+        percentage_change REAL,
+        count_fold_change REAL,
+        percentage_fold_change REAL,
+        percentage_step REAL,
+        PRIMARY KEY (sample, population),
+        FOREIGN KEY (sample) REFERENCES samples (sample)
+    ) WITHOUT ROWID
+"""
+"""Statement creating 'longitudinal' table, which holds each 'summary' row's change from its subject's baseline (time 0)"""
+
+CUBE_SUBJECT_DIMENSIONS = [ "project", "condition", "treatment", "response", "sex" ]
+"""Subject columns the cohort cube is grouped by"""
+
+CUBE_SAMPLE_DIMENSIONS = [ "sample_type", "time_from_treatment_start" ]
+"""Sample columns the cohort cube is grouped by, each also aggregated over all its values"""
+
+CREATE_COHORT_CUBE: str = f"""
+    CREATE TABLE IF NOT EXISTS cohort_cube (
+        project TEXT,
+        condition TEXT,
+        treatment TEXT,
+        response TEXT,
+        sex TEXT,
+        sample_type TEXT,
+        time_from_treatment_start INTEGER,
+        {', '.join(f'all_{column} INTEGER NOT NULL' for column in CUBE_SAMPLE_DIMENSIONS)},
+        samples INTEGER NOT NULL,
+        subjects INTEGER NOT NULL,
+        {', '.join(f'{cell_type} INTEGER' for cell_type in CELL_TYPES)}
+    )
+"""
+"""Statement creating 'cohort_cube' table; `all_<column>` is 1 in the rows aggregated over every value of that column (then NULL)"""
+
+CUBE_SELECT: str = f"""
+    SELECT {', '.join(f'subj.{column}' for column in CUBE_SUBJECT_DIMENSIONS)}, {{sample_columns}}, {{levels}},
+        COUNT(*),
+        COUNT(DISTINCT t.subject),
+        {', '.join(f'SUM(t.{cell_type})' for cell_type in CELL_TYPES)}
+    FROM samples t
+    JOIN subjects subj ON t.subject = subj.subject
+    {{{{where}}}}
+    GROUP BY {', '.join(f'subj.{column}' for column in CUBE_SUBJECT_DIMENSIONS)}{{group_by}}
+"""
+"""Query computing the 'cohort_cube' rows of one aggregation level, given its `{sample_columns}`, `{levels}` and extra `{group_by}` columns;
+formatting them leaves a `{where}` placeholder selecting the samples"""
+
+INSERT_COHORT_CUBE: str = "INSERT INTO cohort_cube" + " UNION ALL ".join(
+    CUBE_SELECT.format(
+        sample_columns = ", ".join("NULL" if aggregated else f"t.{column}" for column, aggregated in zip(CUBE_SAMPLE_DIMENSIONS, levels)),
+        levels = ", ".join(map(str, levels)),
+        group_by = "".join(f", t.{column}" for column, aggregated in zip(CUBE_SAMPLE_DIMENSIONS, levels) if not aggregated)
+    )
+    for levels in product((0, 1), repeat = len(CUBE_SAMPLE_DIMENSIONS))
+)
+"""Statement computing every row of 'cohort_cube' for the samples matching `{where}`: sample counts, distinct subject counts
+and cell count sums per combination of subject and sample columns, with each sample column either grouped by or aggregated over"""
+
+CUBE_PENDING_MATCH: str = " AND ".join(f"{{table}}.{column} IS p.{column}" for column in CUBE_SUBJECT_DIMENSIONS)
+"""Condition matching the subject columns of `{table}` with those of a 'cube_pending' row (aliased 'p'), NULLs included"""
+
+QUEUE_CUBE_GROUPS: str = f"""
+    INSERT INTO cube_pending ({', '.join(CUBE_SUBJECT_DIMENSIONS)})
+    SELECT DISTINCT {', '.join(CUBE_SUBJECT_DIMENSIONS)}
+    FROM subjects
+    WHERE subject IN ({{subjects}}) OR subject IN (SELECT subject FROM samples WHERE sample IN ({{samples}}))
+"""
+"""Statement queueing the cube groups (subject column values) of the given `{subjects}` and of the subjects of the given `{samples}`"""
+
+INDEXES = {
+    "idx_samples_subject": "samples(subject)",
+    "idx_samples_type_time": "samples(sample_type, time_from_treatment_start, subject)",
+    "idx_subjects_condition_treatment_response": "subjects(condition, treatment, response)",
+    "idx_subjects_sex": "subjects(sex)"
+}
+"""Secondary indexes (name -> table and columns) for faster queries"""
+
 def validate_db(cursor: Cursor, table: str, column: str, value: str) -> bool:
     """
     Check if a value already exists in a given table
@@ -26,6 +201,33 @@ def validate_db(cursor: Cursor, table: str, column: str, value: str) -> bool:
     cursor.execute(f"SELECT 1 FROM {table} WHERE {column} = ?", (value,))
     return cursor.fetchone() is not None
 
+def row_parser(header: list[str]) -> Callable[[list[str]], tuple[tuple, tuple]]:
+    """
+    Build a function converting a CSV row into its 'subjects' and 'samples' table rows
+
+    Columns are looked up by position once, so parsing a row costs no dictionary lookups.
+
+    Args:
+        header (list[str]): CSV header row
+
+    Returns:
+        Callable[[list[str]], tuple[tuple, tuple]]: Function returning the row's values in
+            INSERT_SUBJECT and INSERT_SAMPLE column order, respectively
+    """
+    subject_fields = itemgetter(*(header.index(column) for column in SUBJECT_FIELDS))
+    sample_fields = itemgetter(*(header.index(column) for column in SAMPLE_FIELDS))
+
+    def parse(row: list[str]) -> tuple[tuple, tuple]:
+        subject, project, condition, age, sex, treatment, response = subject_fields(row)
+        sample, sample_type, time_from_treatment_start, *counts = sample_fields(row)
+
+        return (
+            (subject, project, condition, int(age), sex, treatment, response if response else None),
+            (sample, subject, sample_type, int(time_from_treatment_start) if time_from_treatment_start else None, *map(int, counts))
+        )
+
+    return parse
+
 def load_csv(connection: Connection, csv: str = CSV) -> None:
     """
     Load data from a CSV file into the 'subjects' and 'samples' tables in the database
@@ -36,66 +238,555 @@ def load_csv(connection: Connection, csv: str = CSV) -> None:
     """
     cursor = connection.cursor()
 
+    # Checked once, so per-row logging costs nothing when it's disabled
+    debug = logger.isEnabledFor(DEBUG)
+
     # Open given CSV file and read its contents
     with open(csv, mode = "r", newline = "", encoding = "utf-8") as file:
-        csv_reader = DictReader(file, delimiter = ",")
+        csv_reader = reader(file, delimiter = ",")
+        parse = row_parser(next(csv_reader))
 
         # Loop over each row in CSV file
         for row in csv_reader:
+            subject_row, sample_row = parse(row)
+
             # Extract value of 'subject' column in current row
-            subject = row["subject"]
+            subject = subject_row[0]
 
             # Check if current row's subject data already exists in 'subjects' table to avoid duplicates
             if not validate_db(cursor, "subjects", "subject", subject):
                 # Insert current row's subject data into 'subjects' table
-                cursor.execute("""
-                    INSERT INTO subjects
-                    (subject, project, condition, age, sex, treatment, response)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                        subject,
-                        row["project"],
-                        row["condition"],
-                        int(row["age"]),
-                        row["sex"],
-                        row["treatment"],
-                        row["response"] if row["response"] else None
-                    )
-                )
-                print(f"Recorded '{subject}' into 'subjects' table")
+                cursor.execute(INSERT_SUBJECT, subject_row)
+                if debug:
+                    logger.debug("Recorded '%s' into 'subjects' table", subject)
 
             # Extract value of 'sample' column in current row
-            sample = row["sample"]
+            sample = sample_row[0]
 
             # Check if current row's sample data already exists in 'samples' table to avoid duplicates
             if not validate_db(cursor, "samples", "sample", sample):
                 # Insert current row's sample data into 'samples' table
-                cursor.execute(f"""
-                    INSERT INTO samples
-                    (sample, subject, sample_type, time_from_treatment_start, {', '.join(CELL_TYPES)})
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                        sample,
-                        subject,
-                        row["sample_type"],
-                        int(row["time_from_treatment_start"]) if row["time_from_treatment_start"] else None,
-                        int(row["b_cell"]),
-                        int(row["cd8_t_cell"]),
-                        int(row["cd4_t_cell"]),
-                        int(row["nk_cell"]),
-                        int(row["monocyte"])
-                    )
-                )
-                print(f"Recorded '{sample}' into 'samples' table")
+                cursor.execute(INSERT_SAMPLE, sample_row)
+                if debug:
+                    logger.debug("Recorded '%s' into 'samples' table", sample)
+
+    connection.commit()
+
+def insert_batch(cursor: Cursor, subjects: list[tuple], samples: list[tuple]) -> None:
+    """
+    Insert a batch of subject and sample rows, skipping keys that already exist
+
+    Subjects are inserted first so that the samples' foreign keys resolve.
+
+    Args:
+        cursor (Cursor): Database cursor
+        subjects (list[tuple]): Rows for the 'subjects' table
+        samples (list[tuple]): Rows for the 'samples' table
+    """
+    cursor.executemany(INSERT_SUBJECT, subjects)
+    cursor.executemany(INSERT_SAMPLE, samples)
+
+@contextmanager
+def bulk_session(connection: Connection) -> Iterator[None]:
+    """
+    Run a load as a single transaction under BULK_PRAGMAS, with secondary indexes built afterwards
+
+    The transaction is committed if the block succeeds and rolled back otherwise. Either way,
+    the previous PRAGMA values are restored and the indexes in INDEXES are (re)created.
+
+    Args:
+        connection (Connection): Database connection
+    """
+    cursor = connection.cursor()
+
+    # Loader-friendly settings; the previous values are restored once the load is done
+    previous = { pragma: cursor.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in BULK_PRAGMAS }
+    for pragma, value in BULK_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+
+    drop_indexes(connection)
+
+    try:
+        yield
+        connection.commit()
+
+    except BaseException:
+        connection.rollback()
+        raise
+
+    finally:
+        for pragma, value in previous.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+        create_indexes(connection)
+
+def load_csv_bulk(connection: Connection, csv: str = CSV, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Load data from a CSV file in a single transaction, for large files
+
+    Unlike `load_csv`, duplicates are removed in memory instead of with a SELECT per row,
+    rows are inserted in batches of `batch_size` with `executemany`, and nothing is printed per row.
+    Secondary indexes are dropped for the duration of the load and rebuilt once the data is in.
+    Rows whose key already exists in the database are left untouched.
+
+    Args:
+        connection (Connection): Database connection
+        csv (str, optional): Path to the CSV file; defaults to CSV
+        batch_size (int, optional): Number of rows per `executemany` call; defaults to BATCH_SIZE
+
+    Returns:
+        int: Number of CSV rows read
+    """
+    cursor = connection.cursor()
+
+    # Only the keys are kept for deduplication, so memory grows with the number of
+    # distinct subjects and samples rather than with the size of each row
+    seen_subjects: set[str] = set()
+    seen_samples: set[str] = set()
+    subjects: list[tuple] = []
+    samples: list[tuple] = []
+    rows = 0
+
+    with bulk_session(connection):
+        with open(csv, mode = "r", newline = "", encoding = "utf-8") as file:
+            csv_reader = reader(file, delimiter = ",")
+            parse = row_parser(next(csv_reader))
+
+            for row in csv_reader:
+                rows += 1
+                subject_row, sample_row = parse(row)
+
+                if subject_row[0] not in seen_subjects:
+                    seen_subjects.add(subject_row[0])
+                    subjects.append(subject_row)
+
+                if sample_row[0] not in seen_samples:
+                    seen_samples.add(sample_row[0])
+                    samples.append(sample_row)
+
+                if len(samples) >= batch_size:
+                    insert_batch(cursor, subjects, samples)
+                    subjects.clear()
+                    samples.clear()
+
+        insert_batch(cursor, subjects, samples)
+
+    return rows
+
+def read_lines(file: BinaryIO, position: list[int]) -> Iterator[str]:
+    """
+    Yield decoded lines from a binary file while keeping track of the byte offset consumed so far
+
+    Args:
+        file (BinaryIO): File opened in binary mode
+        position (list[int]): One-element list holding the file's current byte offset; updated in place
+
+    Yields:
+        str: Next line of the file
+    """
+    for line in file:
+        position[0] += len(line)
+        yield line.decode("utf-8")
+
+def load_csv_stream(connection: Connection, csv: str = CSV, chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Load data from a CSV file in fixed-size chunks, committing each chunk with a checkpoint
+
+    After each chunk of `chunk_size` rows, the byte offset and row number reached are saved in the
+    'load_checkpoints' table in the same transaction as the chunk's rows. If a load is interrupted,
+    calling this again with the same (unchanged) file resumes right after the last committed chunk.
+    Only one chunk is held in memory at a time, so memory use does not depend on the file's size.
+
+    Args:
+        connection (Connection): Database connection
+        csv (str, optional): Path to the CSV file; defaults to CSV
+        chunk_size (int, optional): Number of rows per committed chunk; defaults to BATCH_SIZE
+
+    Returns:
+        int: Number of CSV rows loaded by this call
+    """
+    cursor = connection.cursor()
+    path = abspath(csv)
+    file_stat = stat(path)
+
+    # Resume from the last checkpoint, unless the file changed since it was recorded
+    checkpoint = cursor.execute(
+        "SELECT size, modified, offset, rows FROM load_checkpoints WHERE csv = ?", (path,)
+    ).fetchone()
+
+    if checkpoint and checkpoint[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+        offset, rows = checkpoint[2:]
+        logger.info("Resuming '%s' from row %d (byte %d)", csv, rows, offset)
+    else:
+        offset, rows = 0, 0
+
+    loaded = 0
+    subjects: list[tuple] = []
+    samples: list[tuple] = []
+
+    with open(path, mode = "rb") as file:
+        position = [ 0 ]
+        csv_reader = reader(read_lines(file, position), delimiter = ",")
+        parse = row_parser(next(csv_reader))
+
+        if offset > position[0]:
+            file.seek(offset)
+            position[0] = offset
+
+        while True:
+            for row in csv_reader:
+                if row:
+                    subject_row, sample_row = parse(row)
+                    subjects.append(subject_row)
+                    samples.append(sample_row)
+
+                    if len(samples) >= chunk_size:
+                        break
+
+            if not samples:
+                break
+
+            insert_batch(cursor, subjects, samples)
+            rows += len(samples)
+            loaded += len(samples)
+
+            # Record how far the file has been loaded, atomically with the chunk itself
+            cursor.execute("""
+                INSERT INTO load_checkpoints (csv, size, modified, offset, rows)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (csv) DO UPDATE SET
+                    size = excluded.size, modified = excluded.modified,
+                    offset = excluded.offset, rows = excluded.rows
+            """, (path, file_stat.st_size, file_stat.st_mtime_ns, position[0], rows))
+            connection.commit()
+            logger.debug("Committed rows up to %d (byte %d) of '%s'", rows, position[0], csv)
+
+            subjects.clear()
+            samples.clear()
+
+    count("bytes_read", position[0] - offset)
+
+    return loaded
+
+def csv_files(source: str) -> list[str]:
+    """
+    Resolve a directory or glob pattern into the CSV files it refers to
+
+    Args:
+        source (str): Directory (all '*.csv' files in it), glob pattern, or single file path
+
+    Returns:
+        list[str]: Sorted list of matching file paths
+    """
+    pattern = join(source, "*.csv") if isdir(source) else source
+    files = sorted(path for path in glob(pattern) if isfile(path))
+
+    if not files:
+        raise FileNotFoundError(f"No CSV files match '{source}'")
+
+    return files
+
+def split_csv(csv: str, chunk_bytes: int = CHUNK_BYTES) -> list[tuple[str, list[str], int, int]]:
+    """
+    Split a CSV file into byte ranges that can be parsed independently
+
+    Range boundaries don't need to fall on line breaks: each line belongs to the range it starts in.
+
+    Args:
+        csv (str): Path to the CSV file
+        chunk_bytes (int, optional): Approximate size of each range in bytes; defaults to CHUNK_BYTES
+
+    Returns:
+        list[tuple[str, list[str], int, int]]: File path, header row, start and end offset of each range
+    """
+    with open(csv, mode = "rb") as file:
+        header_line = file.readline()
+
+    header = next(reader([ header_line.decode("utf-8") ], delimiter = ","))
+    start, size = len(header_line), getsize(csv)
+
+    return [ (csv, header, offset, min(offset + chunk_bytes, size)) for offset in range(start, size, chunk_bytes) ]
+
+def parse_csv_range(task: tuple[str, list[str], int, int]) -> tuple[list[tuple], list[tuple]]:
+    """
+    Parse the rows of one byte range of a CSV file (see `split_csv`); runs in a worker process
+
+    Args:
+        task (tuple[str, list[str], int, int]): File path, header row, start and end offset
+
+    Returns:
+        tuple[list[tuple], list[tuple]]: Rows for the 'subjects' and 'samples' tables, respectively
+    """
+    csv, header, start, end = task
+    parse = row_parser(header)
+    subjects: list[tuple] = []
+    samples: list[tuple] = []
+
+    with open(csv, mode = "rb") as file:
+        # Skip the line in progress at `start`, which belongs to the previous range
+        file.seek(start - 1)
+        file.readline()
+
+        lines = []
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            lines.append(line.decode("utf-8"))
+
+    for row in reader(lines, delimiter = ","):
+        if row:
+            subject_row, sample_row = parse(row)
+            subjects.append(subject_row)
+            samples.append(sample_row)
+
+    return subjects, samples
+
+def load_csv_files(connection: Connection, source: str, workers: int | None = None, chunk_bytes: int = CHUNK_BYTES) -> int:
+    """
+    Load every CSV file matching a directory or glob, parsing them in parallel
+
+    Files are split into byte ranges (see `split_csv`) so that the work spreads over all cores
+    even when there are fewer files than cores. A process pool parses and type-converts the ranges,
+    and the parsed batches are handed back through a bounded queue to this process, the only one
+    writing to the database, in a single bulk transaction (see `bulk_session`).
+    Rows whose key already exists in the database are left untouched.
+
+    Args:
+        connection (Connection): Database connection
+        source (str): Directory, glob pattern, or file path (see `csv_files`)
+        workers (int | None, optional): Number of worker processes; defaults to the number of CPUs
+        chunk_bytes (int, optional): Approximate size of each parsed range in bytes; defaults to CHUNK_BYTES
+
+    Returns:
+        int: Number of CSV rows read
+    """
+    cursor = connection.cursor()
+    files = csv_files(source)
+    tasks = [ task for csv in files for task in split_csv(csv, chunk_bytes) ]
+    workers = workers or cpu_count() or 1
+    rows = 0
+
+    logger.info("Parsing %d file(s) in %d chunk(s) with %d worker(s)", len(files), len(tasks), workers)
+    count("bytes_read", sum(getsize(csv) for csv in files))
+
+    with bulk_session(connection), ProcessPoolExecutor(max_workers = workers) as executor:
+        pending: set[Future] = set()
+        remaining = iter(tasks)
+
+        # Keep at most two batches per worker in flight so parsed data can't pile up in memory
+        while True:
+            for task in islice(remaining, 2 * workers - len(pending)):
+                pending.add(executor.submit(parse_csv_range, task))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                subjects, samples = future.result()
+                insert_batch(cursor, subjects, samples)
+                rows += len(samples)
+
+    return rows
+
+def row_digest(subject_row: tuple, sample_row: tuple) -> int:
+    """
+    Hash the parsed values of a CSV row into a signed 64-bit integer
+
+    Args:
+        subject_row (tuple): Row for the 'subjects' table
+        sample_row (tuple): Row for the 'samples' table
+
+    Returns:
+        int: Row digest, small enough to be stored as an SQLite INTEGER
+    """
+    digest = blake2b(repr((subject_row, sample_row)).encode("utf-8"), digest_size = 8).digest()
+    return int.from_bytes(digest, signed = True)
+
+def upsert_changed(cursor: Cursor, batch: dict[str, tuple[int, tuple, tuple]]) -> int:
+    """
+    Write the rows of a batch whose digest differs from the one stored in 'row_hashes'
+
+    New or changed subjects and samples are upserted, their digests are stored, and changed samples are
+    queued in 'summary_pending' so that `data_analysis.refresh_summary_table` recomputes their summary.
+    The cohort cube groups of their subjects, before and after the change, are queued in 'cube_pending'.
+
+    Args:
+        cursor (Cursor): Database cursor
+        batch (dict[str, tuple[int, tuple, tuple]]): Sample ID -> (digest, subject row, sample row)
+
+    Returns:
+        int: Number of new or changed rows
+    """
+    stored = dict(cursor.execute(
+        f"SELECT sample, digest FROM row_hashes WHERE sample IN ({', '.join('?' for _ in batch)})", list(batch)
+    ).fetchall())
+
+    changed = [ (sample, *values) for sample, values in batch.items() if stored.get(sample) != values[0] ]
+
+    if changed:
+        subjects = list({ subject_row[0]: subject_row for _, _, subject_row, _ in changed }.values())
+        samples = [ sample for sample, *_ in changed ]
+        queue = QUEUE_CUBE_GROUPS.format(subjects = ", ".join("?" for _ in subjects), samples = ", ".join("?" for _ in samples))
+        parameters = [ subject_row[0] for subject_row in subjects ] + samples
+
+        # The cube groups a change leaves and those it joins are both queued for `refresh_cohort_cube`
+        cursor.execute(queue, parameters)
+        cursor.executemany(UPSERT_SUBJECT, subjects)
+        cursor.executemany(UPSERT_SAMPLE, [ sample_row for _, _, _, sample_row in changed ])
+        cursor.execute(queue, parameters)
+        cursor.executemany(
+            "INSERT INTO row_hashes (sample, digest) VALUES (?, ?) ON CONFLICT (sample) DO UPDATE SET digest = excluded.digest",
+            [ (sample, digest) for sample, digest, _, _ in changed ]
+        )
+        cursor.executemany("INSERT OR IGNORE INTO summary_pending (sample) VALUES (?)", [ (sample,) for sample, *_ in changed ])
+
+    return len(changed)
+
+def load_csv_incremental(connection: Connection, csv: str = CSV, batch_size: int = HASH_BATCH_SIZE) -> int:
+    """
+    Load only the rows of a CSV file that are new or changed since the previous incremental load
+
+    Each row is hashed (see `row_digest`) and compared with the digest stored for its sample in
+    'row_hashes', one indexed lookup per batch of `batch_size` rows. Unchanged rows cause no writes.
+    New or changed rows are upserted, which also picks up corrected values for existing samples,
+    and their samples are queued for summary recomputation (see `upsert_changed`).
+
+    A database that was loaded in another mode has no stored digests yet, so its first incremental
+    load treats every row as changed.
+
+    Args:
+        connection (Connection): Database connection
+        csv (str, optional): Path to the CSV file; defaults to CSV
+        batch_size (int, optional): Number of rows per digest lookup; defaults to HASH_BATCH_SIZE
+
+    Returns:
+        int: Number of new or changed rows
+    """
+    cursor = connection.cursor()
+    batch: dict[str, tuple[int, tuple, tuple]] = {}
+    changed = 0
+
+    try:
+        with open(csv, mode = "r", newline = "", encoding = "utf-8") as file:
+            csv_reader = reader(file, delimiter = ",")
+            parse = row_parser(next(csv_reader))
+
+            for row in csv_reader:
+                subject_row, sample_row = parse(row)
+                batch[sample_row[0]] = (row_digest(subject_row, sample_row), subject_row, sample_row)
+
+                if len(batch) >= batch_size:
+                    changed += upsert_changed(cursor, batch)
+                    batch.clear()
+
+        if batch:
+            changed += upsert_changed(cursor, batch)
+
+        connection.commit()
+
+    except BaseException:
+        connection.rollback()
+        raise
+
+    return changed
+
+def populate_cohort_cube(connection: Connection) -> int:
+    """
+    Rebuild the cohort cube from the 'samples' and 'subjects' tables, so cohort aggregates don't have to scan them
+
+    The cube only has one row per combination of values, so rebuilding it after every load is cheap
+    next to the load itself. Distinct subject counts can't be updated incrementally, hence the rebuild.
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        int: Number of rows in the cube
+    """
+    cursor = connection.cursor()
+
+    cursor.execute(CREATE_COHORT_CUBE)
+    cursor.execute("DELETE FROM cohort_cube")
+    cursor.execute("DELETE FROM cube_pending")
+    cursor.execute(INSERT_COHORT_CUBE.format(where = ""))
+    rows = cursor.rowcount
+
+    connection.commit()
+
+    return rows
+
+def refresh_cohort_cube(connection: Connection) -> int:
+    """
+    Recompute only the cohort cube groups queued in 'cube_pending' by an incremental load (see `upsert_changed`)
+
+    A group is every cube row of one combination of subject columns, so its distinct subject counts are
+    recomputed from its own samples, found through the 'samples' index on subject. Nothing is read when
+    nothing changed. A cube that was never built is built in full.
+
+    Args:
+        connection (Connection): Database connection
+
+    Returns:
+        int: Number of cube rows recomputed
+    """
+    cursor = connection.cursor()
+    cursor.execute(CREATE_COHORT_CUBE)
+
+    if not cursor.execute("SELECT EXISTS(SELECT 1 FROM cohort_cube)").fetchone()[0]:
+        return populate_cohort_cube(connection)
+
+    if not cursor.execute("SELECT EXISTS(SELECT 1 FROM cube_pending)").fetchone()[0]:
+        return 0
+
+    cursor.execute(f"DELETE FROM cohort_cube WHERE EXISTS (SELECT 1 FROM cube_pending p WHERE {CUBE_PENDING_MATCH.format(table = 'cohort_cube')})")
+    cursor.execute(INSERT_COHORT_CUBE.format(where = f"""
+        WHERE t.subject IN (SELECT s.subject FROM subjects s JOIN cube_pending p ON {CUBE_PENDING_MATCH.format(table = 's')})
+    """))
+    rows = cursor.rowcount
+
+    cursor.execute("DELETE FROM cube_pending")
+    connection.commit()
+
+    return rows
+
+def create_indexes(connection: Connection) -> None:
+    """
+    Create the secondary indexes in INDEXES if they don't exist yet
+
+    Args:
+        connection (Connection): Database connection
+    """
+    cursor = connection.cursor()
+
+    for name, columns in INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+
+    connection.commit()
+
+def drop_indexes(connection: Connection) -> None:
+    """
+    Drop the secondary indexes in INDEXES, e.g. before a bulk load
+
+    Args:
+        connection (Connection): Database connection
+    """
+    cursor = connection.cursor()
+
+    for name in INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
 
     connection.commit()
 
-def create_database(connection: Connection) -> None:
+def create_database(connection: Connection, indexes: bool = True) -> None:
     """
     Create SQLite database
     
     Args:
         connection (Connection): Database connection
+        indexes (bool, optional): Whether to create the secondary indexes; defaults to True
     """
     cursor = connection.cursor()
 
@@ -114,7 +805,7 @@ def create_database(connection: Connection) -> None:
             response TEXT
         )
     """)
-    print("Added 'subjects' table to database")
+    logger.info("Added 'subjects' table to database")
 
     # Create 'samples' table
     cursor.execute("""
@@ -131,57 +822,132 @@ def create_database(connection: Connection) -> None:
             FOREIGN KEY (subject) REFERENCES subjects (subject)
         )
     """)
-    print("Added 'samples' table to database")
+    logger.info("Added 'samples' table to database")
 
-    # Create 'summary' table, which will be populated in `stats_analysis.py`
+    # Create 'summary' table, which will be populated in `data_analysis.py`
     # for Part 2: Initial Analysis - Data Overview
+    cursor.execute(CREATE_SUMMARY)
+    logger.info("Added 'summary' table to database")
+
+    # Create 'longitudinal' table, which will also be populated in `data_analysis.py`
+    cursor.execute(CREATE_LONGITUDINAL)
+
+    # Create 'row_hashes' table, which stores the digest of each sample's
+    # CSV row as of the last load in "incremental" mode
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS row_hashes (
+            sample TEXT PRIMARY KEY,
+            digest INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+    # Create 'summary_pending' table, which queues samples whose 'summary'
+    # rows must be recomputed after an incremental load
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS summary_pending (
+            sample TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    """)
+
+    # Create 'cohort_cube' table, which is rebuilt after every load
+    cursor.execute(CREATE_COHORT_CUBE)
+
+    # Create 'cube_pending' table, which queues the cohort cube groups (subject column
+    # values) whose rows must be recomputed after an incremental load
     cursor.execute(f"""
-        CREATE TABLE IF NOT EXISTS summary (
-            id TEXT PRIMARY KEY,
-            sample TEXT,
-            total_count INTEGER,
-            population TEXT,
-            count INTEGER,
-            percentage REAL,
-            FOREIGN KEY (sample) REFERENCES samples (sample)
+        CREATE TABLE IF NOT EXISTS cube_pending (
+            {', '.join(f'{column} TEXT' for column in CUBE_SUBJECT_DIMENSIONS)}
         )
     """)
-    print(f"Added 'summary' table to database")
 
-    # Indexing for faster queries
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_samples_subject ON samples(subject)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_sample ON summary(sample)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_samples_type_time ON samples(sample_type, time_from_treatment_start, subject)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subjects_condition_treatment_response ON subjects(condition, treatment, response)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subjects_sex ON subjects(sex)")
+    # Create 'load_checkpoints' table, which records how far
+    # each CSV file has been loaded in "stream" mode
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS load_checkpoints (
+            csv TEXT PRIMARY KEY,
+            size INTEGER,
+            modified INTEGER,
+            offset INTEGER,
+            rows INTEGER
+        )
+    """)
 
     connection.commit()
 
-def main(database: str = DATABASE, csv: str = CSV) -> None:
+    # Indexing for faster queries
+    if indexes:
+        create_indexes(connection)
+
+def main(database: str = DATABASE, csv: str = CSV, mode: str = "row", workers: int | None = None) -> None:
     """
     Main function for Part 1: Data Management
         1. Create SQLite database
         2. Load data from CSV file into database
+        3. Rebuild the cohort cube (only its changed groups in "incremental" mode)
 
     Args:
         database (str, optional): Name of the SQLite database file; defaults to DATABASE
-        csv (str, optional): Path to the CSV file; defaults to CSV
+        csv (str, optional): Path to the CSV file, or a directory or glob pattern in "parallel" mode; defaults to CSV
+        mode (str, optional): One of LOAD_MODES; "row" validates and inserts one row at a time,
+            "bulk" uses `load_csv_bulk`, "stream" uses `load_csv_stream`, "parallel" uses
+            `load_csv_files` and "incremental" uses `load_csv_incremental`; defaults to "row"
+        workers (int | None, optional): Number of worker processes in "parallel" mode; defaults to the number of CPUs
     """
-    try:
-        with connect(database) as connection:
-            # 1. Create SQLite database
-            print(f"Creating database '{database}'")
-            create_database(connection)
-
-            # 2. Load data from CSV file into database
-            load_csv(connection, csv)
-            print(f"Loaded data from '{csv}' into '{database}'")
-            
-    except Exception as e:
-        print(f"An error occurred in main: {e}")
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Unknown load mode '{mode}', expected one of {LOAD_MODES}")
 
-    finally:
-        connection.close()
+    with run("load_data"):
+        try:
+            with writer(database) as connection:
+                # 1. Create SQLite database
+                logger.info("Creating database '%s'", database)
+                with span("create"):
+                    create_database(connection, indexes = mode in ("row", "stream", "incremental"))
+
+                # 2. Load data from CSV file into database
+                start = perf_counter()
+                with span("load"):
+                    if mode == "bulk":
+                        rows = load_csv_bulk(connection, csv)
+                        logger.info("Bulk loaded %d rows in %.2fs", rows, perf_counter() - start)
+                    elif mode == "stream":
+                        rows = load_csv_stream(connection, csv)
+                        logger.info("Streamed %d rows", rows)
+                    elif mode == "parallel":
+                        rows = load_csv_files(connection, csv, workers)
+                        logger.info("Loaded %d rows in parallel in %.2fs", rows, perf_counter() - start)
+                    elif mode == "incremental":
+                        rows = load_csv_incremental(connection, csv)
+                        logger.info("Upserted %d new or changed rows", rows)
+                    else:
+                        load_csv(connection, csv)
+                        rows = None
+
+                if rows is not None:
+                    count("rows_loaded", rows)
+                if mode in ("row", "bulk", "incremental") and isfile(csv):
+                    count("bytes_read", getsize(csv))
+
+                logger.info("Loaded data from '%s' into '%s'", csv, database)
+
+                # 3. Rebuild the cohort cube from the loaded data, or only its changed groups
+                with span("cube"):
+                    if mode == "incremental":
+                        cubes = refresh_cohort_cube(connection)
+                        logger.info("Refreshed %d cohort cube rows", cubes)
+                    else:
+                        cubes = populate_cohort_cube(connection)
+                        logger.info("Rebuilt cohort cube with %d rows", cubes)
+
+        except Exception as e:
+            logger.error(f"An error occurred in main: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = ArgumentParser(description = "Create the SQLite database and load the CSV file into it")
+    parser.add_argument("--database", default = DATABASE, help = f"SQLite database path (default: {DATABASE})")
+    parser.add_argument("--csv", default = CSV, help = f"CSV file path, or directory or glob pattern in parallel mode (default: {CSV})")
+    parser.add_argument("--mode", default = "row", choices = LOAD_MODES, help = "Load mode (default: row)")
+    parser.add_argument("--workers", type = int, help = "Number of worker processes in parallel mode (default: number of CPUs)")
+    args = parser.parse_args()
+
+    main(args.database, args.csv, args.mode, args.workers)
\ No newline at end of file
@@ -0,0 +1,267 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from math import ceil
+from os import cpu_count
+from time import perf_counter, process_time
+from numpy import ndarray
+from pandas import DataFrame, concat
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import ParameterGrid, StratifiedGroupKFold
+from sklearn.preprocessing import LabelEncoder
+from load_data import CELL_TYPES
+from instrument import count, run, span
+from batch_predict import feature_matrix
+from stats_analysis import HYPERPARAMETERS, trained_model, training_frame
+
+SEARCH_SPACE = {
+    "max_depth": [ 2, 3, 5, 8, None ],
+    "min_samples_leaf": [ 1, 3, 10 ],
+    "max_features": [ "sqrt", None ],
+    "class_weight": [ None, "balanced" ]
+}
+"""Classifier hyperparameter -> values tried; every combination is a candidate"""
+
+N_SPLITS: int = 5
+"""Number of cross-validation folds"""
+
+MIN_ESTIMATORS: int = 25
+"""Number of trees every candidate is first evaluated with"""
+
+MAX_ESTIMATORS: int = 400
+"""Maximum number of trees a candidate is evaluated with"""
+
+FACTOR: int = 3
+"""Each round keeps the best 1/FACTOR of the candidates and gives them FACTOR times more trees"""
+
+RANDOM_STATE: int = HYPERPARAMETERS["random_state"]
+"""Seed of the folds and of every classifier"""
+
+_fold_data: tuple[ndarray, ndarray, list[tuple[ndarray, ndarray]]] | None = None
+"""Features, labels, and (train, test) row positions of each fold, set once per worker by `init_worker`"""
+
+@dataclass(frozen = True)
+class SearchReport:
+    """
+    Outcome of `search`: per-candidate scores, the best hyperparameters, and how well the workers were used
+    """
+    scores: DataFrame
+    """One row per round and candidate: its hyperparameters, number of trees, and cross-validated ROC AUC"""
+
+    best: dict
+    """Hyperparameters of the best candidate of the last round, usable as `trained_model`'s"""
+
+    best_score: float
+    """Mean cross-validated ROC AUC of the best candidate"""
+
+    wall_seconds: float
+    """Elapsed time of the search"""
+
+    cpu_seconds: float
+    """CPU time spent fitting and scoring, summed over the workers"""
+
+    workers: int
+    """Number of worker processes"""
+
+    @property
+    def cpu_utilization(self) -> float:
+        """
+        Fraction of the workers' available CPU time spent fitting and scoring (1 means every worker was always busy)
+        """
+        return self.cpu_seconds / (self.wall_seconds * self.workers) if self.wall_seconds else 0.0
+
+def init_worker(features: ndarray, labels: ndarray, folds: list[tuple[ndarray, ndarray]]) -> None:
+    """
+    Store the data every task of a worker process uses, so it is sent to each worker once instead of with every task
+
+    Args:
+        features (ndarray): Percentage features of every row
+        labels (ndarray): Encoded response of every row
+        folds (list[tuple[ndarray, ndarray]]): (train, test) row positions of each fold
+    """
+    global _fold_data
+    _fold_data = (features, labels, folds)
+
+def evaluate(task: tuple[int, dict, int]) -> tuple[int, int, float, float]:
+    """
+    Fit one candidate on one fold and score it on the fold's held-out subjects; runs in a worker process
+
+    Args:
+        task (tuple[int, dict, int]): Candidate index, its hyperparameters (including n_estimators), and fold index
+
+    Returns:
+        tuple[int, int, float, float]: Candidate index, fold index, ROC AUC, and CPU seconds taken
+    """
+    candidate, hyperparameters, fold = task
+    features, labels, folds = _fold_data
+    train, test = folds[fold]
+    start = process_time()
+
+    classifier = RandomForestClassifier(**hyperparameters, random_state = RANDOM_STATE, n_jobs = 1)
+    classifier.fit(features[train], labels[train])
+    score = roc_auc_score(labels[test], classifier.predict_proba(features[test])[:, 1])
+
+    return candidate, fold, score, process_time() - start
+
+def search(data_frame: DataFrame | None = None, search_space: dict[str, list] = SEARCH_SPACE, n_splits: int = N_SPLITS,
+           min_estimators: int = MIN_ESTIMATORS, max_estimators: int = MAX_ESTIMATORS, factor: int = FACTOR,
+           workers: int | None = None) -> SearchReport:
+    """
+    Tune the response classifier by successive halving over `search_space`, scoring each candidate with
+    cross-validation grouped by subject
+
+    Every candidate is first evaluated with `min_estimators` trees; each round then keeps the best
+    1/`factor` of them and multiplies their number of trees by `factor`, up to `max_estimators`. Folds
+    never split a subject's rows between training and testing, and keep the response balanced. The
+    percentage features are computed once; every (candidate, fold) fit runs as a task in a process pool.
+
+    Args:
+        data_frame (DataFrame | None, optional): Cell counts, subject, and response of every row; defaults to
+            `training_frame()` averaged per subject, the data `trained_model` trains on
+        search_space (dict[str, list], optional): Hyperparameter -> values tried; defaults to SEARCH_SPACE
+        n_splits (int, optional): Number of folds; defaults to N_SPLITS
+        min_estimators (int, optional): Number of trees of the first round; defaults to MIN_ESTIMATORS
+        max_estimators (int, optional): Maximum number of trees; defaults to MAX_ESTIMATORS
+        factor (int, optional): Fraction of candidates dropped and growth of the number of trees per round; defaults to FACTOR
+        workers (int | None, optional): Number of worker processes; 1 runs in this process; defaults to the number of CPUs
+
+    Returns:
+        SearchReport: Scores of every round, best hyperparameters, and timing
+    """
+    if data_frame is None:
+        data_frame = training_frame().groupby([ 'subject', 'response' ], observed = True)[CELL_TYPES].mean().reset_index()
+
+    workers = workers or cpu_count() or 1
+
+    # Features and folds are computed once, then shared by every fit
+    features = feature_matrix(data_frame, CELL_TYPES).to_numpy()
+    labels = LabelEncoder().fit_transform(data_frame['response'])
+    folds = list(StratifiedGroupKFold(n_splits = n_splits, shuffle = True, random_state = RANDOM_STATE)
+                 .split(features, labels, groups = data_frame['subject']))
+
+    candidates = list(ParameterGrid(search_space))
+    remaining = list(range(len(candidates)))
+    n_estimators = min_estimators
+    rounds = []
+    cpu_seconds = 0.0
+    start = perf_counter()
+
+    executor = ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (features, labels, folds)) if workers > 1 else None
+
+    try:
+        if executor is None:
+            init_worker(features, labels, folds)
+
+        while True:
+            tasks = [ (candidate, { **candidates[candidate], "n_estimators": n_estimators }, fold)
+                      for candidate in remaining for fold in range(n_splits) ]
+
+            with span("round"):
+                if executor is None:
+                    results = list(map(evaluate, tasks))
+                else:
+                    results = list(executor.map(evaluate, tasks, chunksize = max(1, len(tasks) // (4 * workers))))
+
+            count("fits", len(tasks))
+
+            scores = DataFrame(results, columns = [ 'candidate', 'fold', 'score', 'cpu_seconds' ])
+            cpu_seconds += scores['cpu_seconds'].sum()
+
+            summary = scores.groupby('candidate').agg(mean_score = ('score', 'mean'), std_score = ('score', 'std'),
+                                                      cpu_seconds = ('cpu_seconds', 'sum'))
+            summary = summary.sort_values([ 'mean_score' ], ascending = False, kind = 'stable')
+            summary.insert(0, 'round', len(rounds))
+            summary.insert(1, 'n_estimators', n_estimators)
+            rounds.append(summary)
+
+            if len(remaining) == 1 or n_estimators >= max_estimators:
+                break
+
+            # The best candidates move on to the next round, with more trees
+            remaining = list(summary.index[:ceil(len(remaining) / factor)])
+            n_estimators = min(n_estimators * factor, max_estimators)
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    wall_seconds = perf_counter() - start
+
+    scores = concat_rounds(rounds, candidates)
+    best = rounds[-1].index[0]
+
+    return SearchReport(
+        scores = scores,
+        best = { **candidates[best], "n_estimators": n_estimators, "random_state": RANDOM_STATE },
+        best_score = float(rounds[-1]['mean_score'].iloc[0]),
+        wall_seconds = wall_seconds,
+        cpu_seconds = cpu_seconds,
+        workers = workers
+    )
+
+def concat_rounds(rounds: list[DataFrame], candidates: list[dict]) -> DataFrame:
+    """
+    Combine the per-round scores of `search` with the candidates' hyperparameters
+
+    Args:
+        rounds (list[DataFrame]): Scores of each round, indexed by candidate
+        candidates (list[dict]): Hyperparameters of each candidate
+
+    Returns:
+        DataFrame: One row per round and candidate, best first within each round
+    """
+    combined = concat(rounds).rename_axis('candidate').reset_index()
+
+    # Object columns keep None (e.g. no maximum depth) and integers as they were given
+    hyperparameters = DataFrame([ candidates[candidate] for candidate in combined['candidate'] ], dtype = object)
+
+    return concat([ combined[[ 'round', 'candidate' ]], hyperparameters,
+                    combined[[ 'n_estimators', 'mean_score', 'std_score', 'cpu_seconds' ]] ], axis = 1)
+
+def main(workers: int | None = None, n_splits: int = N_SPLITS, min_estimators: int = MIN_ESTIMATORS,
+         max_estimators: int = MAX_ESTIMATORS, factor: int = FACTOR, per_sample: bool = False, train: bool = False) -> None:
+    """
+    Run the hyperparameter search and print its scores, best hyperparameters, and CPU utilization
+
+    Args:
+        workers (int | None, optional): Number of worker processes; defaults to the number of CPUs
+        n_splits (int, optional): Number of folds; defaults to N_SPLITS
+        min_estimators (int, optional): Number of trees of the first round; defaults to MIN_ESTIMATORS
+        max_estimators (int, optional): Maximum number of trees; defaults to MAX_ESTIMATORS
+        factor (int, optional): Halving factor; defaults to FACTOR
+        per_sample (bool, optional): Whether to search on every sample instead of the per-subject averages; defaults to False
+        train (bool, optional): Whether to train and save the model with the best hyperparameters; defaults to False
+    """
+    try:
+        data_frame = training_frame() if per_sample else None
+        report = search(data_frame, n_splits = n_splits, min_estimators = min_estimators, max_estimators = max_estimators,
+                        factor = factor, workers = workers)
+
+        print(report.scores.round(4).to_string(index = False))
+        print(f"\nBest hyperparameters: {report.best}")
+        print(f"Best mean ROC AUC: {report.best_score:.4f}")
+        print(f"Wall-clock: {report.wall_seconds:.1f}s, CPU: {report.cpu_seconds:.1f}s over {report.workers} workers "
+              f"({report.cpu_utilization:.0%} utilization)")
+
+        # Trained on the same rows the hyperparameters were tuned on (None: the per-subject averages)
+        if train:
+            artifact, trained = trained_model(data_frame, hyperparameters = report.best)
+            print(f"{'Trained' if trained else 'Loaded'} model {artifact.key}")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Tune the response classifier with grouped cross-validation and successive halving")
+    parser.add_argument("--workers", type = int, default = None, help = "Worker processes (default: number of CPUs)")
+    parser.add_argument("--splits", type = int, default = N_SPLITS, help = f"Cross-validation folds (default: {N_SPLITS})")
+    parser.add_argument("--min-estimators", type = int, default = MIN_ESTIMATORS, help = f"Trees in the first round (default: {MIN_ESTIMATORS})")
+    parser.add_argument("--max-estimators", type = int, default = MAX_ESTIMATORS, help = f"Maximum number of trees (default: {MAX_ESTIMATORS})")
+    parser.add_argument("--factor", type = int, default = FACTOR, help = f"Halving factor (default: {FACTOR})")
+    parser.add_argument("--per-sample", action = "store_true", help = "Search on every sample instead of per-subject averages")
+    parser.add_argument("--train", action = "store_true", help = "Train and save the model with the best hyperparameters, on the rows searched on")
+    args = parser.parse_args()
+
+    with run("model_search"):
+        main(args.workers, args.splits, args.min_estimators, args.max_estimators, args.factor, args.per_sample, args.train)
@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from hashlib import blake2b
+from json import dumps
+from os import getpid, makedirs, replace
+from os.path import exists, join
+from typing import Any
+from joblib import dump, load
+from pandas import DataFrame
+from pandas.util import hash_pandas_object
+from sklearn import __version__ as sklearn_version
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+
+MODEL_DIRECTORY: str = "models"
+"""Directory trained model artifacts are saved to"""
+
+@dataclass(frozen = True)
+class ModelArtifact:
+    """
+    Everything needed to make predictions with a trained model
+    """
+    model: RandomForestClassifier
+    """Trained classifier"""
+
+    encoder: LabelEncoder
+    """Label encoder of the response used during training"""
+
+    feature_columns: list[str]
+    """Cell count columns the model's features are computed from, in order"""
+
+    key: str
+    """Hash of the training data and hyperparameters the model was trained with (see `artifact_key`)"""
+
+def artifact_key(data_frame: DataFrame, hyperparameters: dict[str, Any]) -> str:
+    """
+    Hash a training frame and the hyperparameters of a model trained on it
+
+    The key changes whenever a value, column, or the order of the rows changes, or when the
+    hyperparameters or scikit-learn version do (a model pickled by one version may not load in another).
+
+    Args:
+        data_frame (DataFrame): Training data
+        hyperparameters (dict[str, Any]): Model hyperparameters; must be JSON serializable
+
+    Returns:
+        str: Hexadecimal key
+    """
+    digest = blake2b(digest_size = 16)
+    digest.update(dumps({ "columns": list(map(str, data_frame.columns)), "hyperparameters": hyperparameters,
+                          "sklearn": sklearn_version }, sort_keys = True).encode())
+    digest.update(hash_pandas_object(data_frame, index = False).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+def artifact_path(key: str, directory: str = MODEL_DIRECTORY) -> str:
+    """
+    Get the path of the artifact saved under a key
+
+    Args:
+        key (str): Output of `artifact_key`
+        directory (str, optional): Directory artifacts are saved to; defaults to MODEL_DIRECTORY
+
+    Returns:
+        str: Artifact path
+    """
+    return join(directory, f"{key}.joblib")
+
+def load_artifact(key: str, directory: str = MODEL_DIRECTORY) -> ModelArtifact | None:
+    """
+    Load the artifact saved under a key
+
+    Args:
+        key (str): Output of `artifact_key`
+        directory (str, optional): Directory artifacts are saved to; defaults to MODEL_DIRECTORY
+
+    Returns:
+        ModelArtifact | None: Saved artifact, or None if there is none
+    """
+    path = artifact_path(key, directory)
+
+    return load(path) if exists(path) else None
+
+def save_artifact(artifact: ModelArtifact, directory: str = MODEL_DIRECTORY) -> str:
+    """
+    Save an artifact under its key
+
+    Args:
+        artifact (ModelArtifact): Trained model artifact
+        directory (str, optional): Directory artifacts are saved to; defaults to MODEL_DIRECTORY
+
+    Returns:
+        str: Artifact path
+    """
+    makedirs(directory, exist_ok = True)
+    path = artifact_path(artifact.key, directory)
+
+    # Written to a temporary file and renamed into place atomically, so other processes never load a partial artifact
+    dump(artifact, f"{path}.{getpid()}.tmp")
+    replace(f"{path}.{getpid()}.tmp", path)
+
+    return path
@@ -0,0 +1,152 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from glob import glob
+from gzip import compress, decompress
+from hashlib import blake2b
+from json import dumps, loads
+from os import getpid, makedirs, remove, replace
+from os.path import basename, exists, join
+from typing import Any
+from plotly.utils import PlotlyJSONEncoder
+from database import DATABASE, content_version
+from instrument import count, span
+
+try:
+    from fcntl import LOCK_EX, LOCK_UN, flock
+except ImportError:
+    # Windows has no fcntl; msvcrt locks byte ranges instead
+    flock = None
+    from msvcrt import LK_LOCK, LK_UNLCK, locking
+
+PAYLOAD_DIRECTORY: str = "payloads"
+"""Directory compressed payloads are saved to"""
+
+COMPRESSION_LEVEL: int = 6
+"""gzip compression level of saved payloads"""
+
+LOCK_STRIPES: int = 64
+"""Number of lock files in the payload directory; each payload locks the one its name hashes to, so unrelated payloads
+are computed concurrently while the number of lock files stays fixed"""
+
+def payload_key(value: Any) -> str:
+    """
+    Hash a value into a payload name component that is the same in every process, e.g. a `Cohort`
+
+    Args:
+        value (Any): Value with a deterministic `repr`
+
+    Returns:
+        str: Hexadecimal key
+    """
+    return blake2b(repr(value).encode(), digest_size = 8).hexdigest()
+
+def encode_payload(value: Any) -> bytes:
+    """
+    Serialize a payload as gzip-compressed JSON, encoding figures and arrays the way Dash does
+
+    Args:
+        value (Any): JSON-serializable value, possibly holding Plotly figures and NumPy arrays
+
+    Returns:
+        bytes: Compressed JSON; identical input gives identical bytes
+    """
+    return compress(dumps(value, cls = PlotlyJSONEncoder).encode(), compresslevel = COMPRESSION_LEVEL, mtime = 0)
+
+def decode_payload(data: bytes) -> Any:
+    """
+    Deserialize the output of `encode_payload`
+
+    Args:
+        data (bytes): Compressed JSON
+
+    Returns:
+        Any: Payload
+    """
+    return loads(decompress(data))
+
+@contextmanager
+def exclusive_lock(path: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a file, shared by every process, for the duration of the block
+
+    Args:
+        path (str): Lock file, created if missing
+    """
+    with open(path, mode = "a+b") as file:
+        if flock is not None:
+            flock(file, LOCK_EX)
+        else:
+            # msvcrt gives up after 10 attempts a second apart, so keep trying until the holder is done
+            file.seek(0)
+            while True:
+                try:
+                    locking(file.fileno(), LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+
+        try:
+            yield
+
+        finally:
+            if flock is not None:
+                flock(file, LOCK_UN)
+            else:
+                file.seek(0)
+                locking(file.fileno(), LK_UNLCK, 1)
+
+def cached_payload(name: str, compute: Callable[[], Any], database: str = DATABASE, directory: str = PAYLOAD_DIRECTORY) -> tuple[str, bytes]:
+    """
+    Get a payload computed from the database, compressed, from a disk cache shared by every process
+
+    The payload is computed at most once per `content_version`: while one process computes it, others
+    missing the same payload wait on its lock file and then read its result. Payloads of any other
+    version are deleted once a new one is saved.
+
+    Args:
+        name (str): Payload name, unique among the payloads computed from the database
+        compute (Callable[[], Any]): Function computing the payload on a cache miss
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+        directory (str, optional): Directory payloads are saved to; defaults to PAYLOAD_DIRECTORY
+
+    Returns:
+        tuple[str, bytes]: Version the payload was computed for and the payload compressed by `encode_payload`
+    """
+    version = content_version(database)
+    path = join(directory, f"{name}-{version}.json.gz")
+
+    if exists(path):
+        count("payload_hits")
+        with open(path, mode = "rb") as file:
+            return version, file.read()
+
+    makedirs(directory, exist_ok = True)
+
+    # Only one process computes a missing payload; the others wait for it and read its file
+    with exclusive_lock(join(directory, f"payloads-{int(payload_key(name), 16) % LOCK_STRIPES}.lock")):
+        if exists(path):
+            count("payload_hits")
+            with open(path, mode = "rb") as file:
+                return version, file.read()
+
+        count("payload_misses")
+        with span("payload"):
+            data = encode_payload(compute())
+
+        # Don't save a payload computed from data that changed in the meantime
+        if content_version(database) != version:
+            return version, data
+
+        # Written to a temporary file and renamed into place atomically, so other processes never read a partial payload
+        with open(f"{path}.{getpid()}.tmp", mode = "wb") as file:
+            file.write(data)
+        replace(f"{path}.{getpid()}.tmp", path)
+
+    for stale in glob(join(directory, "*.json.gz")):
+        if not basename(stale).endswith(f"-{version}.json.gz"):
+            try:
+                remove(stale)
+            except FileNotFoundError:
+                pass
+
+    return version, data
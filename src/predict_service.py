@@ -0,0 +1,343 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import JSONDecodeError, dumps, loads
+from math import isfinite
+from numbers import Real
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+from numpy import percentile
+from pandas import DataFrame
+from batch_predict import score_frame
+from model_store import MODEL_DIRECTORY, ModelArtifact, load_artifact
+from stats_analysis import trained_model
+
+HOST: str = "127.0.0.1"
+"""Address the service listens on; local only by default"""
+
+PORT: int = 8000
+"""Port the service listens on"""
+
+MAX_BATCH_SIZE: int = 256
+"""Maximum number of samples scored by one `predict_proba` call"""
+
+MAX_WAIT: float = 0.005
+"""Seconds a batch waits for more samples after the first one arrives"""
+
+LATENCY_WINDOW: int = 10_000
+"""Number of most recent request latencies the percentiles are computed from"""
+
+MAX_BODY_BYTES: int = 8 * 1024 * 1024
+"""Largest request body accepted"""
+
+class Metrics:
+    """
+    Thread-safe request counters and latency percentiles of the service
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        """
+        Args:
+            window (int, optional): Number of most recent latencies kept; defaults to LATENCY_WINDOW
+        """
+        self.lock = Lock()
+        self.started = monotonic()
+        self.latencies: deque[float] = deque(maxlen = window)
+        self.requests = 0
+        self.samples = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_samples = 0
+
+    def record_request(self, latency: float, samples: int) -> None:
+        """
+        Record a successful request
+
+        Args:
+            latency (float): Seconds the request took
+            samples (int): Number of samples it scored
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.samples += samples
+
+    def record_error(self) -> None:
+        """
+        Record a failed request
+        """
+        with self.lock:
+            self.errors += 1
+
+    def record_batch(self, samples: int) -> None:
+        """
+        Record a scored batch
+
+        Args:
+            samples (int): Number of samples in the batch
+        """
+        with self.lock:
+            self.batches += 1
+            self.batched_samples += samples
+
+    def snapshot(self) -> dict:
+        """
+        Get the current counters
+
+        Returns:
+            dict: Request, sample, error and batch counts, p50/p99 latency (ms) of the recent requests,
+                throughput (requests and samples per second since startup) and mean batch size
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+            uptime = monotonic() - self.started
+
+            return {
+                "uptime_seconds": round(uptime, 3),
+                "requests": self.requests,
+                "samples": self.samples,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": round(self.batched_samples / self.batches, 2) if self.batches else None,
+                "latency_p50_ms": round(float(percentile(latencies, 50)) * 1000, 3) if latencies else None,
+                "latency_p99_ms": round(float(percentile(latencies, 99)) * 1000, 3) if latencies else None,
+                "requests_per_second": round(self.requests / uptime, 2) if uptime else None,
+                "samples_per_second": round(self.samples / uptime, 2) if uptime else None
+            }
+
+class MicroBatcher:
+    """
+    Collects samples submitted by concurrent requests and scores them together
+
+    A single worker thread takes the first waiting sample, keeps collecting for up to `max_wait` seconds
+    or `max_batch_size` samples, then scores the whole batch with one `predict_proba` call and hands each
+    request its own results. Under load, batches fill up immediately; when idle, a request waits at most
+    `max_wait` seconds.
+    """
+
+    def __init__(self, artifact: ModelArtifact, metrics: Metrics, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT) -> None:
+        """
+        Args:
+            artifact (ModelArtifact): Trained model artifact
+            metrics (Metrics): Counters batches are recorded in
+            max_batch_size (int, optional): Maximum number of samples per batch; defaults to MAX_BATCH_SIZE
+            max_wait (float, optional): Seconds a batch waits for more samples; defaults to MAX_WAIT
+        """
+        self.artifact = artifact
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: Queue[tuple[dict, Future]] = Queue()
+        self.worker = Thread(target = self.run, name = "micro-batcher", daemon = True)
+        self.worker.start()
+
+    def submit(self, samples: list[dict]) -> list[dict]:
+        """
+        Score samples along with those of any concurrent requests
+
+        Args:
+            samples (list[dict]): Cell counts of each sample
+
+        Returns:
+            list[dict]: Prediction, confidence, and probabilities (as in `predict_new_sample`) of each sample
+        """
+        futures = []
+
+        for sample in samples:
+            future = Future()
+            self.queue.put((sample, future))
+            futures.append(future)
+
+        return [ future.result() for future in futures ]
+
+    def run(self) -> None:
+        """
+        Score batches of queued samples until the process exits
+        """
+        while True:
+            batch = [ self.queue.get() ]
+            deadline = monotonic() + self.max_wait
+
+            # Keep collecting until the batch is full or the first sample has waited long enough
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout = max(deadline - monotonic(), 0)))
+                except Empty:
+                    break
+
+            try:
+                scores = score_frame(self.artifact.model, self.artifact.encoder, self.artifact.feature_columns,
+                                     DataFrame([ sample for sample, _ in batch ]), id_column = None)
+                self.metrics.record_batch(len(batch))
+
+                for (_, future), result in zip(batch, scores.to_dict("records")):
+                    future.set_result(result)
+
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+def validate_samples(body: object, feature_columns: list[str]) -> list[dict]:
+    """
+    Check a /predict request body
+
+    Args:
+        body (object): Decoded JSON body; one sample (cell population -> count) or a list of samples
+        feature_columns (list[str]): Cell count columns every sample must have
+
+    Raises:
+        ValueError: If the body isn't one or more samples with a finite, non-negative count for every cell population
+
+    Returns:
+        list[dict]: Samples, restricted to `feature_columns`
+    """
+    samples = body if isinstance(body, list) else [ body ]
+
+    if not samples:
+        raise ValueError("Expected at least one sample")
+
+    for sample in samples:
+        if not isinstance(sample, dict):
+            raise ValueError("Each sample must be an object mapping cell populations to counts")
+
+        if missing := [ column for column in feature_columns if column not in sample ]:
+            raise ValueError(f"Missing cell counts: {', '.join(missing)}")
+
+        # json.loads accepts NaN and Infinity, which would pass a plain comparison
+        if any(isinstance(sample[column], bool) or not isinstance(sample[column], Real) or not isfinite(sample[column]) or sample[column] < 0
+               for column in feature_columns):
+            raise ValueError("Cell counts must be finite, non-negative numbers")
+
+        if sum(sample[column] for column in feature_columns) <= 0:
+            raise ValueError("A sample must contain at least one cell")
+
+    return [ { column: sample[column] for column in feature_columns } for sample in samples ]
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    Routes: POST /predict, GET /metrics, GET /healthz
+    """
+    server: "PredictionServer"
+
+    def send_json(self, status: int, payload: object) -> None:
+        """
+        Send a JSON response
+
+        Args:
+            status (int): HTTP status code
+            payload (object): JSON serializable response body
+        """
+        body = dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        """
+        Serve the health check and metrics
+        """
+        if self.path == "/healthz":
+            self.send_json(200, { "status": "ok", "model": self.server.artifact.key })
+        elif self.path == "/metrics":
+            self.send_json(200, self.server.metrics.snapshot())
+        else:
+            self.send_json(404, { "error": f"Unknown path: {self.path}" })
+
+    def do_POST(self) -> None:
+        """
+        Serve predictions for one sample or a list of samples
+        """
+        if self.path != "/predict":
+            self.send_json(404, { "error": f"Unknown path: {self.path}" })
+            return
+
+        start = perf_counter()
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_BYTES:
+                raise ValueError(f"Request body is larger than {MAX_BODY_BYTES} bytes")
+
+            samples = validate_samples(loads(self.rfile.read(length)), self.server.artifact.feature_columns)
+        except (ValueError, JSONDecodeError) as e:
+            self.server.metrics.record_error()
+            self.send_json(400, { "error": str(e) })
+            return
+
+        try:
+            predictions = self.server.batcher.submit(samples)
+        except Exception as e:
+            self.server.metrics.record_error()
+            self.send_json(500, { "error": str(e) })
+            return
+
+        self.server.metrics.record_request(perf_counter() - start, len(samples))
+        self.send_json(200, { "model": self.server.artifact.key, "predictions": predictions })
+
+    def log_message(self, format: str, *args) -> None:
+        # Per-request logging would dominate the cost of small requests
+        pass
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the model, loaded once, along with its batcher and metrics
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], artifact: ModelArtifact, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT) -> None:
+        """
+        Args:
+            address (tuple[str, int]): Host and port to listen on; port 0 picks a free one
+            artifact (ModelArtifact): Trained model artifact
+            max_batch_size (int, optional): Maximum number of samples per batch; defaults to MAX_BATCH_SIZE
+            max_wait (float, optional): Seconds a batch waits for more samples; defaults to MAX_WAIT
+        """
+        super().__init__(address, PredictionHandler)
+        self.artifact = artifact
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(artifact, self.metrics, max_batch_size, max_wait)
+
+def main(host: str = HOST, port: int = PORT, model_key: str | None = None, model_directory: str = MODEL_DIRECTORY,
+         max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT) -> None:
+    """
+    Serve response predictions over HTTP until interrupted
+
+    Args:
+        host (str, optional): Address to listen on; defaults to HOST
+        port (int, optional): Port to listen on; defaults to PORT
+        model_key (str | None, optional): Key of a saved model artifact; defaults to the model trained on the current data
+        model_directory (str, optional): Directory model artifacts are saved to; defaults to MODEL_DIRECTORY
+        max_batch_size (int, optional): Maximum number of samples per batch; defaults to MAX_BATCH_SIZE
+        max_wait (float, optional): Seconds a batch waits for more samples; defaults to MAX_WAIT
+    """
+    try:
+        if model_key is None:
+            artifact, _ = trained_model(directory = model_directory)
+        elif (artifact := load_artifact(model_key, model_directory)) is None:
+            raise FileNotFoundError(f"No model artifact '{model_key}' in '{model_directory}'")
+
+        with PredictionServer((host, port), artifact, max_batch_size, max_wait) as server:
+            print(f"Serving model {artifact.key} on http://{host}:{server.server_address[1]}")
+            server.serve_forever()
+
+    except KeyboardInterrupt:
+        print("Stopped")
+
+    except Exception as e:
+        print(f"An error occurred in main: {e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Serve treatment response predictions over HTTP")
+    parser.add_argument("--host", default = HOST, help = f"Address to listen on (default: {HOST})")
+    parser.add_argument("--port", type = int, default = PORT, help = f"Port to listen on (default: {PORT})")
+    parser.add_argument("--model", help = "Key of a saved model artifact (default: model trained on the current data)")
+    parser.add_argument("--model-directory", default = MODEL_DIRECTORY, help = f"Model artifact directory (default: {MODEL_DIRECTORY})")
+    parser.add_argument("--max-batch-size", type = int, default = MAX_BATCH_SIZE, help = f"Samples per prediction batch (default: {MAX_BATCH_SIZE})")
+    parser.add_argument("--max-wait", type = float, default = MAX_WAIT, help = f"Seconds a batch waits for more samples (default: {MAX_WAIT})")
+    args = parser.parse_args()
+
+    main(args.host, args.port, args.model, args.model_directory, args.max_batch_size, args.max_wait)
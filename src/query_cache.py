@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from functools import wraps
+from os import stat
+from os.path import abspath
+from sqlite3 import Connection, Error
+from threading import Lock
+from typing import Any
+from database import DATABASE, open_reader
+
+CACHE_SIZE: int = 32
+"""Default maximum number of results kept by each cache"""
+
+_monitors: dict[str, tuple[int, Connection]] = {}
+"""Database path -> (inode, connection) used to poll 'PRAGMA data_version'"""
+
+_monitors_lock = Lock()
+"""Guards `_monitors`, which is shared by every thread"""
+
+def database_version(database: str = DATABASE) -> tuple:
+    """
+    Get a token that changes whenever the database's contents may have changed
+
+    The token combines the modification time and size of the database file and its write-ahead log
+    with 'PRAGMA data_version', which changes whenever another connection (in this or any other
+    process) commits. Stat alone can miss writes within the file system's timestamp resolution, and
+    'data_version' alone can't tell that the file was deleted and recreated, hence both.
+
+    Args:
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Returns:
+        tuple: Version token; only meaningful when compared for equality
+    """
+    path = abspath(database)
+
+    try:
+        file_stat = stat(path)
+    except FileNotFoundError:
+        return (path, None)
+
+    try:
+        wal_stat = stat(f"{path}-wal")
+        wal = (wal_stat.st_mtime_ns, wal_stat.st_size)
+    except FileNotFoundError:
+        wal = None
+
+    with _monitors_lock:
+        inode, monitor = _monitors.get(path, (None, None))
+
+        # (Re)open the monitoring connection if the file was replaced since it was opened
+        if inode != file_stat.st_ino:
+            if monitor is not None:
+                monitor.close()
+
+            monitor = open_reader(path, check_same_thread = False)
+            _monitors[path] = (file_stat.st_ino, monitor)
+
+        try:
+            data_version = monitor.execute("PRAGMA data_version").fetchone()[0]
+        except Error:
+            data_version = None
+
+    return (path, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size, wal, data_version)
+
+class QueryCache:
+    """
+    Least-recently-used cache of query results that empties itself when the database changes
+
+    Every lookup compares the current `database_version` with the one the cached results were
+    computed for, so results are reused until the data actually changes. Concurrent lookups of the
+    same missing key wait for a single computation instead of repeating it. Cached values are shared
+    between callers and must be treated as read-only.
+    """
+
+    def __init__(self, maxsize: int = CACHE_SIZE, database: str = DATABASE) -> None:
+        """
+        Args:
+            maxsize (int, optional): Maximum number of results kept; defaults to CACHE_SIZE
+            database (str, optional): Path to the SQLite database file; defaults to DATABASE
+        """
+        self.maxsize = maxsize
+        self.database = database
+        self.version: tuple | None = None
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.lock = Lock()
+        self.computing: dict[Hashable, Lock] = {}
+
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Get the cached result for a key, computing and caching it if needed
+
+        Args:
+            key (Hashable): Cache key
+            compute (Callable[[], Any]): Function computing the result on a cache miss
+
+        Returns:
+            Any: Cached or freshly computed result
+        """
+        version = database_version(self.database)
+
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            key_lock = self.computing.setdefault(key, Lock())
+
+        # Only one caller computes a missing key; the others wait for it and reuse its result
+        with key_lock:
+            with self.lock:
+                if version == self.version and key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+
+            try:
+                value = compute()
+
+                with self.lock:
+                    # Don't cache a result computed from data that changed in the meantime
+                    if version == self.version:
+                        self.entries[key] = value
+
+                        if len(self.entries) > self.maxsize:
+                            self.entries.popitem(last = False)
+            finally:
+                with self.lock:
+                    if self.computing.get(key) is key_lock:
+                        del self.computing[key]
+
+        return value
+
+    def clear(self) -> None:
+        """
+        Remove all cached results
+        """
+        with self.lock:
+            self.entries.clear()
+
+def cached_query(maxsize: int = CACHE_SIZE, database: str = DATABASE) -> Callable[[Callable], Callable]:
+    """
+    Decorator memoizing a function of the database's contents in a `QueryCache`,
+    keyed by the function's (hashable) arguments
+
+    Args:
+        maxsize (int, optional): Maximum number of results kept; defaults to CACHE_SIZE
+        database (str, optional): Path to the SQLite database file; defaults to DATABASE
+
+    Returns:
+        Callable[[Callable], Callable]: Decorator; the decorated function's cache is available as its `cache` attribute
+    """
+    def decorator(function: Callable) -> Callable:
+        cache = QueryCache(maxsize, database)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs) -> Any:
+            return cache.get((args, tuple(sorted(kwargs.items()))), lambda: function(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -1,148 +1,530 @@
-from pandas import DataFrame, read_sql_query
-from scipy.stats import mannwhitneyu
-from sqlite3 import connect
-from data_analysis import DATABASE
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from numpy import arange, array, bincount, concatenate, isnan, nanmedian, ndarray, percentile, searchsorted, sort, where, zeros
+from numpy.random import Generator, default_rng
+from pandas import DataFrame, MultiIndex, concat, read_sql_query
+from scipy.stats import false_discovery_control, mannwhitneyu
+from database import DATABASE, reader
 from load_data import CELL_TYPES
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.preprocessing import LabelEncoder
+from query_cache import cached_query
+from instrument import count, run, span
+from cohort import Cohort, cohort_frequencies
+from model_store import MODEL_DIRECTORY, ModelArtifact, artifact_key, load_artifact, save_artifact
+from dataset import FILTERED, RESPONDED, dataset
 
-connection = connect(DATABASE)
-
-# Summary table
-DATA_FRAME_SUMMARY = read_sql_query(
-    f"""SELECT sample, population AS 'Cell Population', count, total_count AS 'Total Count', percentage AS 'Relative Frequency (%)'
-        FROM summary
-    """, connection
-)
-
-# Population relative frequencies comparing responders
-# versus non-responders using a boxplot for each
-# immune cell population
-RESP_FREQ_DF = read_sql_query(
-    f"""SELECT s.population, s.percentage, subj.response, t.subject
-        FROM summary s
-        JOIN samples t ON s.sample = t.sample
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE subj.response IN ('yes', 'no')
-    """, connection
-)
-
-# Population relative frequencies comparing responders
-# versus non-responders using a boxplot for each
-# immune cell population
-DATA_FRAME_FILTERED_BOXPLOT = read_sql_query(
-    f"""SELECT s.population, s.percentage, subj.response, t.subject
-        FROM summary s
-        JOIN samples t ON s.sample = t.sample
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE subj.response IN ('yes', 'no')
-        AND t.sample_type = 'PBMC'
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-    """, connection
-)
-
-# Compare the differences in cell population relative frequencies of
-# melanoma patients receiving miraclib who respond (responders)
-# versus those who do not (non-responders), with the overarching
-# aim of predicting response to the treatment miraclib.
-# 
-# Response information can be found in column "response",
-# with value "yes" for responding and value "no" for non-responding.
-# Please only include PBMC samples.
-DATA_FRAME2 = read_sql_query(
-    f"""SELECT DISTINCT 
-            t.sample, 
-            t.b_cell, 
-            t.cd8_t_cell, 
-            t.cd4_t_cell, 
-            t.nk_cell, 
-            t.monocyte,
-            t.subject, 
-            subj.response
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.sample_type = 'PBMC'
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-        AND subj.response IN ('yes', 'no')
-    """, connection
-)
-
-connection.close()
+def read_query(query: str) -> DataFrame:
+    """
+    Run a query on the database and return its result
+
+    Args:
+        query (str): SQL query
+
+    Returns:
+        DataFrame: Query result
+    """
+    with span("query"):
+        result = read_sql_query(query, reader(DATABASE))
+
+    count("rows_queried", len(result))
+    return result
+
+@cached_query()
+def summary_frame() -> DataFrame:
+    """
+    Summary table
+
+    Returns:
+        DataFrame: One row per sample and cell population, with display column names
+    """
+    return dataset().frequencies(columns = ("sample", "population", "count", "total_count", "percentage")).rename(columns = {
+        "population": "Cell Population", "total_count": "Total Count", "percentage": "Relative Frequency (%)"
+    })
+
+@cached_query()
+def response_frequencies() -> DataFrame:
+    """
+    Population relative frequencies comparing responders
+    versus non-responders using a boxplot for each
+    immune cell population
+
+    Returns:
+        DataFrame: Population, percentage, response, and subject of every sample with a response
+    """
+    data = dataset()
+    return data.frequencies(data.mask(RESPONDED))
+
+@cached_query()
+def filtered_frequencies() -> DataFrame:
+    """
+    Population relative frequencies comparing responders
+    versus non-responders using a boxplot for each
+    immune cell population, for melanoma patients
+    receiving miraclib with PBMC samples
+
+    Returns:
+        DataFrame: Population, percentage, response, and subject of every matching sample
+    """
+    data = dataset()
+    return data.frequencies(data.mask(FILTERED))
+
+@cached_query()
+def training_frame() -> DataFrame:
+    """
+    Compare the differences in cell population relative frequencies of
+    melanoma patients receiving miraclib who respond (responders)
+    versus those who do not (non-responders), with the overarching
+    aim of predicting response to the treatment miraclib.
+
+    Response information can be found in column "response",
+    with value "yes" for responding and value "no" for non-responding.
+    Please only include PBMC samples.
+
+    Returns:
+        DataFrame: Cell counts, subject, and response of every matching sample
+    """
+    data = dataset()
+    return data.samples(data.mask(FILTERED), ("sample", *CELL_TYPES, "subject", "response"))
+
+@cached_query()
+def longitudinal_frame() -> DataFrame:
+    """
+    Longitudinal table, i.e. every sample's cell population frequencies relative to its subject's baseline
+
+    Returns:
+        DataFrame: One row per sample and cell population, with its subject's response
+    """
+    return read_query(
+        """SELECT l.*, subj.response
+            FROM longitudinal l
+            JOIN subjects subj ON l.subject = subj.subject
+        """
+    )
+
+def trajectory_features(data_frame: DataFrame | None = None, value: str = "percentage_fold_change") -> DataFrame:
+    """
+    Reshape longitudinal rows into one row of features per subject and sample type, for time-course models
+
+    Args:
+        data_frame (DataFrame | None, optional): Rows of the longitudinal table; defaults to `longitudinal_frame()`
+        value (str, optional): Longitudinal column used as the features; defaults to "percentage_fold_change"
+
+    Returns:
+        DataFrame: Indexed by subject and sample type, with one "<population>_t<time>" column per cell
+            population and time point (NaN where the subject has no sample)
+    """
+    if data_frame is None:
+        data_frame = longitudinal_frame()
+
+    features = data_frame.pivot_table(
+        index = [ "subject", "sample_type" ],
+        columns = [ "population", "time_from_treatment_start" ],
+        values = value
+    )
+    features.columns = [ f"{population}_t{time}" for population, time in features.columns ]
+
+    return features
 
 ALPHA = 0.05
 
-def compare_populations(input_df: DataFrame = DATA_FRAME_FILTERED_BOXPLOT) -> DataFrame:
+CONFIDENCE_LEVEL = 0.95
+"""Confidence level of the bootstrap confidence intervals"""
+
+STRATA = [ "condition", "treatment", "sample_type", "time_from_treatment_start" ]
+"""Columns `sweep_strata` stratifies cohorts by"""
+
+MIN_SUBJECTS: int = 3
+"""Minimum number of subjects per response group for `sweep_strata` to test a stratum"""
+
+HYPERPARAMETERS = { "n_estimators": 100, "random_state": 42, "max_depth": 3 }
+"""Hyperparameters of the response classifier"""
+
+RESAMPLE_ELEMENTS: int = 2_000_000
+"""Approximate number of values resampled at once when bootstrapping, which bounds its memory use"""
+
+def order_statistic(counts: ndarray, values: ndarray, k: int) -> ndarray:
     """
-    Compare cell populations between responders and non-responders
-    by first averaging samples within each subject to handle repeated measures.
+    Get the k-th smallest value (0-based) of resamples given as counts of each sorted value
+
+    Args:
+        counts (ndarray): Number of times each value was drawn (resamples x values)
+        values (ndarray): Sorted values
+        k (int): Rank of the value to get
+
+    Returns:
+        ndarray: k-th smallest value of each resample
+    """
+    return values[(counts.cumsum(axis = 1) > k).argmax(axis = 1)]
+
+def resample_counts(rng: Generator, n: int, size: int) -> ndarray:
+    """
+    Draw `size` resamples of `n` values with replacement, as counts of how often each value was drawn
+
+    Args:
+        rng (Generator): Random number generator
+        n (int): Number of values
+        size (int): Number of resamples
+
+    Returns:
+        ndarray: Counts (resamples x values); each row sums to `n`
+    """
+    draws = rng.integers(0, n, (size, n)) + arange(size)[:, None] * n
+    return bincount(draws.ravel(), minlength = size * n).reshape(size, n)
+
+def bootstrap_population(yes: ndarray, no: ndarray, n_resamples: int, rng: Generator) -> tuple[ndarray, ndarray]:
+    """
+    Draw bootstrap resamples of one cell population and compute their median difference and rank-biserial correlation
+
+    Resampling with replacement from sorted values is represented by counts of each value,
+    so medians and U statistics come from cumulative sums instead of sorting or ranking every resample:
+    a responder value beats the non-responder values below it (and ties half of those equal to it),
+    whose resampled counts are read off the cumulative counts at fixed, precomputed positions.
+
+    Args:
+        yes (ndarray): Responders' subject-level percentages
+        no (ndarray): Non-responders' subject-level percentages
+        n_resamples (int): Number of bootstrap resamples
+        rng (Generator): Random number generator
+
+    Returns:
+        tuple[ndarray, ndarray]: Median difference and effect size of each resample
+    """
+    yes, no = sort(yes), sort(no)
+    n_yes, n_no = len(yes), len(no)
+
+    # Cumulative non-responder counts up to (excluding / including) each responder value
+    below = searchsorted(no, yes, side = "left")
+    up_to = searchsorted(no, yes, side = "right")
+
+    chunk = max(1, RESAMPLE_ELEMENTS // (n_yes + n_no))
+    differences, effects = [], []
+
+    for start in range(0, n_resamples, chunk):
+        size = min(chunk, n_resamples - start)
+        yes_counts = resample_counts(rng, n_yes, size)
+        no_counts = resample_counts(rng, n_no, size)
+
+        median_yes = (order_statistic(yes_counts, yes, (n_yes - 1) // 2) + order_statistic(yes_counts, yes, n_yes // 2)) / 2
+        median_no = (order_statistic(no_counts, no, (n_no - 1) // 2) + order_statistic(no_counts, no, n_no // 2)) / 2
+        differences.append(median_yes - median_no)
+
+        cumulative = concatenate([ zeros((size, 1), dtype = no_counts.dtype), no_counts.cumsum(axis = 1) ], axis = 1)
+        wins = cumulative[:, below] + (cumulative[:, up_to] - cumulative[:, below]) / 2
+        u_statistic = (yes_counts * wins).sum(axis = 1)
+        effects.append(1 - (2 * u_statistic) / (n_yes * n_no))
+
+    return concatenate(differences), concatenate(effects)
+
+def bootstrap_intervals(yes: ndarray, no: ndarray, n_resamples: int, confidence_level: float = CONFIDENCE_LEVEL,
+                        random_state: int | None = None) -> tuple[ndarray, ndarray]:
+    """
+    Bootstrap percentile confidence intervals of the median difference and rank-biserial correlation
+    between responders and non-responders, for every cell population
+
+    Subjects are resampled with replacement within each response group (see `bootstrap_population`).
+    Resamples are evaluated as arrays in chunks of about RESAMPLE_ELEMENTS values, so thousands of
+    resamples take no Python loop per resample.
+
+    Args:
+        yes (ndarray): Responders' subject-level percentages (subjects x populations; NaN if missing)
+        no (ndarray): Non-responders' subject-level percentages (subjects x populations; NaN if missing)
+        n_resamples (int): Number of bootstrap resamples
+        confidence_level (float, optional): Confidence level of the intervals; defaults to CONFIDENCE_LEVEL
+        random_state (int | None, optional): Seed for reproducible resampling; defaults to None
+
+    Returns:
+        tuple[ndarray, ndarray]: Lower and upper bounds (2 x populations) of the median difference and of the effect size
+    """
+    rng = default_rng(random_state)
+    tail = (1 - confidence_level) / 2 * 100
+    differences, effects = [], []
+
+    for column in range(yes.shape[1]):
+        difference, effect = bootstrap_population(yes[~isnan(yes[:, column]), column], no[~isnan(no[:, column]), column], n_resamples, rng)
+        differences.append(percentile(difference, [ tail, 100 - tail ]))
+        effects.append(percentile(effect, [ tail, 100 - tail ]))
+
+    return array(differences).T, array(effects).T
+
+def population_statistics(input_df: DataFrame, n_resamples: int = 0, confidence_level: float = CONFIDENCE_LEVEL,
+                          random_state: int | None = None) -> DataFrame:
+    """
+    Compute unrounded Mann-Whitney U test statistics between responders and non-responders
+    for every cell population in one vectorized pass (see `compare_populations`)
 
     Args:
         input_df (DataFrame): Input DataFrame with subject, population, response, and percentage columns
+        n_resamples (int, optional): Number of bootstrap resamples for confidence intervals; 0 skips them; defaults to 0
+        confidence_level (float, optional): Confidence level of the intervals; defaults to CONFIDENCE_LEVEL
+        random_state (int | None, optional): Seed for reproducible resampling; defaults to None
 
     Returns:
-        DataFrame: Comparison results for each cell population
+        DataFrame: One row per population with its medians, median difference, U statistic, p-value,
+            effect size, group sizes, and (if `n_resamples` > 0) confidence interval bounds
     """
     # Average the percentages for each subject within each population
-    # This collapses multiple samples per subject down to one value per subject
-    df_averaged = input_df.groupby([ 'subject', 'population', 'response' ], as_index = False)['percentage'].mean()
-    
-    populations = df_averaged['population'].unique()
-    results = []
+    # This collapses multiple samples per subject down to one value per subject,
+    # then pivots to one (subjects x populations) matrix per response status
+    averaged = input_df.groupby([ 'response', 'subject', 'population' ], observed = True)['percentage'].mean().unstack('population')
+    populations = averaged.columns
+    groups = set(averaged.index.get_level_values('response'))
+
+    # Without both responders and non-responders there is nothing to compare, so every statistic is NaN
+    if not { 'yes', 'no' } <= groups:
+        intervals = [ 'median_diff_low', 'median_diff_high', 'rank_biserial_low', 'rank_biserial_high' ] if n_resamples > 0 else []
+        statistics = DataFrame({ 'population': populations }).reindex(columns = [
+            'population', 'median_yes', 'median_no', 'median_diff', 'u_statistic', 'p_value', 'rank_biserial', 'n_yes', 'n_no', *intervals
+        ])
+        subjects = averaged.notna().groupby(level = 'response', observed = True).sum()
+
+        for group in ('yes', 'no'):
+            statistics[f'n_{group}'] = subjects.loc[group].to_numpy() if group in groups else 0
+
+        return statistics
+
+    yes = averaged.xs('yes', level = 'response').to_numpy(dtype = float)
+    no = averaged.xs('no', level = 'response').to_numpy(dtype = float)
+    missing = isnan(yes).any() or isnan(no).any()
+
+    # Perform Mann-Whitney U test on subject-level averages, for all populations at once
+    u_statistic, p_val = mannwhitneyu(yes, no, alternative = 'two-sided', axis = 0, nan_policy = 'omit' if missing else 'propagate')
+
+    # Calculate effect size
+    n_yes = (~isnan(yes)).sum(axis = 0)
+    n_no = (~isnan(no)).sum(axis = 0)
+
+    statistics = DataFrame({
+        'population': populations,
+        'median_yes': nanmedian(yes, axis = 0),
+        'median_no': nanmedian(no, axis = 0),
+        'u_statistic': u_statistic,
+        'p_value': p_val,
+        'rank_biserial': 1 - (2 * u_statistic) / (n_yes * n_no),
+        'n_yes': n_yes,
+        'n_no': n_no
+    })
+    statistics.insert(3, 'median_diff', statistics['median_yes'] - statistics['median_no'])
+
+    if n_resamples > 0:
+        (diff_low, diff_high), (effect_low, effect_high) = bootstrap_intervals(yes, no, n_resamples, confidence_level, random_state)
+        statistics['median_diff_low'], statistics['median_diff_high'] = diff_low, diff_high
+        statistics['rank_biserial_low'], statistics['rank_biserial_high'] = effect_low, effect_high
+
+    return statistics
+
+def format_comparison(statistics: DataFrame, alpha: float = ALPHA) -> DataFrame:
+    """
+    Turn `population_statistics` results into the rounded, labelled table shown to users
+
+    Args:
+        statistics (DataFrame): Output of `population_statistics`
+        alpha (float, optional): Significance level; defaults to ALPHA
+
+    Returns:
+        DataFrame: Comparison results for each cell population
+    """
+    # Determine significance
+    bonferroni_threshold = alpha / len(statistics)
+
+    results_df = DataFrame({
+        'Cell Population': statistics['population'],
+        'Median Frequency for Responders (%)': statistics['median_yes'].round(2),
+        'Median Frequency for Non-Responders (%)': statistics['median_no'].round(2),
+        'Difference Between Responder and Non-Responder Medians (%)': statistics['median_diff'].round(2),
+        'P-Value': statistics['p_value'].round(5),
+        'Significant Difference': where(statistics['p_value'] < alpha, "Yes", "No"),
+        'Significant Difference (Bonferroni)': where(statistics['p_value'] < bonferroni_threshold, "Yes", "No"),
+        'Effect Size (r)': statistics['rank_biserial'].round(2)
+    })
+
+    if 'median_diff_low' in statistics:
+        results_df['Median Difference CI Lower (%)'] = statistics['median_diff_low'].round(2)
+        results_df['Median Difference CI Upper (%)'] = statistics['median_diff_high'].round(2)
+        results_df['Effect Size CI Lower'] = statistics['rank_biserial_low'].round(2)
+        results_df['Effect Size CI Upper'] = statistics['rank_biserial_high'].round(2)
 
-    bonferroni_threshold = ALPHA / len(populations)
-    
-    for pop in populations:
-        # Filter for this specific cell population
-        df_pop = df_averaged[df_averaged['population'] == pop]
-        
-        # Separate by response status
-        # Now each value represents one subject's average
-        yes = df_pop[df_pop['response'] == 'yes']['percentage']
-        no = df_pop[df_pop['response'] == 'no']['percentage']
-        
-        # Perform Mann-Whitney U test on subject-level averages
-        u_statistic, p_val = mannwhitneyu(yes, no, alternative = 'two-sided')
-        
-        # Calculate descriptive statistics
-        median_yes = yes.median()
-        median_no = no.median()
-        median_diff = median_yes - median_no
-        
-        # Calculate effect size
-        n_yes = len(yes)
-        n_no = len(no)
-        rank_biserial = 1 - (2 * u_statistic) / (n_yes * n_no)
-        
-        # Determine significance
-        significant_uncorrected = "Yes" if p_val < ALPHA else "No"
-        significant_bonferroni = "Yes" if p_val < bonferroni_threshold else "No"
-        
-        results.append({
-            'Cell Population': pop,
-            'Median Frequency for Responders (%)': round(median_yes, 2),
-            'Median Frequency for Non-Responders (%)': round(median_no, 2),
-            'Difference Between Responder and Non-Responder Medians (%)': round(median_diff, 2),
-            'P-Value': round(p_val, 5),
-            'Significant Difference': significant_uncorrected,
-            'Significant Difference (Bonferroni)': significant_bonferroni,
-            'Effect Size (r)': round(rank_biserial, 2)
-        })
-
-    results_df = DataFrame(results)
-    
     return results_df
 
-COMPARISON = compare_populations(RESP_FREQ_DF)
-COMPARISON_FILTER = compare_populations(DATA_FRAME_FILTERED_BOXPLOT)
+def compare_populations(input_df: DataFrame | None = None, n_resamples: int = 0, confidence_level: float = CONFIDENCE_LEVEL,
+                        random_state: int | None = None) -> DataFrame:
+    """
+    Compare cell populations between responders and non-responders
+    by first averaging samples within each subject to handle repeated measures.
 
-def train_and_evaluate_model(data_frame: DataFrame) -> tuple[RandomForestClassifier, LabelEncoder]:
+    Args:
+        input_df (DataFrame | None, optional): Input DataFrame with subject, population, response, and percentage columns;
+            defaults to `filtered_frequencies()`
+        n_resamples (int, optional): Number of bootstrap resamples for confidence intervals of the median difference
+            and effect size; 0 skips them; defaults to 0
+        confidence_level (float, optional): Confidence level of the intervals; defaults to CONFIDENCE_LEVEL
+        random_state (int | None, optional): Seed for reproducible resampling; defaults to None
+
+    Returns:
+        DataFrame: Comparison results for each cell population
+    """
+    if input_df is None:
+        input_df = filtered_frequencies()
+
+    with span("compare"):
+        return format_comparison(population_statistics(input_df, n_resamples, confidence_level, random_state))
+
+@cached_query()
+def stratified_frequencies() -> DataFrame:
+    """
+    Population relative frequencies of every sample with a response,
+    along with the columns its cohort can be stratified by (see STRATA)
+
+    Returns:
+        DataFrame: Population, percentage, response, subject, and stratum columns of every sample with a response
+    """
+    data = dataset()
+    return data.frequencies(data.mask(RESPONDED), ("population", "percentage", "response", "subject", *STRATA))
+
+def stratum_statistics(stratum: tuple[tuple, DataFrame]) -> DataFrame:
+    """
+    Compute `population_statistics` for one stratum; runs in a worker process
+
+    Args:
+        stratum (tuple[tuple, DataFrame]): Stratum key (one value per stratum column) and its rows
+
+    Returns:
+        DataFrame: Statistics for each cell population, with a 'stratum' column holding the key
+    """
+    key, input_df = stratum
+    statistics = population_statistics(input_df)
+    statistics.insert(0, 'stratum', [ key ] * len(statistics))
+
+    return statistics
+
+def sweep_strata(input_df: DataFrame | None = None, strata: list[str] = STRATA, workers: int | None = None,
+                 min_subjects: int = MIN_SUBJECTS, alpha: float = ALPHA) -> DataFrame:
     """
-    Train model with proper cross-validation to estimate real-world performance.
+    Compare responders versus non-responders within every combination of the stratum columns
+
+    The data is pulled once and grouped in memory. Strata where either response group has fewer than
+    `min_subjects` subjects are skipped, the rest are tested in a process pool (see `population_statistics`),
+    and p-values are adjusted for the false discovery rate (Benjamini-Hochberg) across all tests.
+
+    Args:
+        input_df (DataFrame | None, optional): Input DataFrame with subject, population, response, percentage,
+            and stratum columns; defaults to `stratified_frequencies()`
+        strata (list[str], optional): Columns to stratify by; defaults to STRATA
+        workers (int | None, optional): Number of worker processes; 1 runs in this process; defaults to the number of CPUs
+        min_subjects (int, optional): Minimum number of subjects per response group; defaults to MIN_SUBJECTS
+        alpha (float, optional): False discovery rate; defaults to ALPHA
+
+    Returns:
+        DataFrame: One row per stratum and cell population with the stratum columns, unrounded statistics,
+            FDR-adjusted p-value ('q_value'), and whether the difference is significant
+    """
+    if input_df is None:
+        input_df = stratified_frequencies()
+
+    subjects = input_df.groupby([ *strata, 'response' ], observed = True, dropna = False)['subject'].nunique().unstack('response')
+    eligible = subjects[(subjects.reindex(columns = [ 'yes', 'no' ]).fillna(0) >= min_subjects).all(axis = 1)].index
+
+    # Grouping by a list always yields tuple keys, even for a single stratum column, whose index isn't a MultiIndex
+    if not isinstance(eligible, MultiIndex):
+        eligible = MultiIndex.from_arrays([ eligible ])
+
+    tasks = [
+        (key, frame[[ 'subject', 'population', 'response', 'percentage' ]])
+        for key, frame in input_df.groupby(strata, observed = True, dropna = False)
+        if key in eligible
+    ]
+
+    if workers == 1 or len(tasks) < 2:
+        results = list(map(stratum_statistics, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(stratum_statistics, tasks, chunksize = max(1, len(tasks) // (4 * (workers or cpu_count() or 1)))))
+
+    if not results:
+        return DataFrame(columns = [ *strata, 'population', 'q_value', 'significant' ])
+
+    sweep = concat(results, ignore_index = True)
+    sweep[strata] = DataFrame(sweep.pop('stratum').tolist(), columns = strata)
+    sweep = sweep[[ *strata, *sweep.columns[:-len(strata)] ]]
+
+    sweep['q_value'] = false_discovery_control(sweep['p_value'], method = 'bh')
+    sweep['significant'] = sweep['q_value'] < alpha
+
+    return sweep
+
+@cached_query()
+def comparison() -> DataFrame:
+    """
+    Comparison results for all samples with responses
+
+    Returns:
+        DataFrame: `compare_populations` results for `response_frequencies()`
+    """
+    return compare_populations(response_frequencies())
+
+@cached_query()
+def comparison_filter() -> DataFrame:
+    """
+    Comparison results for melanoma patients receiving miraclib with PBMC samples
+
+    Returns:
+        DataFrame: `compare_populations` results for `filtered_frequencies()`
+    """
+    return compare_populations(filtered_frequencies())
+
+@cached_query(maxsize = 128)
+def cohort_comparison(cohort: Cohort) -> DataFrame:
+    """
+    Comparison results for any cohort, e.g. one picked in the dashboard
+
+    Args:
+        cohort (Cohort): Cohort
+
+    Returns:
+        DataFrame: `compare_populations` results for the cohort; empty unless it has both responders and non-responders
+    """
+    frequencies = cohort_frequencies(cohort)
+
+    if set(frequencies["response"]) != { "yes", "no" }:
+        return DataFrame()
+
+    return compare_populations(frequencies)
+
+LAZY_ATTRIBUTES = {
+    "DATA_FRAME_SUMMARY": summary_frame,
+    "RESP_FREQ_DF": response_frequencies,
+    "DATA_FRAME_FILTERED_BOXPLOT": filtered_frequencies,
+    "DATA_FRAME2": training_frame,
+    "COMPARISON": comparison,
+    "COMPARISON_FILTER": comparison_filter
+}
+"""Module attributes that used to be computed at import time -> accessor now computing them on first use"""
+
+def __getattr__(name: str) -> DataFrame:
+    """
+    Compute the attributes in LAZY_ATTRIBUTES on access, so importing this module runs no queries
+
+    Args:
+        name (str): Attribute name
+
+    Returns:
+        DataFrame: Current (cached) value of the attribute
+    """
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def train_and_evaluate_model(data_frame: DataFrame, hyperparameters: dict = HYPERPARAMETERS,
+                             n_jobs: int | None = -1) -> tuple[RandomForestClassifier, LabelEncoder]:
+    """
+    Train the model on all of the data, for deployment. Hyperparameters can be tuned with
+    cross-validation grouped by subject beforehand (see `model_search.search`).
 
     Args:
         data_frame (DataFrame): Input DataFrame
+        hyperparameters (dict, optional): Classifier hyperparameters; defaults to HYPERPARAMETERS
+        n_jobs (int | None, optional): Number of cores used to build the trees; -1 uses all of them; defaults to -1
 
     Returns:
         tuple[RandomForestClassifier, LabelEncoder]: Trained model and label encoder
@@ -159,14 +541,44 @@ def train_and_evaluate_model(data_frame: DataFrame) -> tuple[RandomForestClassif
     le = LabelEncoder()
     y = le.fit_transform(data_frame['response'])
             
-    # Train and evaluate with cross-validation
-    clf = RandomForestClassifier(n_estimators = 100, random_state = 42, max_depth = 3)
+    clf = RandomForestClassifier(**hyperparameters, n_jobs = n_jobs)
             
     # Train final model on ALL data for deployment
-    clf.fit(X, y)
+    with span("train"):
+        clf.fit(X, y)
         
     return clf, le
 
+def trained_model(data_frame: DataFrame | None = None, hyperparameters: dict = HYPERPARAMETERS,
+                  directory: str = MODEL_DIRECTORY) -> tuple[ModelArtifact, bool]:
+    """
+    Load the model trained on the given data with the given hyperparameters, training and saving it if needed
+
+    Args:
+        data_frame (DataFrame | None, optional): Training data, one row per subject or sample; defaults to `training_frame()`
+            averaged per subject
+        hyperparameters (dict, optional): Classifier hyperparameters; defaults to HYPERPARAMETERS
+        directory (str, optional): Directory model artifacts are saved to; defaults to MODEL_DIRECTORY
+
+    Returns:
+        tuple[ModelArtifact, bool]: Model artifact, and whether it had to be trained
+    """
+    if data_frame is None:
+        # Handle multiple samples per subject by averaging
+        data_frame = training_frame().groupby(['subject', 'response'])[CELL_TYPES].mean().reset_index()
+
+    # Hashed before training, which adds columns to the frame
+    key = artifact_key(data_frame, hyperparameters)
+
+    if (artifact := load_artifact(key, directory)) is not None:
+        return artifact, False
+
+    model, encoder = train_and_evaluate_model(data_frame, hyperparameters)
+    artifact = ModelArtifact(model = model, encoder = encoder, feature_columns = list(CELL_TYPES), key = key)
+    save_artifact(artifact, directory)
+
+    return artifact, True
+
 def predict_new_sample(model: RandomForestClassifier, encoder: LabelEncoder, feature_cols: list[str], new_data: dict[str, int]) -> dict:
     """
     Predict response for a new patient's PBMC sample.
@@ -211,10 +623,11 @@ def predict_new_sample(model: RandomForestClassifier, encoder: LabelEncoder, fea
 def main():
     # Handle multiple samples per subject by averaging
     # This prevents data leakage during cross-validation
-    DATA_FRAME_SUBJECT = DATA_FRAME2.groupby(['subject', 'response'])[CELL_TYPES].mean().reset_index()
+    DATA_FRAME_SUBJECT = training_frame().groupby(['subject', 'response'])[CELL_TYPES].mean().reset_index()
 
-    # Train and evaluate the model
-    clf, le = train_and_evaluate_model(DATA_FRAME_SUBJECT)
+    # Load the model trained on this data, training it only if the data or hyperparameters changed
+    artifact, trained = trained_model(DATA_FRAME_SUBJECT)
+    print(f"{'Trained' if trained else 'Loaded'} model {artifact.key}")
 
     # Test prediction on new patient
     new_patient_data = {
@@ -225,7 +638,7 @@ def main():
         'monocyte': 13000
     }
 
-    result = predict_new_sample(clf, le, CELL_TYPES, new_patient_data)
+    result = predict_new_sample(artifact.model, artifact.encoder, artifact.feature_columns, new_patient_data)
     
     print(f"\n=== New Patient Prediction ===")
     print(f"Prediction: {result['prediction']}")
@@ -234,4 +647,5 @@ def main():
     print(f"P(yes response): {result['probability_yes']}%")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with run("stats_analysis"):
+        main()
\ No newline at end of file
@@ -1,83 +1,116 @@
-from pandas import read_sql_query
-from sqlite3 import connect
-from data_analysis import DATABASE
-
-connection = connect(DATABASE)
-
-# Identify all melanoma PBMC samples at baseline
-# (time_from_treatment_start is 0) from patients
-# who have been treated with miraclib
-DATA_FRAME_FILTER = read_sql_query(
-    f"""SELECT t.sample
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.sample_type = 'PBMC'
-        AND t.time_from_treatment_start = 0
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-    """, connection
-)
-print("1. All melanoma PBMC samples at baseline from patients treated with miraclib:")
-print(DATA_FRAME_FILTER)
-
-# How many samples from each project
-DATA_FRAME_PROJECTS = read_sql_query(
-    f"""SELECT subj.project, COUNT(t.sample) AS 'Number of Samples'
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.sample_type = 'PBMC'
-        AND t.time_from_treatment_start = 0
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-        GROUP BY subj.project
-    """, connection
-)
-print("\n2. Among the previously filtered samples, number of samples from each project:")
-print(DATA_FRAME_PROJECTS)
-
-# How many subjects were responders/non-responders 
-DATA_FRAME_RESPONDERS = read_sql_query(
-    f"""SELECT subj.response, COUNT(DISTINCT t.subject) AS 'Count'
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.sample_type = 'PBMC'
-        AND t.time_from_treatment_start = 0
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-        GROUP BY subj.response
-    """, connection
-)
-print("\n3. Among the previously filtered samples, number of subjects who were responders (yes) vs. non-responders (no):")
-print(DATA_FRAME_RESPONDERS)
-
-# How many subjects were males/females
-DATA_FRAME_SEXES = read_sql_query(
-    f"""SELECT subj.sex, COUNT(DISTINCT t.subject) AS 'Count'
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.sample_type = 'PBMC'
-        AND t.time_from_treatment_start = 0
-        AND subj.condition = 'melanoma'
-        AND subj.treatment = 'miraclib'
-        GROUP BY subj.sex
-    """, connection
-)
-print("\n4. Among the previously filtered samples, number of subjects who were males (M) vs females (F):")
-print(DATA_FRAME_SEXES)
-
-# Get number of b_cells for all males AND melanoma AND t = 0 AND responds
-DF = read_sql_query(
-    f"""SELECT t.b_cell
-        FROM samples t
-        JOIN subjects subj ON t.subject = subj.subject
-        WHERE t.time_from_treatment_start = 0
-        AND subj.condition = 'melanoma'
-        AND subj.sex = 'M'
-        AND subj.response = 'yes'
-    """, connection
-)
-
-avg_b_cells = DF['b_cell'].mean()
-print("\n5. Average number of B cells for Melanoma males responders at time = 0:", avg_b_cells)
-
-connection.close()
\ No newline at end of file
+from pandas import DataFrame
+from cohort import Cohort, cohort_summary, rollup
+from dataset import dataset
+from instrument import run
+
+BASELINE = Cohort(condition = "melanoma", treatment = "miraclib", sample_type = "PBMC", time_from_treatment_start = 0)
+"""All melanoma PBMC samples at baseline (time_from_treatment_start is 0) from patients who have been treated with miraclib"""
+
+RESPONDERS = Cohort(condition = "melanoma", sex = "M", response = "yes", time_from_treatment_start = 0)
+"""All samples of male melanoma responders at time = 0"""
+
+def baseline_samples() -> DataFrame:
+    """
+    Identify all melanoma PBMC samples at baseline
+    (time_from_treatment_start is 0) from patients
+    who have been treated with miraclib
+
+    Returns:
+        DataFrame: Sample IDs
+    """
+    data = dataset()
+    return data.samples(data.mask(BASELINE))
+
+def samples_per_project() -> DataFrame:
+    """
+    How many samples from each project
+
+    Returns:
+        DataFrame: Number of baseline samples per project
+    """
+    return rollup(cohort_summary(BASELINE), [ "project" ])[[ "project", "samples" ]].rename(columns = { "samples": "Number of Samples" })
+
+def subjects_per_response() -> DataFrame:
+    """
+    How many subjects were responders/non-responders
+
+    Returns:
+        DataFrame: Number of subjects with baseline samples per response
+    """
+    return rollup(cohort_summary(BASELINE), [ "response" ])[[ "response", "subjects" ]].rename(columns = { "subjects": "Count" })
+
+def subjects_per_sex() -> DataFrame:
+    """
+    How many subjects were males/females
+
+    Returns:
+        DataFrame: Number of subjects with baseline samples per sex
+    """
+    return rollup(cohort_summary(BASELINE), [ "sex" ])[[ "sex", "subjects" ]].rename(columns = { "subjects": "Count" })
+
+def responder_b_cells() -> DataFrame:
+    """
+    Get number of b_cells for all males AND melanoma AND t = 0 AND responds
+
+    Returns:
+        DataFrame: B cell count of every matching sample
+    """
+    data = dataset()
+    return data.samples(data.mask(RESPONDERS), ("b_cell",))
+
+def average_responder_b_cells() -> float:
+    """
+    Get average number of b_cells for all males AND melanoma AND t = 0 AND responds,
+    without fetching the individual counts
+
+    Returns:
+        float: Mean B cell count of the matching samples
+    """
+    return rollup(cohort_summary(RESPONDERS), [])["b_cell"].iloc[0]
+
+LAZY_ATTRIBUTES = {
+    "DATA_FRAME_FILTER": baseline_samples,
+    "DATA_FRAME_PROJECTS": samples_per_project,
+    "DATA_FRAME_RESPONDERS": subjects_per_response,
+    "DATA_FRAME_SEXES": subjects_per_sex,
+    "DF": responder_b_cells
+}
+"""Module attributes that used to be computed at import time -> accessor now computing them on first use"""
+
+def __getattr__(name: str) -> DataFrame:
+    """
+    Compute the attributes in LAZY_ATTRIBUTES on access, so importing this module runs no queries
+
+    Args:
+        name (str): Attribute name
+
+    Returns:
+        DataFrame: Current (cached) value of the attribute
+    """
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def main() -> None:
+    """
+    Main function for Part 4: Data Subset Analysis
+    """
+    print("1. All melanoma PBMC samples at baseline from patients treated with miraclib:")
+    print(baseline_samples())
+
+    print("\n2. Among the previously filtered samples, number of samples from each project:")
+    print(samples_per_project())
+
+    print("\n3. Among the previously filtered samples, number of subjects who were responders (yes) vs. non-responders (no):")
+    print(subjects_per_response())
+
+    print("\n4. Among the previously filtered samples, number of subjects who were males (M) vs females (F):")
+    print(subjects_per_sex())
+
+    avg_b_cells = average_responder_b_cells()
+    print("\n5. Average number of B cells for Melanoma males responders at time = 0:", avg_b_cells)
+
+if __name__ == "__main__":
+    with run("subset_analysis"):
+        main()
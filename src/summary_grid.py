@@ -0,0 +1,278 @@
+from load_data import POPULATION_POSITION
+from database import DATABASE, reader
+from query_cache import QueryCache, cached_query
+from instrument import count, span
+
+FIELDS = {
+    "sample": "sample",
+    "Cell Population": "population",
+    "count": "count",
+    "Total Count": "total_count",
+    "Relative Frequency (%)": "percentage"
+}
+"""Grid field (i.e. column name displayed in the dashboard) -> column of the 'summary' table"""
+
+TEXT_FIELDS = [ "sample", "Cell Population" ]
+"""Grid fields filtered as text; the others are filtered as numbers"""
+
+PAGE_SIZE: int = 100
+"""Number of rows the grid requests at a time"""
+
+ORDER_TIEBREAK = [ ("sample", "ASC"), (POPULATION_POSITION, "ASC") ]
+"""Sample and position of the population in CELL_TYPES, unique like the 'summary' table's primary key; appended to
+every ordering so pages never overlap or skip rows, and so unsorted rows list each sample's populations in CELL_TYPES order"""
+
+BOUNDARY_CACHE_SIZE: int = 1024
+"""Maximum number of page boundaries kept for keyset pagination (see `page_boundary`)"""
+
+_boundaries = QueryCache(BOUNDARY_CACHE_SIZE)
+"""(filter, parameters, ordering, row) -> sort key of the row just before it, until the database changes"""
+
+TEXT_CONDITIONS = {
+    "contains": ("{column} LIKE ? ESCAPE '\\'", "%{value}%"),
+    "notContains": ("{column} NOT LIKE ? ESCAPE '\\'", "%{value}%"),
+    "startsWith": ("{column} LIKE ? ESCAPE '\\'", "{value}%"),
+    "endsWith": ("{column} LIKE ? ESCAPE '\\'", "%{value}"),
+    "equals": ("{column} = ?", None),
+    "notEqual": ("{column} != ?", None)
+}
+"""AG Grid text filter type -> (SQL condition, LIKE pattern; None to compare the value as is)"""
+
+NUMBER_CONDITIONS = {
+    "equals": "{column} = ?",
+    "notEqual": "{column} != ?",
+    "lessThan": "{column} < ?",
+    "lessThanOrEqual": "{column} <= ?",
+    "greaterThan": "{column} > ?",
+    "greaterThanOrEqual": "{column} >= ?",
+    "inRange": "{column} BETWEEN ? AND ?"
+}
+"""AG Grid number filter type -> SQL condition"""
+
+def condition_clause(field: str, model: dict) -> tuple[str, list]:
+    """
+    Translate the filter model of one grid column into a SQL condition
+
+    Args:
+        field (str): Grid field; must be in FIELDS
+        model (dict): AG Grid text or number filter model, either a single condition or
+            a combination of `conditions` joined by `operator`
+
+    Raises:
+        ValueError: If the field or filter type isn't supported
+
+    Returns:
+        tuple[str, list]: SQL condition and its parameters
+    """
+    if field not in FIELDS:
+        raise ValueError(f"Unknown grid field: {field}")
+
+    column = FIELDS[field]
+
+    # Combined model, e.g. "contains A OR contains B"
+    if "conditions" in model:
+        operator = { "AND": " AND ", "OR": " OR " }[model.get("operator", "AND")]
+        clauses = [ condition_clause(field, condition) for condition in model["conditions"] ]
+        return "(" + operator.join(sql for sql, _ in clauses) + ")", [ parameter for _, parameters in clauses for parameter in parameters ]
+
+    filter_type = model.get("type")
+
+    if filter_type == "blank":
+        return f"{column} IS NULL", []
+    if filter_type == "notBlank":
+        return f"{column} IS NOT NULL", []
+
+    if field in TEXT_FIELDS:
+        if filter_type not in TEXT_CONDITIONS:
+            raise ValueError(f"Unsupported text filter: {filter_type}")
+
+        sql, pattern = TEXT_CONDITIONS[filter_type]
+        value = str(model.get("filter", ""))
+
+        if pattern is not None:
+            value = pattern.format(value = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+        return sql.format(column = column), [ value ]
+
+    if filter_type not in NUMBER_CONDITIONS:
+        raise ValueError(f"Unsupported number filter: {filter_type}")
+
+    parameters = [ model.get("filter") ] + ([ model.get("filterTo") ] if filter_type == "inRange" else [])
+    return NUMBER_CONDITIONS[filter_type].format(column = column), parameters
+
+def where_clause(filter_model: dict | None) -> tuple[str, tuple]:
+    """
+    Translate the grid's filter model into a WHERE clause
+
+    Args:
+        filter_model (dict | None): Grid field -> filter model
+
+    Returns:
+        tuple[str, tuple]: WHERE clause (empty if nothing is filtered) and its parameters
+    """
+    clauses = [ condition_clause(field, model) for field, model in sorted((filter_model or {}).items()) ]
+
+    if not clauses:
+        return "", ()
+
+    return "WHERE " + " AND ".join(sql for sql, _ in clauses), tuple(parameter for _, parameters in clauses for parameter in parameters)
+
+def sort_terms(sort_model: list[dict] | None) -> tuple[tuple[str, str], ...]:
+    """
+    Translate the grid's sort model into the terms of an ORDER BY clause
+
+    Args:
+        sort_model (list[dict] | None): Columns to sort by, each with a `colId` and a `sort` direction
+
+    Raises:
+        ValueError: If a column or direction isn't supported
+
+    Returns:
+        tuple[tuple[str, str], ...]: (expression, direction) of each term, always ending with ORDER_TIEBREAK
+    """
+    terms = []
+
+    for sort in sort_model or []:
+        if sort.get("colId") not in FIELDS or sort.get("sort") not in ("asc", "desc"):
+            raise ValueError(f"Unsupported sort: {sort}")
+
+        terms.append((FIELDS[sort["colId"]], sort["sort"].upper()))
+
+    return tuple(terms + ORDER_TIEBREAK)
+
+def order_clause(terms: tuple[tuple[str, str], ...]) -> str:
+    """
+    Build an ORDER BY clause
+
+    Args:
+        terms (tuple[tuple[str, str], ...]): Output of `sort_terms`
+
+    Returns:
+        str: ORDER BY clause
+    """
+    return "ORDER BY " + ", ".join(f"{expression} {direction}" for expression, direction in terms)
+
+def seek_clause(terms: tuple[tuple[str, str], ...], key: tuple) -> tuple[str, tuple]:
+    """
+    Build a condition selecting the rows that come after a row in an ordering, for keyset pagination
+
+    The leading term's bound comes first and on its own, so SQLite can start from it in an index.
+
+    Args:
+        terms (tuple[tuple[str, str], ...]): Output of `sort_terms`
+        key (tuple): Value of each term for the row; none may be NULL
+
+    Returns:
+        tuple[str, tuple]: SQL condition and its parameters
+    """
+    clauses = []
+    parameters = []
+
+    # (a, b, c) after (x, y, z) is a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z), reversed for DESC terms
+    for position, (expression, direction) in enumerate(terms):
+        equal = [ f"{previous} = ?" for previous, _ in terms[:position] ]
+        clauses.append("(" + " AND ".join(equal + [ f"{expression} {'>' if direction == 'ASC' else '<'} ?" ]) + ")")
+        parameters.extend(key[:position + 1])
+
+    (expression, direction), value = terms[0], key[0]
+
+    return f"{expression} {'>=' if direction == 'ASC' else '<='} ? AND (" + " OR ".join(clauses) + ")", (value, *parameters)
+
+def page_boundary(where: str, parameters: tuple, terms: tuple[tuple[str, str], ...], start: int) -> tuple | None:
+    """
+    Get the sort key of the row just before a page, so the page can be read by seeking past it
+
+    Serving a page records the key of its last row for the page that follows (see `summary_rows`), so
+    scrolling reads each page in time proportional to its size. Only a jump to an unvisited page reads
+    the rows before it, once.
+
+    Args:
+        where (str): Output of `where_clause`
+        parameters (tuple): Parameters of `where`
+        terms (tuple[tuple[str, str], ...]): Output of `sort_terms`
+        start (int): Position of the page's first row; must be positive
+
+    Returns:
+        tuple | None: Value of each of `terms` for the row; None if there is no such row or a value is NULL,
+            which SQL can't seek past
+    """
+    def boundary() -> tuple | None:
+        count("boundary_scans")
+        return reader(DATABASE).execute(
+            f"""SELECT {', '.join(expression for expression, _ in terms)}
+                FROM summary
+                {where}
+                {order_clause(terms)}
+                LIMIT 1 OFFSET ?
+            """,
+            parameters + (start - 1,)
+        ).fetchone()
+
+    key = _boundaries.get((where, parameters, terms, start), boundary)
+    return key if key is not None and None not in key else None
+
+@cached_query()
+def row_count(where: str, parameters: tuple) -> int:
+    """
+    Count the summary table rows matching a filter, cached until the database changes
+
+    Args:
+        where (str): Output of `where_clause`
+        parameters (tuple): Parameters of `where`
+
+    Returns:
+        int: Number of matching rows
+    """
+    return reader(DATABASE).execute(f"SELECT COUNT(*) FROM summary {where}", parameters).fetchone()[0]
+
+def summary_rows(request: dict) -> dict:
+    """
+    Answer a request of the summary grid's infinite row model with a single page of rows
+
+    Only the requested rows are read and sent, so the page size and the time it takes don't depend on
+    the size of the table: pages start by seeking past the sort key of the previous page's last row
+    (see `page_boundary`) rather than skipping an OFFSET of rows. Sorting and filtering are done by
+    SQLite; field names and filter types are checked against FIELDS and the supported conditions, and
+    values are always passed as parameters.
+
+    Args:
+        request (dict): AG Grid `getRowsRequest` with `startRow`, `endRow`, `sortModel` and `filterModel`
+
+    Returns:
+        dict: AG Grid `getRowsResponse` with the page's `rowData` and the total `rowCount`
+    """
+    start = max(int(request.get("startRow") or 0), 0)
+    end = max(int(request.get("endRow") or start + PAGE_SIZE), start)
+
+    where, parameters = where_clause(request.get("filterModel"))
+    terms = sort_terms(request.get("sortModel"))
+
+    with span("query"):
+        key = page_boundary(where, parameters, terms, start) if start > 0 else None
+
+        # Without a key (first page, or a NULL in the previous row's key) the page falls back to OFFSET
+        if key is not None:
+            seek, seek_parameters = seek_clause(terms, key)
+            condition = f"{where} AND {seek}" if where else f"WHERE {seek}"
+            query_parameters, offset = parameters + seek_parameters, 0
+        else:
+            condition, query_parameters, offset = where, parameters, start
+
+        cursor = reader(DATABASE).execute(
+            f"""SELECT {', '.join(FIELDS.values())}, {', '.join(expression for expression, _ in terms)}
+                FROM summary
+                {condition}
+                {order_clause(terms)}
+                LIMIT ? OFFSET ?
+            """,
+            query_parameters + (end - start, offset)
+        )
+        results = cursor.fetchall()
+        rows = [ dict(zip(FIELDS, row)) for row in results ]
+
+    # The next page seeks past this page's last row
+    if len(results) == end - start and results:
+        last = results[-1][len(FIELDS):]
+        _boundaries.get((where, parameters, terms, end), lambda: last)
+
+    return { "rowData": rows, "rowCount": row_count(where, parameters) }